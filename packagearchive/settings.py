@@ -80,6 +80,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # In-memory test databases fail with "database table is locked" when threads (processincoming
+        # --jobs) write at the same time, a file lets them wait for each other.
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test-db.sqlite3')},
     }
 }
 
@@ -132,9 +135,14 @@ MEDIA_URL = '/media/'
 APT_BASEDIR = os.environ.get("APT_BASEDIR", default=None)
 RPM_BASEDIR = os.environ.get("RPM_BASEDIR", default=None)
 RPM_CACHEDIR = os.environ.get("RPM_CACHEDIR", default="/tmp/cache/createrepo")
+# also read by "python -m repomanager.precheck", which doesn't load the settings
+PRECHECK_STATE = os.environ.get("PRECHECK_STATE", default="/tmp/cache/repomanager/precheck.json")
 
 SELINUX = False
 
+# seconds API responses are cached, see repomanager.cache
+API_CACHE_TIMEOUT = int(os.environ.get("API_CACHE_TIMEOUT", default=300))
+
 try:
     from .localsettings import *  # NOQA
 except ImportError:
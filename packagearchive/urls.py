@@ -2,10 +2,19 @@ from django.urls import path
 from django.contrib import admin
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
+from repomanager import api
+from repomanager.views import metrics
+from repomanager.views import upload
+
 admin.autodiscover()
 
 urlpatterns = [
     # Uncomment the next line to enable the admin:
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
+    path('api/packages/', api.packages, name='api-packages'),
+    path('api/sourcepackages/', api.source_packages, name='api-sourcepackages'),
+    path('api/binarypackages/', api.binary_packages, name='api-binarypackages'),
+    path('upload/<str:dirname>/', upload, name='upload'),
 ]
 urlpatterns += staticfiles_urlpatterns()
@@ -12,15 +12,59 @@
 # not, see <http://www.gnu.org/licenses/>.
 
 from django.contrib import admin
-
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Prefetch
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import cached_property
+
+from .constants import JOB_FAILED
+from .constants import JOB_PENDING
+from .constants import JOB_RUNNING
 from .models import BinaryPackage
 from .models import Component
 from .models import Distribution
 from .models import IncomingDirectory
+from .models import Job
 from .models import Package
+from .models import PendingUpload
 from .models import SourcePackage
 
 
+class EstimatedCountPaginator(Paginator):
+    """Paginator that uses the row estimate of the database for unfiltered querysets.
+
+    Counting all rows of a large table is slow on PostgreSQL, while the planner statistics are good
+    enough for the number of pages. Other databases and filtered querysets are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        if connection.vendor == 'postgresql' and not qs.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [qs.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] > 0:
+                return int(row[0])
+        return super().count
+
+
+class CappedInlineFormSet(BaseInlineFormSet):
+    """Inline formset that shows at most ``max_rows`` rows."""
+
+    max_rows = None
+
+    def get_queryset(self):
+        # cache the sliced queryset, slicing creates a new queryset that would be evaluated again
+        if not hasattr(self, '_capped_queryset'):
+            qs = super().get_queryset()
+            if self.max_rows is not None:
+                qs = qs[:self.max_rows]
+            self._capped_queryset = qs
+        return self._capped_queryset
+
+
 @admin.register(Component)
 class ComponentAdmin(admin.ModelAdmin):
     list_display = ('name', 'enabled', 'last_seen', )
@@ -34,14 +78,23 @@ class DistributionAdmin(admin.ModelAdmin):
     list_display = ('name', 'vendor', 'last_seen', 'supported_until')
     list_filter = ('vendor', )
     ordering = ('name', )
-    readonly_fields = ('last_seen', )
+    readonly_fields = ('last_seen', 'needs_export', )
 
 
-class SourcePackageInline(admin.TabularInline):
-    model = SourcePackage
-    fields = ('timestamp', 'version', 'dist', 'components')
-    readonly_fields = ('timestamp', 'version', 'dist', 'components')
-    ordering = ('-dist__released', )
+class UploadInline(admin.TabularInline):
+    """Base class for read-only inlines of uploads, which can have a very long history."""
+
+    formset = CappedInlineFormSet
+    max_rows = 50
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('package', 'dist').prefetch_related(
+            Prefetch('components', queryset=Component.objects.order_by('name')))
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.max_rows = self.max_rows
+        return formset
 
     def has_add_permission(self, request, obj):
         return False
@@ -50,18 +103,19 @@ class SourcePackageInline(admin.TabularInline):
         return False
 
 
-class BinaryPackageInline(admin.TabularInline):
+class SourcePackageInline(UploadInline):
+    model = SourcePackage
+    fields = ('timestamp', 'version', 'dist', 'components')
+    readonly_fields = ('timestamp', 'version', 'dist', 'components')
+    ordering = ('-dist__released', )
+
+
+class BinaryPackageInline(UploadInline):
     model = BinaryPackage
     fields = ('timestamp', 'name', 'version', 'arch', 'dist', 'components')
     readonly_fields = ('timestamp', 'name', 'version', 'arch', 'dist', 'components')
     ordering = ('-dist__released', 'name', 'arch', )
 
-    def has_add_permission(self, request, obj):
-        return False
-
-    def has_delete_permission(self, request, obj):
-        return False
-
 
 @admin.register(Package)
 class PackageAdmin(admin.ModelAdmin):
@@ -72,11 +126,88 @@ class PackageAdmin(admin.ModelAdmin):
     list_display = ('name', 'components_list', 'last_seen', )
     list_filter = ('all_components', 'components', )
     ordering = ('name', )
+    paginator = EstimatedCountPaginator
     readonly_fields = ('last_seen', )
     search_fields = ('name', )
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('components', queryset=Component.objects.order_by('name')))
+
+    def components_list(self, obj):
+        return ', '.join(c.name for c in obj.components.all())
+
+
+class UploadAdmin(admin.ModelAdmin):
+    """Read-only changelist of all uploads, paginated instead of capped like the inlines."""
+
+    list_filter = ('dist', )
+    list_select_related = ('package', 'dist', )
+    ordering = ('-pk', )
+    paginator = EstimatedCountPaginator
+    search_fields = ('package__name', )
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('components', queryset=Component.objects.order_by('name')))
 
     def components_list(self, obj):
-        return ', '.join(obj.components.all().order_by('name').values_list('name', flat=True))
+        return ', '.join(c.name for c in obj.components.all())
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SourcePackage)
+class SourcePackageAdmin(UploadAdmin):
+    list_display = ('package', 'version', 'dist', 'components_list', 'timestamp', )
+
+
+@admin.register(BinaryPackage)
+class BinaryPackageAdmin(UploadAdmin):
+    list_display = ('name', 'package', 'version', 'arch', 'dist', 'components_list', 'timestamp', )
+    search_fields = ('name', 'package__name', )
+
+
+@admin.register(PendingUpload)
+class PendingUploadAdmin(admin.ModelAdmin):
+    actions = ['retry']
+    list_display = ('path', 'attempts', 'quarantined', 'last_attempt', 'next_attempt', 'last_error', )
+    list_filter = ('quarantined', )
+    ordering = ('path', )
+    readonly_fields = ('path', 'directory', 'fingerprint', 'first_seen', 'last_attempt', )
+    search_fields = ('path', )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Retry with the next run')
+    def retry(self, request, queryset):
+        queryset.update(attempts=0, quarantined=False, next_attempt=None)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    actions = ['retry']
+    list_display = ('path', 'status', 'attempts', 'worker', 'started', 'finished', 'needs_publish', )
+    list_filter = ('status', 'needs_publish', )
+    ordering = ('-pk', )
+    readonly_fields = ('path', 'lock', 'worker', 'created', 'started', 'finished', 'publish', )
+    search_fields = ('path', )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Retry failed jobs')
+    def retry(self, request, queryset):
+        # there may only be one open job per directory
+        open_paths = Job.objects.filter(status__in=[JOB_PENDING, JOB_RUNNING]).values('path')
+        queryset.filter(status=JOB_FAILED).exclude(path__in=open_paths).update(status=JOB_PENDING, attempts=0)
 
 
 @admin.register(IncomingDirectory)
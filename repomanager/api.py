@@ -0,0 +1,193 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Read-only JSON API for packages and uploads.
+
+Lists are paginated with keysets: a response contains at most ``limit`` results and the URL of the next
+page, which continues after the last result. ``Last-Modified`` and ``ETag`` headers are derived from the
+latest upload, so clients can use conditional requests, and responses are cached on the server (see
+:py:mod:`repomanager.cache`).
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db.models import Max
+from django.db.models import Prefetch
+from django.http import JsonResponse
+from django.views.decorators.http import condition
+from django.views.decorators.http import require_GET
+
+from . import cache
+from .models import BinaryPackage
+from .models import Component
+from .models import Distribution
+from .models import Package
+from .models import SourcePackage
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class ApiError(Exception):
+    """Invalid request parameters."""
+
+
+def get_last_modified(request, *args, **kwargs):
+    """Get the time of the latest upload, which uses the timestamp indexes."""
+
+    timestamps = [model.objects.aggregate(latest=Max('timestamp'))['latest']
+                  for model in [SourcePackage, BinaryPackage]]
+    return max((t for t in timestamps if t is not None), default=None)
+
+
+def get_etag(request, *args, **kwargs):
+    last_modified = get_last_modified(request)
+    data = f'{cache.get_version()}:{last_modified}:{request.get_full_path()}'
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+
+def get_components():
+    return Prefetch('components', queryset=Component.objects.order_by('name'))
+
+
+def get_limit(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit must be an integer.')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ApiError(f'limit must be between 1 and {MAX_LIMIT}.')
+    return limit
+
+
+def paginate(request, qs, key, serialize):
+    """Get a page of `qs` (ordered by `key`) starting after the ``after`` parameter."""
+
+    limit = get_limit(request)
+    after = request.GET.get('after')
+    if after is not None:
+        if key == 'pk':
+            try:
+                after = int(after)
+            except ValueError:
+                raise ApiError('after must be an integer.')
+        qs = qs.filter(**{f'{key}__gt': after})
+
+    rows = list(qs.order_by(key)[:limit + 1])  # one more row to know if there is a next page
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = request.GET.copy()
+        params['after'] = getattr(rows[-1], key)
+        next_url = f'{request.path}?{params.urlencode()}'
+    return {'results': [serialize(row) for row in rows], 'next': next_url}
+
+
+def filter_uploads(request, qs, fields):
+    """Filter uploads by the request parameters that are keys of `fields`.
+
+    With ``newest``, only the newest version of every package is included, with ``newer_than`` (which
+    requires ``dist``) only versions newer than the given one.
+    """
+
+    for param, lookup in fields.items():
+        value = request.GET.get(param)
+        if value is not None:
+            qs = qs.filter(**{lookup: value})
+
+    if request.GET.get('newest'):
+        qs = qs.newest()
+    if 'newer_than' in request.GET:
+        dist = Distribution.objects.filter(name=request.GET.get('dist')).first()
+        if dist is None:
+            raise ApiError('newer_than requires an existing dist.')
+        qs = qs.newer_than(dist, request.GET['newer_than'])
+    return qs
+
+
+def serialize_package(package):
+    return {
+        'name': package.name,
+        'components': [c.name for c in package.components.all()],
+        'all_components': package.all_components,
+        'all_distributions': package.all_distributions,
+        'last_seen': package.last_seen,
+    }
+
+
+def serialize_upload(upload):
+    return {
+        'id': upload.pk,
+        'package': upload.package.name,
+        'dist': upload.dist.name,
+        'version': upload.version,
+        'components': [c.name for c in upload.components.all()],
+        'timestamp': upload.timestamp,
+    }
+
+
+def serialize_binary_package(upload):
+    data = serialize_upload(upload)
+    data.update(name=upload.name, arch=upload.arch)
+    return data
+
+
+def get_packages(request):
+    qs = Package.objects.prefetch_related(get_components())
+    if 'component' in request.GET:
+        qs = qs.filter(components__name=request.GET['component'])
+    return paginate(request, qs, 'name', serialize_package)
+
+
+def get_source_packages(request):
+    qs = SourcePackage.objects.select_related('package', 'dist').prefetch_related(get_components())
+    qs = filter_uploads(request, qs, {
+        'package': 'package__name', 'dist': 'dist__name', 'component': 'components__name',
+        'version': 'version',
+    })
+    return paginate(request, qs, 'pk', serialize_upload)
+
+
+def get_binary_packages(request):
+    qs = BinaryPackage.objects.select_related('package', 'dist').prefetch_related(get_components())
+    qs = filter_uploads(request, qs, {
+        'package': 'package__name', 'name': 'name', 'dist': 'dist__name', 'arch': 'arch',
+        'component': 'components__name', 'version': 'version',
+    })
+    return paginate(request, qs, 'pk', serialize_binary_package)
+
+
+def cached_view(func):
+    """Wrap a function returning data for a JSON response into a cached and conditional view."""
+
+    @require_GET
+    @condition(etag_func=get_etag, last_modified_func=get_last_modified)
+    def view(request):
+        key = cache.get_key(get_last_modified(request), request.get_full_path())
+        data = django_cache.get(key)
+        if data is None:
+            try:
+                data = func(request)
+            except ApiError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            django_cache.set(key, data, settings.API_CACHE_TIMEOUT)
+        return JsonResponse(data)
+    return view
+
+
+packages = cached_view(get_packages)
+source_packages = cached_view(get_source_packages)
+binary_packages = cached_view(get_binary_packages)
@@ -0,0 +1,316 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Offline benchmark of processincoming.
+
+Uploads are generated for a number of Debian and Fedora dists and processed with fake ``reprepro``,
+``createrepo_c``, ``rpm`` and ``restorecon`` executables that only sleep for a configurable time, so
+the benchmark measures the overhead of processincoming itself.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from .constants import VENDOR_DEBIAN
+from .constants import VENDOR_FEDORA
+from .metrics import Metrics
+from .models import Component
+from .models import Distribution
+from .models import IncomingDirectory
+from .models import Package
+from .models import RunSummary
+from .rpm import RPM_LEAD
+from .rpm import RPM_MAGIC
+from .rpm import RPM_TYPE_SOURCE
+
+# default latency of the fake tools in seconds
+LATENCY = {
+    'reprepro': 0.01,
+    'createrepo_c': 0.05,
+    'rpm': 0.005,
+    'restorecon': 0.01,
+}
+
+# the fake rpm reports a valid signature for every file
+FAKE_RPM = '''
+for arg in "$@"; do
+    case "$arg" in
+        -*) ;;
+        *) echo "$arg: digests signatures OK" ;;
+    esac
+done
+'''
+
+# the fake createrepo_c creates repodata/repomd.xml, so that components are not regenerated every time
+FAKE_CREATEREPO_C = '''
+while [ $# -gt 0 ]; do
+    if [ "$1" = "--basedir" ]; then
+        shift
+        mkdir -p "$1/repodata" && : > "$1/repodata/repomd.xml"
+    fi
+    shift
+done
+'''
+
+# keys of the results that must not increase
+PER_UPLOAD_KEYS = ['subprocesses_per_upload', 'queries_per_upload']
+
+
+def write_fake_tools(bindir, latency):
+    """Write fake executables for all tools in `latency` to `bindir`."""
+
+    os.makedirs(bindir, exist_ok=True)
+    for tool, seconds in latency.items():
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as stream:
+            stream.write('#!/bin/sh\n')
+            stream.write(f'# fake {tool} for benchmarks\n')
+            if seconds > 0:
+                stream.write(f'sleep {seconds}\n')
+            if tool == 'createrepo_c':
+                stream.write(FAKE_CREATEREPO_C)
+            elif tool == 'rpm':
+                stream.write(FAKE_RPM)
+            stream.write('exit 0\n')
+        os.chmod(path, 0o755)
+
+
+def _rpm_header(entries, signature=False):
+    """Get an RPM header structure with the given ``(tag, value)`` entries."""
+
+    store = b''
+    index = b''
+    for tag, value in entries:
+        if isinstance(value, str):
+            data = value.encode('utf-8') + b'\0'
+            type_ = 6  # RPM_STRING_TYPE
+        else:
+            store += b'\0' * (-len(store) % 4)  # integers are aligned
+            data = struct.pack('!I', value)
+            type_ = 4  # RPM_INT32_TYPE
+        index += struct.pack('!iiii', tag, type_, len(store), 1)
+        store += data
+
+    header = b'\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('!ii', len(entries), len(store)) + index + store
+    if signature:
+        header += b'\0' * (-len(header) % 8)  # the signature header is padded to eight bytes
+    return header
+
+
+def make_rpm(directory, name, version, release, arch, size):
+    """Write a minimal RPM file with a random payload of `size` bytes and return its path."""
+
+    source = arch == 'src'
+    lead = RPM_LEAD.pack(RPM_MAGIC, 3, 0, RPM_TYPE_SOURCE if source else 0, 1,
+                         f'{name}-{version}-{release}'.encode('utf-8'), 1, 5, b'')
+    entries = [(1000, name), (1001, version), (1002, release), (1022, 'x86_64' if source else arch)]
+    if not source:
+        entries.append((1044, f'{name}-{version}-{release}.src.rpm'))  # RPMTAG_SOURCERPM
+
+    path = os.path.join(directory, f'{name}-{version}-{release}.{arch}.rpm')
+    with open(path, 'wb') as stream:
+        stream.write(lead + _rpm_header([(1000, 0)], signature=True) + _rpm_header(entries))
+        stream.write(os.urandom(size))
+    return path
+
+
+def make_changes(directory, source, version, binaries, arch, size):
+    """Write a .changes file with a .dsc and a .deb file for every binary package and return its path."""
+
+    files = {f'{binary}_{version}_{arch}.deb': b'!<arch>\n' + os.urandom(size) for binary in binaries}
+    files[f'{source}_{version}.dsc'] = f'Source: {source}\nVersion: {version}\n'.encode('utf-8')
+    for name, data in files.items():
+        with open(os.path.join(directory, name), 'wb') as stream:
+            stream.write(data)
+
+    lines = [
+        'Format: 1.8',
+        f'Source: {source}',
+        f'Binary: {" ".join(binaries)}',
+        f'Architecture: source {arch}',
+        f'Version: {version}',
+        'Distribution: unstable',
+        'Checksums-Sha256:',
+    ]
+    lines += [f' {hashlib.sha256(data).hexdigest()} {len(data)} {name}' for name, data in files.items()]
+    lines.append('Files:')
+    lines += [f' {hashlib.md5(data).hexdigest()} {len(data)} misc optional {name}'
+              for name, data in files.items()]
+
+    path = os.path.join(directory, f'{source}_{version}_{arch}.changes')
+    with open(path, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+    return path
+
+
+def create_fixtures(incoming, dists, packages):
+    """Create `dists` Debian and Fedora dists, `packages` packages and the incoming directory."""
+
+    main = Component.objects.get_or_create(name='main')[0]
+    for i in range(dists):
+        dist = Distribution.objects.get_or_create(name=f'bench{i}', defaults={'vendor': VENDOR_DEBIAN})[0]
+        dist.components.add(main)
+        os.makedirs(os.path.join(incoming, f'{dist.name}-amd64'), exist_ok=True)
+
+        dist = Distribution.objects.get_or_create(name=f'benchfc{i}', defaults={'vendor': VENDOR_FEDORA})[0]
+        for arch in ['x86_64', 'src']:
+            dist.components.add(Component.objects.get_or_create(name=f'{dist.name}-{arch}')[0])
+        os.makedirs(os.path.join(incoming, dist.name), exist_ok=True)
+
+    for j in range(packages):
+        Package.objects.get_or_create(name=f'bench{j}', defaults={'all_components': True})
+    IncomingDirectory.objects.get_or_create(location=incoming)
+
+
+def generate_uploads(incoming, dists, packages, version, size):
+    """Generate one upload of every package for every dist. Returns the number of uploads."""
+
+    uploads = 0
+    for i in range(dists):
+        for j in range(packages):
+            make_changes(os.path.join(incoming, f'bench{i}-amd64'), f'bench{j}', f'{version}-1',
+                         [f'bench{j}'], 'amd64', size)
+            make_rpm(os.path.join(incoming, f'benchfc{i}'), f'bench{j}', version, '1', 'x86_64', size)
+            uploads += 2
+    return uploads
+
+
+class QueryCounter:
+    """Count the database queries of all threads while it is used as a context manager."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        # worker threads open their own connections
+        connection_created.connect(self.install)
+        for connection in connections.all():
+            self.install(connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+@contextmanager
+def fake_tools(bindir):
+    """Prepend `bindir` to ``PATH``, so that processincoming runs the fake tools."""
+
+    path = os.environ.get('PATH', '')
+    os.environ['PATH'] = os.pathsep.join([bindir, path])
+    try:
+        yield
+    finally:
+        os.environ['PATH'] = path
+
+
+def run_benchmark(workdir, dists=2, packages=50, runs=3, latency=LATENCY, size=64 * 1024, jobs=1,
+                  selinux=False, stderr=None):
+    """Run processincoming `runs` times on newly generated uploads and return the results as dict.
+
+    The database must be a test database, as rows are created and processincoming writes to it.
+    """
+
+    bindir = os.path.join(workdir, 'bin')
+    incoming = os.path.join(workdir, 'incoming')
+    write_fake_tools(bindir, latency)
+    create_fixtures(incoming, dists, packages)
+
+    repo_settings = {
+        'DEB_BASEDIR': os.path.join(workdir, 'deb'),
+        'RPM_BASEDIR': os.path.join(workdir, 'rpm'),
+        'RPM_CACHEDIR': os.path.join(workdir, 'cache'),
+        'PRECHECK_STATE': os.path.join(workdir, 'precheck.json'),
+        'SELINUX': selinux,
+    }
+
+    uploads = 0
+    elapsed = 0.0
+    metrics = Metrics()
+    with override_settings(**repo_settings), fake_tools(bindir), QueryCounter() as queries:
+        for run in range(runs):
+            uploads += generate_uploads(incoming, dists, packages, f'1.{run}', size)
+
+            start = time.monotonic()
+            call_command('processincoming', jobs=jobs, stdout=StringIO(), stderr=stderr or StringIO())
+            elapsed += time.monotonic() - start
+
+            metrics.merge(Metrics.from_json(RunSummary.objects.get(command='processincoming').metrics))
+
+    subprocesses = {}
+    for (name, labels), (_buckets, _total, count) in metrics.histograms.items():
+        if name == 'repomanager_subprocess_seconds':
+            tool = dict(labels)['tool']
+            subprocesses[tool] = subprocesses.get(tool, 0) + count
+    added = sum(value for (name, labels), value in metrics.counters.items()
+                if name == 'repomanager_uploads_total' and dict(labels)['outcome'] == 'added')
+
+    return {
+        'dists': dists,
+        'packages': packages,
+        'runs': runs,
+        'jobs': jobs,
+        'latency': latency,
+        'uploads': uploads,
+        'added': added,
+        'seconds': elapsed,
+        'uploads_per_second': uploads / elapsed if elapsed else 0.0,
+        'subprocesses': subprocesses,
+        'subprocesses_per_upload': sum(subprocesses.values()) / uploads if uploads else 0.0,
+        'queries': queries.count,
+        'queries_per_upload': queries.count / uploads if uploads else 0.0,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline and return a list of regressions.
+
+    Throughput may be `tolerance` percent lower than in the baseline, subprocesses and queries per upload
+    may be `tolerance` percent higher.
+    """
+
+    regressions = []
+    factor = tolerance / 100
+
+    minimum = baseline['uploads_per_second'] * (1 - factor)
+    if results['uploads_per_second'] < minimum:
+        regressions.append('uploads_per_second: %.1f < %.1f' % (results['uploads_per_second'], minimum))
+    for key in PER_UPLOAD_KEYS:
+        maximum = baseline[key] * (1 + factor)
+        if results[key] > maximum:
+            regressions.append('%s: %.2f > %.2f' % (key, results[key], maximum))
+    return regressions
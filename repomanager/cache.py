@@ -0,0 +1,46 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Server-side cache of API responses.
+
+Cache keys contain a version number that is increased whenever uploads are recorded, which invalidates
+all cached responses at once. Use a cache shared by all processes (e.g. memcached or the database cache)
+for processincoming to be able to invalidate the cache of the web server.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+
+VERSION_KEY = 'repomanager:api:version'
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def invalidate():
+    """Invalidate all cached API responses."""
+
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:  # the key does not exist (yet)
+        cache.set(VERSION_KEY, 1, None)
+
+
+def get_key(*parts):
+    """Get a cache key for the current version and the given parts, e.g. the URL of a request."""
+
+    digest = hashlib.sha256(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f'repomanager:api:{get_version()}:{digest}'
@@ -0,0 +1,112 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Verify the files referenced by a .changes file before they are added to the repository."""
+
+import hashlib
+import os
+import time
+from collections import namedtuple
+
+BUFSIZE = 1024 * 1024
+
+
+class VerifyResult(namedtuple('VerifyResult', ['missing', 'incomplete', 'mismatched', 'size', 'elapsed'])):
+    """Result of :py:func:`verify_changes`.
+
+    `missing`, `incomplete` (size differs) and `mismatched` (checksum differs) are lists of file names,
+    `size` is the number of bytes hashed and `elapsed` the wall-clock time in seconds.
+    """
+
+    @property
+    def complete(self):
+        """True if all files exist and have the expected size."""
+        return not self.missing and not self.incomplete
+
+    @property
+    def ok(self):
+        return self.complete and not self.mismatched
+
+
+def get_checksums(changes):
+    """Get a list of ``(name, size, algorithm, digest)`` tuples for all files in a .changes file.
+
+    SHA-256 checksums are used if available, MD5 checksums from the ``Files`` field otherwise. The size is
+    ``None`` if it is not a number.
+    """
+
+    if 'Checksums-Sha256' in changes:
+        return [(f['name'], _parse_size(f['size']), 'sha256', f['sha256'])
+                for f in changes['Checksums-Sha256']]
+    return [(f['name'], _parse_size(f['size']), 'md5', f['md5sum']) for f in changes['Files']]
+
+
+def _parse_size(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def hexdigest(path, algorithm):
+    """Hash a file, reading it in large chunks into a reused buffer."""
+
+    digest = hashlib.new(algorithm)
+    buf = bytearray(BUFSIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as stream:
+        while True:
+            count = stream.readinto(buf)
+            if not count:
+                break
+            digest.update(view[:count])  # hashlib releases the GIL for large buffers
+    return digest.hexdigest()
+
+
+def verify_changes(changesfile, changes, executor):
+    """Verify all files referenced by `changes`, hashing them in parallel using `executor`."""
+
+    start = time.monotonic()
+    basedir = os.path.dirname(changesfile)
+    missing = []
+    incomplete = []
+    mismatched = []
+    futures = []
+
+    for name, size, algorithm, expected in get_checksums(changes):
+        if size is None:  # an invalid .changes file can't match any file
+            mismatched.append(name)
+            continue
+
+        path = os.path.join(basedir, name)
+        try:
+            actual_size = os.stat(path).st_size
+        except FileNotFoundError:
+            missing.append(name)
+            continue
+
+        # A file with the wrong size is probably still being uploaded, no need to hash it
+        if actual_size != size:
+            incomplete.append(name)
+            continue
+
+        futures.append((name, size, expected, executor.submit(hexdigest, path, algorithm)))
+
+    hashed = 0
+    for name, size, expected, future in futures:
+        if future.result() != expected.lower():
+            mismatched.append(name)
+        hashed += size
+
+    return VerifyResult(missing=missing, incomplete=incomplete, mismatched=mismatched, size=hashed,
+                        elapsed=time.monotonic() - start)
@@ -15,3 +15,8 @@ VENDOR_DEBIAN = 0
 VENDOR_UBUNTU = 1
 VENDOR_FEDORA = 2
 VENDOR_REDHAT = 3
+
+JOB_PENDING = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_FAILED = 3
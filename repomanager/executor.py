@@ -0,0 +1,256 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run external commands concurrently on an asyncio event loop.
+
+The loop runs in a background thread, so that the (thread-based) rest of processincoming can submit
+commands from any thread and either wait for them or let them run in the background. The number of
+concurrent processes is limited per tool, and commands that must not run concurrently (e.g. reprepro on
+the same basedir) are serialized by passing the same `key`.
+
+Output is read while the command runs and only its tail is kept (see :py:class:`OutputTail`), so that
+commands with a lot of output (e.g. ``restorecon -Rv``) don't use a lot of memory.
+"""
+
+import asyncio
+import fcntl
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from contextlib import nullcontext
+from subprocess import PIPE
+
+CPU_COUNT = os.cpu_count() or 1
+
+# maximum number of concurrent processes per tool, other tools may run once per CPU
+DEFAULT_LIMITS = {
+    'reprepro': 1,
+    'createrepo_c': max(1, CPU_COUNT // 4),  # createrepo_c uses several threads itself
+    'restorecon': 1,
+}
+
+# interval for polling a lock file held by another process
+LOCK_POLL_INTERVAL = 0.1
+
+# bytes of stdout and stderr kept for every command, enough for a full batch of "rpm --checksig"
+OUTPUT_LIMIT = 256 * 1024
+
+# bytes read from a pipe at once, and maximum length of a line passed to a line callback
+READ_SIZE = 64 * 1024
+
+
+class Result(namedtuple('Result', ['args', 'returncode', 'stdout', 'stderr', 'duration', 'timed_out',
+                                   'truncated'])):
+    """Result of a command. `stdout` and `stderr` are bytes, `duration` is the wall-clock time in seconds.
+
+    If `truncated` is ``True``, `stdout` and/or `stderr` only contain the last bytes of the output.
+    """
+
+    @property
+    def tool(self):
+        return os.path.basename(self.args[0])
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class OutputTail:
+    """Ring buffer keeping the last `size` bytes of a stream.
+
+    If `on_line` is given, it is called with every line (bytes, without the newline) as soon as it is
+    complete. Lines longer than :py:data:`READ_SIZE` are split.
+    """
+
+    def __init__(self, size, on_line=None):
+        self.size = size
+        self.on_line = on_line
+        self.data = bytearray()
+        self.truncated = False
+        self.line = bytearray()
+
+    def feed(self, chunk):
+        self.data += chunk
+        if len(self.data) > self.size:
+            del self.data[:len(self.data) - self.size]
+            self.truncated = True
+
+        if self.on_line is not None:
+            self.line += chunk
+            *lines, rest = self.line.split(b'\n')
+            for line in lines:
+                self.on_line(bytes(line))
+            while len(rest) > READ_SIZE:
+                self.on_line(bytes(rest[:READ_SIZE]))
+                rest = rest[READ_SIZE:]
+            self.line = rest
+
+    def close(self):
+        if self.on_line is not None and self.line:
+            self.on_line(bytes(self.line))
+        self.line = bytearray()
+
+    def getvalue(self):
+        return bytes(self.data)
+
+
+def parse_limits(values):
+    """Parse a list of ``TOOL=N`` strings into a dict, raising ``ValueError`` for invalid ones."""
+
+    limits = {}
+    for value in values:
+        tool, _, limit = value.partition('=')
+        if not tool or not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f'Invalid limit "{value}", expected TOOL=N.')
+        limits[tool] = int(limit)
+    return limits
+
+
+class ToolExecutor:
+    """Executor for external commands, use it as a context manager.
+
+    `limits` override :py:data:`DEFAULT_LIMITS`, `timeout` is the default timeout in seconds. `observer`
+    is called with every :py:class:`Result` (in the thread of the event loop) before it is returned.
+    At most `output_limit` bytes of stdout and stderr are kept for every command.
+    """
+
+    def __init__(self, limits=None, timeout=None, observer=None, output_limit=OUTPUT_LIMIT):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.output_limit = output_limit
+        self.default_limit = CPU_COUNT
+        self.timeout = timeout
+        self.observer = observer
+        self.semaphores = {}  # maps tools to an asyncio.Semaphore, only used in the loop
+        self.locks = {}  # maps (tool, key) to an asyncio.Lock, only used in the loop
+        self.loop = None
+        self.thread = None
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='tool-executor', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Wait for all commands and stop the event loop.
+
+        Commands are not cancelled, as killing e.g. createrepo_c leaves temporary files behind that make
+        the next run fail. Cancel their futures to kill them.
+        """
+
+        async def wait():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(wait(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _get_semaphore(self, tool):
+        semaphore = self.semaphores.get(tool)
+        if semaphore is None:
+            semaphore = self.semaphores[tool] = asyncio.Semaphore(self.limits.get(tool, self.default_limit))
+        return semaphore
+
+    def _get_lock(self, tool, key):
+        if key is None:
+            return nullcontext()
+        lock = self.locks.get((tool, key))
+        if lock is None:
+            lock = self.locks[(tool, key)] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def _lock_file(self, path):
+        """Hold an exclusive lock on `path`, polling so that waiting can be cancelled."""
+
+        if path is None:
+            yield
+            return
+
+        with open(path, 'a') as stream:
+            while True:
+                try:
+                    fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    async def _read(stream, tail):
+        try:
+            while True:
+                chunk = await stream.read(READ_SIZE)
+                if not chunk:
+                    break
+                tail.feed(chunk)
+        finally:
+            tail.close()
+
+    async def _run(self, args, key, timeout, lockfile, on_line):
+        tool = os.path.basename(args[0])
+        stdout = OutputTail(self.output_limit, on_line and (lambda line: on_line('stdout', line)))
+        stderr = OutputTail(self.output_limit, on_line and (lambda line: on_line('stderr', line)))
+
+        # wait for the key (and the lock file) before taking one of the slots of the tool
+        async with self._get_lock(tool, key), self._lock_file(lockfile), self._get_semaphore(tool):
+            start = time.monotonic()
+            process = await asyncio.create_subprocess_exec(*args, stdout=PIPE, stderr=PIPE)
+            timed_out = False
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    self._read(process.stdout, stdout), self._read(process.stderr, stderr), process.wait(),
+                ), timeout)
+            except asyncio.TimeoutError:
+                # output read so far is kept
+                process.kill()
+                await process.wait()
+                timed_out = True
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+
+        result = Result(args, process.returncode, stdout.getvalue(), stderr.getvalue(),
+                        time.monotonic() - start, timed_out, stdout.truncated or stderr.truncated)
+        if self.observer is not None:
+            self.observer(result)
+        return result
+
+    def submit(self, args, key=None, timeout=None, lockfile=None, on_line=None):
+        """Start a command and return a :py:class:`concurrent.futures.Future` of its :py:class:`Result`.
+
+        If `lockfile` is given, an exclusive ``flock()`` is held on it while the command runs, so that it is
+        also serialized with commands of other processes. `on_line` is called (in the thread of the event
+        loop) with ``"stdout"`` or ``"stderr"`` and every line of output while the command runs. Cancelling
+        the future kills the process.
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        coro = self._run(list(args), key, timeout, lockfile, on_line)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, args, key=None, timeout=None, lockfile=None, on_line=None):
+        """Run a command and wait for its :py:class:`Result`."""
+        return self.submit(args, key, timeout, lockfile, on_line).result()
@@ -0,0 +1,184 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Job queue in the database, so that several workers (also on different hosts) can process uploads.
+
+``processincoming --enqueue`` creates a :py:class:`~repomanager.models.Job` for every dist directory with
+files in it, ``processincoming --worker`` claims and processes them. Work that affects the whole repository
+(exporting reprepro indices, regenerating RPM metadata, fixing SELinux contexts) is recorded in the job and
+done by whichever worker holds the ``publish`` :py:class:`~repomanager.models.Lease`.
+"""
+
+import os
+import socket
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from .constants import JOB_DONE
+from .constants import JOB_FAILED
+from .constants import JOB_PENDING
+from .constants import JOB_RUNNING
+from .constants import VENDOR_DEBIAN
+from .constants import VENDOR_UBUNTU
+from .models import Job
+from .models import Lease
+
+# done jobs are deleted after this time
+JOB_RETENTION = timedelta(days=7)
+
+# lock of all jobs that run reprepro
+REPREPRO_LOCK = 'reprepro'
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def get_job_lock(dist):
+    """Get the lock of jobs for `dist`, jobs with the same lock never run at the same time."""
+
+    if dist.vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]:
+        return REPREPRO_LOCK  # reprepro locks its database anyway
+    return f'rpm:{dist.vendor}'  # links of all_distributions packages go to all dists of a vendor
+
+
+def enqueue(directories):
+    """Create jobs for ``(path, lock)`` tuples that don't have a pending or running job yet.
+
+    Returns the number of created jobs.
+    """
+
+    open_paths = set(Job.objects.filter(status__in=[JOB_PENDING, JOB_RUNNING]).values_list('path', flat=True))
+    jobs = [Job(path=path, lock=lock) for path, lock in directories if path not in open_paths]
+    # another process might enqueue the same directory at the same time
+    Job.objects.bulk_create(jobs, ignore_conflicts=True)
+
+    expired = timezone.now() - JOB_RETENTION
+    Job.objects.filter(status=JOB_DONE, needs_publish=False, finished__lt=expired).delete()
+    return len(jobs)
+
+
+def claim_job(worker, timeout):
+    """Claim the oldest job that can run now, or return None if there is none.
+
+    Running jobs whose worker did not finish them within `timeout` seconds are claimed again.
+    """
+
+    now = timezone.now()
+    stale = now - timedelta(seconds=timeout)
+    held = Job.objects.filter(status=JOB_RUNNING, started__gte=stale).values('lock')
+    skipped = []
+
+    while True:
+        with transaction.atomic():
+            due = Q(next_attempt__isnull=True) | Q(next_attempt__lte=now)
+            job = (Job.objects.select_for_update(skip_locked=True)
+                   .filter(Q(due, status=JOB_PENDING) | Q(status=JOB_RUNNING, started__lt=stale))
+                   .exclude(lock__in=held).exclude(pk__in=skipped).order_by('created').first())
+            if job is None:
+                return None
+
+            # Databases without row locks (SQLite) ignore select_for_update(), so make sure that nobody else
+            # claimed the job in the meantime. The unique_running_lock constraint makes sure that no other
+            # job with the same lock was started since `held` was read.
+            try:
+                with transaction.atomic():
+                    claimed = Job.objects.filter(pk=job.pk, status=job.status, attempts=job.attempts).update(
+                        status=JOB_RUNNING, attempts=F('attempts') + 1, worker=worker, started=now,
+                        finished=None)
+            except IntegrityError:
+                skipped.append(job.pk)
+                continue
+        break
+    if not claimed:
+        return None
+
+    job.refresh_from_db()
+    return job
+
+
+def is_lock_busy(lock):
+    """Check if a pending or running job has the given lock."""
+
+    return Job.objects.filter(lock=lock, status__in=[JOB_PENDING, JOB_RUNNING]).exists()
+
+
+def finish_job(job, publication, error=None, max_attempts=3, backoff=60):
+    """Mark a claimed job as done, or as failed if `error` is given.
+
+    `publication` is a dict of lists of what has to be published, it is added to what the job recorded
+    before. Failed jobs are retried after `backoff` seconds, doubled with every attempt, until they were
+    attempted `max_attempts` times.
+    """
+
+    now = timezone.now()
+    publish = {key: sorted(set(job.publish.get(key, [])) | set(values))
+               for key, values in publication.items()}
+    values = {'finished': now, 'publish': publish, 'next_attempt': None}
+    if any(publish.values()):
+        values['needs_publish'] = True
+    if error is None:
+        values.update(status=JOB_DONE, last_error='')
+    elif job.attempts < max_attempts:
+        next_attempt = now + timedelta(seconds=backoff * 2 ** (job.attempts - 1))
+        values.update(status=JOB_PENDING, last_error=error, next_attempt=next_attempt)
+    else:
+        values.update(status=JOB_FAILED, last_error=error)
+
+    # the job might have been claimed by another worker if we took too long
+    return Job.objects.filter(pk=job.pk, worker=job.worker, status=JOB_RUNNING).update(**values) == 1
+
+
+def get_publication():
+    """Get all jobs that need to be published and the union of what they recorded."""
+
+    jobs = list(Job.objects.filter(needs_publish=True).exclude(status=JOB_RUNNING))
+    publication = {}
+    for job in jobs:
+        for key, values in job.publish.items():
+            publication.setdefault(key, set()).update(values)
+    return jobs, publication
+
+
+def mark_published(jobs, collected):
+    """Mark jobs as published, unless they were processed again after `collected`."""
+
+    qs = Job.objects.filter(pk__in=[j.pk for j in jobs], finished__lte=collected).exclude(status=JOB_RUNNING)
+    qs.update(needs_publish=False, publish={})
+
+
+def acquire_lease(name, holder, duration):
+    """Acquire or renew a lease for `duration` seconds. Returns False if somebody else holds it."""
+
+    now = timezone.now()
+    expires = now + timedelta(seconds=duration)
+    if Lease.objects.filter(name=name).filter(Q(holder=holder) | Q(expires__lt=now)).update(
+            holder=holder, expires=expires):
+        return True
+
+    try:
+        with transaction.atomic():
+            Lease.objects.create(name=name, holder=holder, expires=expires)
+    except IntegrityError:  # somebody else holds the lease
+        return False
+    return True
+
+
+def release_lease(name, holder):
+    Lease.objects.filter(name=name, holder=holder).update(expires=timezone.now())
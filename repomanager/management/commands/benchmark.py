@@ -0,0 +1,110 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from ...benchmark import LATENCY
+from ...benchmark import compare
+from ...benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of processincoming with generated uploads and fake external tools'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dists', type=int, default=2, metavar='N',
+                            help="Generate uploads for N Debian and N Fedora dists (default: %(default)s).")
+        parser.add_argument('--packages', type=int, default=50, metavar='M',
+                            help="Generate M packages per dist (default: %(default)s).")
+        parser.add_argument('--runs', type=int, default=3, metavar='N',
+                            help="Run processincoming N times (default: %(default)s).")
+        parser.add_argument('--size', type=int, default=64 * 1024, metavar='BYTES',
+                            help="Size of generated package files (default: %(default)s).")
+        parser.add_argument('--latency', action='append', default=[], metavar='TOOL=SECONDS',
+                            help="Latency of a fake tool, may be given multiple times (default: %s)."
+                                 % ', '.join(f'{k}={v}' for k, v in LATENCY.items()))
+        parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                            help="Passed to processincoming (default: %(default)s).")
+        parser.add_argument('--selinux', default=False, action='store_true',
+                            help="Run restorecon like with SELINUX = True.")
+        parser.add_argument('--workdir', metavar='PATH',
+                            help="Generate files in PATH and keep them (default: a temporary directory).")
+        parser.add_argument('--save-baseline', metavar='FILE', help="Write the results to FILE.")
+        parser.add_argument('--baseline', metavar='FILE',
+                            help="Compare the results with FILE and fail if they are worse.")
+        parser.add_argument('--tolerance', type=float, default=10, metavar='PERCENT',
+                            help="Allowed deviation from the baseline (default: %(default)s).")
+
+    def get_latency(self, values):
+        latency = dict(LATENCY)
+        for value in values:
+            tool, sep, seconds = value.partition('=')
+            if not sep or tool not in LATENCY:
+                raise CommandError(f'Invalid --latency: {value}')
+            latency[tool] = float(seconds)
+        return latency
+
+    def handle(self, *args, **options):
+        latency = self.get_latency(options['latency'])
+        workdir = options['workdir'] or tempfile.mkdtemp(prefix='repomanager-benchmark-')
+
+        # Never touch the real database, processincoming writes to it. SQLite test databases are in memory,
+        # where the threads of --jobs can't wait for each other's writes, so use a file instead.
+        test_settings = connection.settings_dict['TEST']
+        test_name = test_settings['NAME']
+        if connection.vendor == 'sqlite':
+            test_settings['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_benchmark(workdir, dists=options['dists'], packages=options['packages'],
+                                    runs=options['runs'], latency=latency, size=options['size'],
+                                    jobs=options['jobs'], selinux=options['selinux'], stderr=self.stderr)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = test_name
+            if not options['workdir']:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        self.stdout.write('%s uploads in %.2f seconds: %.1f uploads/s' % (
+            results['uploads'], results['seconds'], results['uploads_per_second']))
+        if results['added'] != results['uploads']:
+            self.stderr.write('Only %s of %s uploads were added.' % (results['added'], results['uploads']))
+        self.stdout.write('subprocesses: %s (%.2f per upload)' % (
+            ', '.join(f'{tool}={count}' for tool, count in sorted(results['subprocesses'].items())),
+            results['subprocesses_per_upload']))
+        self.stdout.write('database queries: %s (%.2f per upload)' % (
+            results['queries'], results['queries_per_upload']))
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as stream:
+                json.dump(results, stream, indent=4, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as stream:
+                baseline = json.load(stream)
+            for key in ['dists', 'packages', 'jobs', 'latency']:
+                if baseline.get(key) != results[key]:
+                    self.stderr.write(f'Warning: baseline was measured with {key} {baseline.get(key)}')
+
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Worse than baseline: %s' % '; '.join(regressions))
+            self.stdout.write('No regressions compared to %s.' % options['baseline'])
@@ -0,0 +1,49 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...pool import find_unreferenced
+
+
+class Command(BaseCommand):
+    help = ('Remove files from the RPM pool that are no longer linked from any component, e.g. after '
+            'processincoming --prerm. Run this periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only print the files that would be removed.')
+        parser.add_argument('--min-age', type=float, default=86400, metavar='SECONDS',
+                            help='Keep files added to the pool less than SECONDS ago (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        if settings.RPM_BASEDIR is None:
+            return
+
+        pooldir = os.path.join(settings.RPM_BASEDIR, 'pool')
+        size = 0
+        paths = find_unreferenced(pooldir, settings.RPM_BASEDIR, options['min_age'])
+        for path in paths:
+            if options['verbosity'] >= 2 or options['dry_run']:
+                self.stdout.write(path)
+            size += os.lstat(path).st_size
+            if not options['dry_run']:
+                os.remove(path)
+
+        if options['verbosity'] >= 1:
+            action = 'Would remove' if options['dry_run'] else 'Removed'
+            self.stdout.write(f'{action} {len(paths)} files ({size} bytes) from {pooldir}.')
@@ -12,22 +12,77 @@
 # not, see <http://www.gnu.org/licenses/>.
 
 import glob
+import hashlib
 import os
 import re
-from subprocess import PIPE
-from subprocess import Popen
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import connections
+from django.db.models import Count
+from django.db.models import Min
+from django.db.models import Q
 from django.utils import timezone
 
 from debian import deb822, debfile
 
+from ...checksums import verify_changes
+from ...executor import CPU_COUNT
+from ...executor import Result
+from ...executor import ToolExecutor
+from ...executor import parse_limits
+from ...inotify import IN_CLOSE_WRITE
+from ...inotify import IN_CREATE
+from ...inotify import IN_IGNORED
+from ...inotify import IN_ISDIR
+from ...inotify import IN_MODIFY
+from ...inotify import IN_MOVED_TO
+from ...inotify import IN_ONLYDIR
+from ...inotify import IN_Q_OVERFLOW
+from ...inotify import Inotify
+from ...jobs import REPREPRO_LOCK
+from ...jobs import acquire_lease
+from ...jobs import claim_job
+from ...jobs import enqueue
+from ...jobs import finish_job
+from ...jobs import get_job_lock
+from ...jobs import get_publication
+from ...jobs import get_worker_name
+from ...jobs import is_lock_busy
+from ...jobs import mark_published
+from ...jobs import release_lease
+from ...metrics import Metrics
+from ...metrics import save_run
 from ...models import BinaryPackage
 from ...models import Distribution
 from ...models import IncomingDirectory
-from ...models import Package
+from ...models import PendingUpload
 from ...models import SourcePackage
+from ...pending import PendingUploads
+from ...pending import get_fingerprint
+from ...pool import add_to_pool
+from ...pool import get_pool_path
+from ...pool import sha256sum
+from ...pool import symlink
+from ...pool import write_file
+from ...precheck import remove_state
+from ...precheck import save_state
+from ...precheck import scan
+from ...recorder import Catalog
+from ...recorder import UploadRecorder
+from ...rpm import is_valid_checksig
+from ...rpm import parse_checksig
+from ...rpm import read_rpm_header
 from ...constants import VENDOR_FEDORA, VENDOR_REDHAT, VENDOR_DEBIAN, VENDOR_UBUNTU
 
 # NOTE 2016-01-15: We add --ignore=surprisingbinary because of automatically generated
@@ -39,6 +94,18 @@ from ...constants import VENDOR_FEDORA, VENDOR_REDHAT, VENDOR_DEBIAN, VENDOR_UBU
 DEB_BASE_ARGS = ['reprepro', '-b', settings.DEB_BASEDIR, '--ignore=surprisingbinary',
                  '--ignore=wrongdistribution']
 
+# Commands that modify the repository don't export (and sign) the indices of a dist, this is done once for
+# every modified dist at the end of the run (see Command.export).
+DEB_NOEXPORT_ARGS = DEB_BASE_ARGS + ['--export=silent-never']
+
+# Maximum number of files passed to a single "rpm --checksig" or "restorecon" call
+CHECKSIG_BATCH = 256
+RESTORECON_BATCH = 256
+
+# inotify events watched with --watch
+WATCH_INCOMING_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+WATCH_DIST_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY | IN_ONLYDIR
+
 
 class Command(BaseCommand):
     help = 'Process incoming files'
@@ -54,57 +121,211 @@ class Command(BaseCommand):
         )
         parser.add_argument('--norm', default=False, action='store_true',
                             help="Don't remove files after adding them to the repository.")
+        parser.add_argument('--regenerate-all', default=False, action='store_true',
+                            help="Regenerate RPM metadata of all components, not only of changed ones.")
+        parser.add_argument('--watch', default=False, action='store_true',
+                            help="Keep running and process dist directories as soon as files arrive.")
+        parser.add_argument('--settle', type=float, default=5, metavar='SECONDS',
+                            help="With --watch, wait until no files were written to a dist directory "
+                                 "for SECONDS before processing it (default: %(default)s).")
+        parser.add_argument('--rescan', type=float, default=300, metavar='SECONDS',
+                            help="With --watch, do a full scan of all incoming directories every SECONDS "
+                                 "(default: %(default)s).")
+        parser.add_argument('--hash-workers', type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                            metavar='N', help="Verify checksums of up to N files in parallel "
+                                              "(default: %(default)s).")
+        parser.add_argument('--retry-backoff', type=float, default=60, metavar='SECONDS',
+                            help="Wait SECONDS before retrying a failed upload, doubled with every failed "
+                                 "attempt (default: %(default)s).")
+        parser.add_argument('--max-attempts', type=int, default=10, metavar='N',
+                            help="Quarantine uploads that failed N times (default: %(default)s).")
+        parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                            help="Process up to N dist directories in parallel (default: %(default)s).")
+        parser.add_argument('--enqueue', default=False, action='store_true',
+                            help="Only create a job for every dist directory with files in it, to be "
+                                 "processed by --worker.")
+        parser.add_argument('--worker', default=False, action='store_true',
+                            help="Process jobs created by --enqueue until there are none left. Several "
+                                 "workers may run on hosts sharing the repository and the database.")
+        parser.add_argument('--poll', type=float, metavar='SECONDS',
+                            help="With --worker, keep running and look for new jobs every SECONDS.")
+        parser.add_argument('--job-timeout', type=float, default=3600, metavar='SECONDS',
+                            help="With --worker, consider jobs running for more than SECONDS abandoned "
+                                 "and process them again (default: %(default)s).")
+        parser.add_argument('--job-attempts', type=int, default=3, metavar='N',
+                            help="With --worker, give up on jobs that failed N times (default: %(default)s).")
+        parser.add_argument('--job-backoff', type=float, default=60, metavar='SECONDS',
+                            help="With --worker, wait SECONDS before retrying a failed job, "
+                                 "doubled with every failed attempt (default: %(default)s).")
+        parser.add_argument('--lease', type=float, default=300, metavar='SECONDS',
+                            help="With --worker, the worker publishing the repository is elected for "
+                                 "SECONDS at a time (default: %(default)s).")
+        parser.add_argument('--tool-limit', action='append', default=[], metavar='TOOL=N',
+                            help="Run at most N processes of TOOL at the same time. By default, reprepro "
+                                 "and restorecon run one at a time, createrepo_c once per four CPUs and "
+                                 "other tools once per CPU. May be given several times.")
+        parser.add_argument('--tool-timeout', type=float, metavar='SECONDS',
+                            help="Kill external commands running for more than SECONDS.")
+        parser.add_argument('--createrepo-workers', type=int, metavar='N',
+                            help="Number of threads of every createrepo_c run (default: the number of CPUs "
+                                 "divided by the number of createrepo_c runs at the same time).")
+
+    def write(self, stream, msg):
+        # When running a directory in a worker thread, output is collected and written once the
+        # directory is done, so that output of different directories does not interleave.
+        output = getattr(self.local, 'output', None)
+        if output is None:
+            stream.write(msg)
+        else:
+            output.append((stream, msg))
+
+    def out(self, msg):
+        self.write(self.stdout, "%s\n" % msg)
 
     def err(self, msg):
-        self.stderr.write("%s\n" % msg)
+        self.write(self.stderr, "%s\n" % msg)
 
     def rm(self, path):
         """Remove a file. Honours --dry, --norm and --verbose."""
         if self.norm:
             return
         if self.verbose:
-            print(f"rm {path}")
+            self.out(f"rm {path}")
         if not self.dry:
             os.remove(path)
 
-    def ex(self, *args):
+    def makedirs(self, path):
+        """Create a directory and its parents if they don't exist. Honours --dry and --verbose.
+
+        Created directories are relabeled by :py:meth:`restorecon`.
+        """
+        created = []
+        head = os.path.abspath(path)
+        while not os.path.isdir(head):
+            created.append(head)
+            head = os.path.dirname(head)
+        if not created:
+            return
+
         if self.verbose:
-            print(' '.join(args))
+            self.out(f"mkdir -p {path}")
         if not self.dry:
-            process = Popen(args, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = process.communicate()
-            return process.returncode, stdout, stderr
-        return 0, '', ''
+            os.makedirs(path, exist_ok=True)
+        self.touched_paths.update(created)
+
+    def ex_async(self, *args, key=None, lockfile=None):
+        """Start an external command, returns a future of its :py:class:`~repomanager.executor.Result`.
+
+        Commands with the same `key` (and tool) never run at the same time, commands with the same `lockfile`
+        not even in different processes. Honours --dry and --verbose, with --verbose the output of the
+        command is printed while it runs.
+        """
+        if self.verbose:
+            self.out(' '.join(args))
+        if self.dry:
+            future = Future()
+            future.set_result(Result(args, 0, b'', b'', 0.0, False, False))
+            return future
+
+        on_line = None
+        if self.verbose:
+            # lines arrive on the executor thread, so pass on where the output of this thread is collected
+            on_line = partial(self.print_line, os.path.basename(args[0]), getattr(self.local, 'output', None))
+        return self.executor.submit(args, key=key, lockfile=lockfile, on_line=on_line)
+
+    def print_line(self, tool, output, stream, line):
+        """Print a line of output of a running command, or add it to `output` if that is not None."""
+        stream = self.stderr if stream == 'stderr' else self.stdout
+        msg = f"{tool}: {line.decode('utf-8', 'replace')}\n"
+        if output is None:
+            stream.write(msg)
+        else:
+            output.append((stream, msg))
+
+    def ex(self, *args, key=None):
+        """Run an external command and return its :py:class:`~repomanager.executor.Result`."""
+        return self.ex_async(*args, key=key).result()
+
+    def observe_result(self, result):
+        outcome = 'ok' if result.returncode == 0 else 'error'
+        if result.timed_out:
+            outcome = 'timeout'
+        self.metrics.observe('repomanager_subprocess_seconds', result.duration, tool=result.tool,
+                             outcome=outcome)
+
+    def report(self, result):
+        """Print the output of a failed command."""
+        if result.timed_out:
+            self.err('   ... TIMED OUT after %.1f seconds' % result.duration)
+        if result.truncated:
+            self.err('   ... OUTPUT TRUNCATED to the last %s bytes' % self.executor.output_limit)
+        self.err('   ... RETURN CODE: %s' % result.returncode)
+        self.err('   ... STDOUT: %s' % result.stdout.decode('utf-8', 'replace'))
+        self.err('   ... STDERR: %s' % result.stderr.decode('utf-8', 'replace'))
+
+    def reprepro(self, *args):
+        # reprepro locks its database, so commands on the same basedir are serialized
+        return self.ex(*args, key=settings.DEB_BASEDIR)
 
     def remove_src_package(self, pkg, dist):
         """Remove a source package from a distribution."""
 
-        cmd = DEB_BASE_ARGS + ['removesrc', dist.name, pkg]
-        return self.ex(*cmd)
+        self.mark_unexported(dist)
+        cmd = DEB_NOEXPORT_ARGS + ['removesrc', dist.name, pkg]
+        return self.reprepro(*cmd)
 
     def include(self, dist, component, changesfile):
         """Add a .changes file to the repository."""
 
-        cmd = DEB_BASE_ARGS + ['-C', component.name, 'include', dist.name, changesfile.path]
-        return self.ex(*cmd)
+        self.mark_unexported(dist)
+        cmd = DEB_NOEXPORT_ARGS + ['-C', component.name, 'include', dist.name, changesfile]
+        return self.reprepro(*cmd)
 
     def includedeb(self, dist, component, debpath):
-        cmd = DEB_BASE_ARGS + ['-C', component.name, 'includedeb', dist.name, debpath]
-        return self.ex(*cmd)
+        self.mark_unexported(dist)
+        cmd = DEB_NOEXPORT_ARGS + ['-C', component.name, 'includedeb', dist.name, debpath]
+        return self.reprepro(*cmd)
+
+    def touch_deb_pool(self, component, source):
+        """Remember the directory reprepro stores the files of a source package in for restorecon()."""
+
+        prefix = source[:4] if source.startswith('lib') else source[:1]
+        self.touched_trees.add(f"{settings.DEB_BASEDIR}/pool/{component.name}/{prefix}/{source}")
+
+    def mark_unexported(self, dist):
+        """Remember that the indices of `dist` have to be exported, in the database in case the run fails."""
+
+        if dist.name not in self.unexported:
+            self.unexported.add(dist.name)
+            if not self.dry:
+                Distribution.objects.filter(pk=dist.pk, needs_export=False).update(needs_export=True)
+
+    def export(self):
+        """Export the indices of all dists modified in this run (or in a run that failed)."""
+
+        if not self.unexported:
+            return
+
+        dists = sorted(self.unexported)
+        cmd = DEB_BASE_ARGS + ['export'] + dists
+        result = self.reprepro(*cmd)
+        self.touched_trees.update(f"{settings.DEB_BASEDIR}/dists/{dist}" for dist in dists)
+        if not result.ok:
+            self.err('%s: Could not export indices.' % ', '.join(dists))
+            self.report(result)
+            raise CommandError('reprepro export failed.')
+        if not self.dry:
+            Distribution.objects.filter(name__in=dists).update(needs_export=False)
+        self.unexported.clear()
+
+    @property
+    def recorder(self):
+        """The UploadRecorder for the dist directory that is currently processed."""
+        return self.local.recorder
 
     def record_source_upload(self, package, changes, dist, components):
         version = changes['Version'].rsplit('-', 1)[0]
-        pkg, created = SourcePackage.objects.get_or_create(package=package, dist=dist, defaults={
-            'version': version,
-        })
-        if not created:
-            pkg.version = version
-            pkg.components.clear()
-            pkg.timestamp = timezone.now()
-            pkg.save()
-
-        pkg.components.add(*components)
-        return pkg
+        return self.recorder.record_source(package, dist, version, components)
 
     def record_binary_upload(self, deb, package, dist, components):
         # parse name, version and arch from the filename
@@ -113,83 +334,126 @@ class Command(BaseCommand):
         version = match.group('version')
         arch = match.group('arch')
 
-        pkg, created = BinaryPackage.objects.get_or_create(
-            package=package, name=name, dist=dist, arch=arch, defaults={
-                'version': version,
-            })
-        if not created:
-            pkg.version = version
-            pkg.components.clear()
-            pkg.timestamp = timezone.now()
-            pkg.save()
-
-        pkg.components.add(*components)
-        return pkg
+        return self.recorder.record_binary(package, name, dist, arch, version, components)
+
+    def handle_changesfile(self, changesfile, dist, arch, pending):
+        pkg = None
+        try:
+            with open(changesfile) as f:
+                pkg = deb822.Changes(f)
+        except (OSError, ValueError) as e:
+            error = f'Cannot read .changes file: {e}'
+
+        # Uploads that failed before are only retried once their files stopped changing and the backoff
+        # has elapsed, so that stuck uploads don't cost a reprepro run every time.
+        fingerprint = get_fingerprint(changesfile, pkg)
+        reason = pending.check(changesfile, fingerprint)
+        if reason is not None:
+            if self.verbose:
+                self.out('%s: %s' % (changesfile, reason))
+            self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='deferred')
+            return
 
-    def handle_changesfile(self, changesfile, dist, arch):
-        with open(changesfile) as f:
-            pkg = deb822.Changes(f)
+        try:
+            if pkg is not None:
+                error = self.add_changesfile(changesfile, pkg, dist, arch)
+            else:
+                self.err(f'{changesfile}: {error}')
+        except RuntimeError as e:
+            self.err(e)
+            error = str(e)
+        except KeyError as e:
+            # malformed .changes files fail like any other upload, so they are retried and quarantined
+            error = f'Invalid .changes file: missing field {e}'
+            self.err(f'{changesfile}: {error}')
+        except ValueError as e:
+            error = f'Invalid .changes file: {e}'
+            self.err(f'{changesfile}: {error}')
+
+        if error is None:
+            pending.succeeded(changesfile)
+            self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='added')
+        else:
+            entry = pending.failed(changesfile, fingerprint, error)
+            outcome = 'failed'
+            if entry.quarantined:
+                self.err('%s: Quarantined after %s failed attempts' % (changesfile, entry.attempts))
+                outcome = 'quarantined'
+            self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome=outcome)
+
+    def add_changesfile(self, changesfile, pkg, dist, arch):
+        """Add the packages of a .changes file. Returns an error message if that was not possible."""
+
+        # Verify all files before doing anything else. If files are missing or have the wrong size, we
+        # might be in the middle of uploading a new package, so try again next time.
+        result = verify_changes(changesfile, pkg, self.hash_executor)
+        if self.verbose:
+            self.out('%s: verified %s bytes in %.3f seconds' % (changesfile, result.size, result.elapsed))
+        if result.missing:
+            self.err('%s: Not all files exist (missing %s)' % (changesfile, ', '.join(result.missing)))
+        if result.incomplete:
+            self.err('%s: Files are incomplete (%s)' % (changesfile, ', '.join(result.incomplete)))
+        if result.missing:
+            return 'Missing %s' % ', '.join(result.missing)
+        if result.incomplete:
+            return 'Incomplete %s' % ', '.join(result.incomplete)
+        if result.mismatched:
+            self.err('%s: Checksum mismatch for %s' % (changesfile, ', '.join(result.mismatched)))
+            return 'Checksum mismatch for %s' % ', '.join(result.mismatched)
 
         srcpkg = pkg['Source']
-        package = Package.objects.get_or_create(name=srcpkg)[0]
-        package.last_seen = timezone.now()
-        package.save()
+        binary_packages = [f['name'] for f in pkg['Files'] if f['name'].endswith('.deb')]
+        package = self.catalog.get_package(srcpkg)
+        self.recorder.touch(package)
 
         # get list of components
-        if package.all_components:
-            components = dist.components.filter(enabled=True)
-        else:
-            components = package.components.order_by('name').filter(distribution=dist)
-            components.update(last_seen=timezone.now())
+        components = self.catalog.get_components(package, dist)
+        if not package.all_components:
+            self.recorder.touch(*components)
         if self.verbose:
-            print('%s: %s' % (dist, ', '.join([c.name for c in components])))
-
-        # see if all files exist. If not, try a few more times, we might be in
-        # the middle of uploading a new package.
-        for file in pkg['Files']:
-            if not os.path.exists(os.path.join(os.path.dirname(changesfile), file['name'])):
-                self.err('%s: Not all files exist (missing %s)' % (changesfile, file['name']))
+            self.out('%s: %s' % (dist, ', '.join([c.name for c in components])))
 
         # remove package if requested
         if srcpkg in self.prerm or package.remove_on_update:
             self.remove_src_package(pkg=srcpkg, dist=dist)
 
-        totalcode = 0
+        failed = False
 
         for component in components:
             if arch == 'amd64':
-                code, stdout, stderr = self.include(dist, component, pkg)
-                totalcode += code
+                result = self.include(dist, component, changesfile)
+                failed = failed or not result.ok
 
-                if code == 0:
+                if result.ok:
+                    self.touch_deb_pool(component, srcpkg)
                     self.record_source_upload(package, pkg, dist, components)
-                    for deb in pkg.binary_packages:
+                    for deb in binary_packages:
                         self.record_binary_upload(deb, package, dist, components)
                 else:
-                    self.err('   ... RETURN CODE: %s' % code)
-                    self.err('   ... STDOUT: %s' % stdout.decode('utf-8'))
-                    self.err('   ... STDERR: %s' % stderr.decode('utf-8'))
+                    self.report(result)
             else:
-                debs = [f for f in pkg.binary_packages if f.endswith('_%s.deb' % arch)]
+                debs = [f for f in binary_packages if f.endswith('_%s.deb' % arch)]
                 for deb in debs:
-                    debpath = os.path.join(os.path.dirname(pkg.path), deb)
-                    code, stdout, stderr = self.includedeb(dist, component, debpath)
-                    totalcode += code
+                    debpath = os.path.join(os.path.dirname(changesfile), deb)
+                    result = self.includedeb(dist, component, debpath)
+                    failed = failed or not result.ok
 
-                    if code == 0:
+                    if result.ok:
+                        self.touch_deb_pool(component, srcpkg)
                         self.record_binary_upload(deb, package, dist, components)
                     else:
-                        self.err('   ... RETURN CODE: %s' % code)
-                        self.err('   ... STDOUT: %s' % stdout.decode('utf-8'))
-                        self.err('   ... STDERR: %s' % stderr.decode('utf-8'))
+                        self.report(result)
 
-        if totalcode == 0:
-            # remove changes files and the files referenced:
-            basedir = os.path.dirname(changesfile)
-            for file in pkg['Files']:
-                self.rm(os.path.join(basedir, file['name']))
+        if failed:
+            return 'reprepro failed'
+
+        # remove changes files and the files referenced:
+        basedir = os.path.dirname(changesfile)
+        for file in pkg['Files']:
+            self.rm(os.path.join(basedir, file['name']))
 
-            self.rm(changesfile)
+        self.rm(changesfile)
+        return None
 
     def handle_rpm_directory(self, path, dist):
         rpm_file_paths = []
@@ -199,70 +463,47 @@ class Command(BaseCommand):
             if os.path.isfile(subdirpath) and subdirpath.endswith(".rpm"):
                 rpm_file_paths.append(subdirpath)
 
+        dist = self.dists[dist]
+        self.local.signatures = self.check_signatures(rpm_file_paths)
+
         for filepath in rpm_file_paths:
             try:
-                # try to get package infos via rpm
-                pkgmatch = {
-                    'dist': dist,
-                    'arch': 'x86_64',
-                }
-
-                command = ["rpm", "-qpi", filepath]
-                code, out, err = self.ex(*command)
-                lines = out.decode('utf-8').split('\n')
-                for line in lines:
-                    if line.startswith('Description'):
-                        break
-                    line_re = re.match('^(?P<key>[a-zA-Z ]*[a-zA-Z])[ ]*: (?P<value>.*)$', line)
-                    if line_re is None:
-                        print("Can't parse line: {}".format(line))
-                        continue
-                    k = line_re.group('key').lower()
-                    v = line_re.group('value')
-                    if k in ['name', 'version', 'release']:
-                        pkgmatch[k] = v
-                    if k == 'architecture':
-                        pkgmatch['arch'] = v
-
-                dist = Distribution.objects.get(name=pkgmatch['dist'])
-
-                # find package name from file name
-                package = None
-                if pkgmatch['arch'] == "src":
-                    pkgs = SourcePackage.objects.filter(package__name=pkgmatch['name'])
-                    pkgs_dist = pkgs.filter(dist=dist)
-                    if len(pkgs_dist) > 0:
-                        package = pkgs_dist[0].package
-                    elif len(pkgs) > 0:
-                        package = pkgs[0].package
-                else:
-                    pkgs = BinaryPackage.objects.filter(name=pkgmatch['name'])
-                    pkgs_dist = pkgs.filter(dist=dist)
-                    pkgs_arch = pkgs_dist.filter(arch=pkgmatch['arch'])
-                    if len(pkgs_arch) > 0:
-                        package = pkgs_arch[0].package
-                    elif len(pkgs_dist) > 0:
-                        package = pkgs_dist[0].package
-                    elif len(pkgs) > 0:
-                        package = pkgs[0].package
+                header = read_rpm_header(filepath)
+
+                # find package name from file name. Source packages are looked up by the name of their
+                # package, so they always belong to the package with the same name.
+                package = self.find_rpm_package(header, dist)
+
+                # the file was added after the locks were chosen, and needs other ones
+                missing = self.get_rpm_locks(package, dist) - self.local.locks
+                if missing:
+                    self.err(f"{filepath}: Needs the locks {', '.join(sorted(missing))}, retrying later.")
+                    self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='deferred')
+                    continue
 
                 if package is None:
-                    package = Package.objects.get_or_create(name=pkgmatch['name'])[0]
+                    package = self.catalog.get_package(header.name)
 
-                package.last_seen = timezone.now()
-                package.save()
+                self.recorder.touch(package)
 
                 # remove package if requested
                 if package.name in self.prerm or package.remove_on_update:
-                    name = pkgmatch['name']
+                    # write pending records first, as they have to be removed as well
+                    self.recorder.flush()
+                    self.catalog.forget(package)
+
+                    name = header.name
+                    # Files stored before the content-addressed pool was introduced. Files in the pool are
+                    # kept, as they may be shared with other packages or dists (see the cleanpool command).
                     storagefiles = glob.glob(f"{settings.RPM_BASEDIR}/rpms/{name}-*-*.*.*.rpm")
                     for file in storagefiles:
                         self.rm(file)
                     for srcpkg in SourcePackage.objects.filter(package__name=package.name, dist__vendor__in=[VENDOR_FEDORA, VENDOR_REDHAT]):
                         for component in srcpkg.components.all():
-                            fn = f"{settings.RPM_BASEDIR}/{component.name}/{srcpkg.name}-{srcpkg.version}.{srcpkg.dist.name}.src.rpm"
+                            fn = f"{settings.RPM_BASEDIR}/{component.name}/{srcpkg.package.name}-{srcpkg.version}.{srcpkg.dist.name}.src.rpm"
                             if os.path.exists(fn) or os.path.islink(fn):
                                 self.rm(fn)
+                                self.changed_components.add(component.name)
                         if not self.dry:
                             srcpkg.delete()
                     for binpkg in BinaryPackage.objects.filter(package__name=package.name, dist__vendor__in=[VENDOR_FEDORA, VENDOR_REDHAT]):
@@ -270,107 +511,147 @@ class Command(BaseCommand):
                             fn = f"{settings.RPM_BASEDIR}/{component.name}/{binpkg.name}-{binpkg.version}.{binpkg.dist.name}.{binpkg.arch}.rpm"
                             if os.path.exists(fn) or os.path.islink(fn):
                                 self.rm(fn)
+                                self.changed_components.add(component.name)
                         if not self.dry:
                             binpkg.delete()
 
-                target = self.handle_rpm_file(filepath, package, dist, pkgmatch)
+                target = self.handle_rpm_file(filepath, package, dist, header)
                 if target is None:
                     self.err("Couldn't create link target rpm file.")
+                    self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='failed')
                     continue
 
                 dists = [dist]
                 if package.all_distributions:
-                    dists = Distribution.objects.filter(vendor=dist.vendor)
+                    dists = [d for d in self.dists.values() if d.vendor == dist.vendor]
 
                 for d in dists:
-                    d.last_seen = timezone.now()
-                    d.save()
-                    self.handle_rpm_distribution(filepath, package, d, pkgmatch, target)
+                    self.recorder.touch(d)
+                    self.handle_rpm_distribution(filepath, package, d, header, target)
+                self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='added')
 
             except RuntimeError as e:
                 self.err(e)
+                self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='failed')
 
-    def handle_rpm_file(self, rpmfile, package, dist, pkgmatch):
-        name = pkgmatch['name']
-        version = pkgmatch['version']
-        release = pkgmatch['release']
-        arch = pkgmatch['arch']
+    def check_signatures(self, paths):
+        """Check the signatures of RPM files, using one rpm process for up to CHECKSIG_BATCH files.
 
-        # check signature
-        command = ["rpm", "--quiet", "--checksig", rpmfile]
-        code, stdout, stderr = self.ex(*command)
+        Returns a dict mapping each path to ``None`` if its signature is valid, or to an error message.
+        """
 
-        if code != 0:
-            self.err('Signature for {} is invalid'.format(rpmfile))
-            return None
+        results = {}
+        for i in range(0, len(paths), CHECKSIG_BATCH):
+            batch = paths[i:i + CHECKSIG_BATCH]
+            result = self.ex("rpm", "--checksig", *batch)
+            if result.ok:  # all files are valid, also in dry runs
+                results.update(dict.fromkeys(batch))
+                continue
+
+            # rpm fails if any file is invalid, so look at the output to find out which
+            statuses = parse_checksig(batch, result.stdout.decode('utf-8', 'replace'))
+            for path in batch:
+                status = statuses.get(path)
+                if status is None:
+                    error = result.stderr.decode('utf-8', 'replace').strip()
+                    results[path] = error or 'not checked by rpm'
+                elif is_valid_checksig(status):
+                    results[path] = None
+                else:
+                    results[path] = status
+        return results
+
+    def handle_rpm_file(self, rpmfile, package, dist, header):
+        name, version, release, arch = header
 
-        # copy to proper location
-        target = f"{name}-{version}-{release}.{dist.name}.{arch}.rpm"
-        command = ["cp", "-a", rpmfile, f"{settings.RPM_BASEDIR}/rpms/{target}"]
-        code, stdout, stderr = self.ex(*command)
-        if code != 0:
-            self.err(f"Couldn't copy file {rpmfile} to {settings.RPM_BASEDIR}/rpms/.")
-            self.err(f"command: {command}")
-            self.err(f"target: {target}")
+        # signatures are checked for all files of a directory beforehand, see check_signatures()
+        error = self.local.signatures.get(rpmfile, 'not checked')
+        if error is not None:
+            self.err('Signature for {} is invalid ({})'.format(rpmfile, error))
             return None
 
+        # add to the content-addressed pool
+        pooldir = f"{settings.RPM_BASEDIR}/pool"
+        if self.dry:
+            target = get_pool_path(pooldir, sha256sum(rpmfile), '.rpm')
+        else:
+            try:
+                # the file may be hardlinked into the pool only if it is removed below
+                target, method = add_to_pool(pooldir, rpmfile, link=not self.norm)
+            except OSError as e:
+                self.err(f"Couldn't add file {rpmfile} to {pooldir}: {e}")
+                return None
+            if self.verbose:
+                self.out(f"{rpmfile} -> {target} ({method})")
+            if method != 'exists':
+                self.touched_paths.update([os.path.dirname(target), target])
+
         # remove rpm file:
         self.rm(rpmfile)
 
         return target
 
-    def handle_rpm_distribution(self, rpmfile, package, dist, pkgmatch, target):
-        name = pkgmatch['name']
-        version = pkgmatch['version']
-        release = pkgmatch['release']
-        arch = pkgmatch['arch']
+    def handle_rpm_distribution(self, rpmfile, package, dist, header, target):
+        name, version, release, arch = header
 
         # get list of components
-        if arch == "noarch":
-            components = dist.components.filter(enabled=True)
-        else:
-            components = dist.components.filter(enabled=True, name__endswith=f"-{arch}")
+        components = [c for c in dist.components.all() if c.enabled]
+        if arch != "noarch":
+            components = [c for c in components if c.name.endswith(f"-{arch}")]
         if not package.all_components:
-            specific_components = package.components.order_by('name')
+            specific_components = list(package.components.all())
             if len(specific_components) > 0:
-                specific_components.update(last_seen=timezone.now())
+                self.recorder.touch(*specific_components)
                 components = specific_components
         if self.verbose:
-            print('%s: %s' % (dist, ', '.join([c.name for c in components])))
+            self.out('%s: %s' % (dist, ', '.join([c.name for c in components])))
 
+        # RPM uploads keep a row for every version
         if arch == "src":
-            pkg, created = SourcePackage.objects.get_or_create(package=package, dist=dist, version=f"{version}-{release}")
+            self.recorder.record_source(package, dist, f"{version}-{release}", components, by_version=True)
         else:
-            pkg, created = BinaryPackage.objects.get_or_create(package=package, name=name, dist=dist, arch=arch, version=f"{version}-{release}")
-        if not created:
-            pkg.components.clear()
-            pkg.timestamp = timezone.now()
-            pkg.save()
-
-        pkg.components.add(*components)
+            self.recorder.record_binary(package, name, dist, arch, f"{version}-{release}", components,
+                                        by_version=True)
 
         for component in components:
             if self.verbose:
-                print(target)
+                self.out(target)
             linkpath = f"{settings.RPM_BASEDIR}/{component.name}/{name}-{version}-{release}.{dist.name}.{arch}.rpm"
             if self.verbose:
-                print(linkpath)
-            os.symlink(f"{settings.RPM_BASEDIR}/rpms/{target}", linkpath)
+                self.out(linkpath)
+            if not self.dry:
+                symlink(target, linkpath)
+            self.changed_components.add(component.name)
+            self.touched_paths.add(linkpath)
+
+    def needs_regeneration(self, component):
+        """Check if the RPM metadata of a component has to be regenerated."""
+
+        if self.regenerate_all or component.name in self.changed_components:
+            return True
+
+        # also generate metadata for components that never had any (e.g. newly added components)
+        return not os.path.exists(f"{settings.RPM_BASEDIR}/{component.name}/repodata/repomd.xml")
 
     def handle_deb_directory(self, path, dist):
         dist, arch = os.path.basename(path).split('-', 1)
-        dist = Distribution.objects.get(name=dist)
+        dist = self.dists[dist]
 
         seen_packages = []
+        changesfiles = set()
+        pending = PendingUploads(path, self.max_attempts, self.retry_backoff, settle=self.settle,
+                                 dry=self.dry)
 
         for f in [f for f in os.listdir(path) if f.endswith('.changes')]:
             pkgname, _, _ = f.rpartition('_')
             seen_packages.append(pkgname)
-            dist.last_seen = timezone.now()
+            changesfiles.add(os.path.join(path, f))
+            self.recorder.touch(dist)
             try:
-                self.handle_changesfile(os.path.join(path, f), dist, arch)
+                self.handle_changesfile(os.path.join(path, f), dist, arch, pending)
             except RuntimeError as e:
                 self.err(e)
+        pending.cleanup(changesfiles)
 
         # check for leftover deb files without metadata files
         for filename in [f for f in os.listdir(path) if f.endswith('.deb')]:
@@ -380,82 +661,206 @@ class Command(BaseCommand):
             if pkgname in seen_packages:
                 continue
 
-            dist.last_seen = timezone.now()
+            self.recorder.touch(dist)
             try:
                 df = debfile.DebFile(filepath)
                 ctrl = df.debcontrol()
-                package = Package.objects.get_or_create(name=ctrl['Package'])[0]
-                package.last_seen = timezone.now()
-                package.save()
+                package = self.catalog.get_package(ctrl['Package'])
+                self.recorder.touch(package)
 
                 # get list of components
-                if package.all_components:
-                    components = dist.components.filter(enabled=True)
-                else:
-                    components = package.components.order_by('name').filter(distribution=dist)
-                    components.update(last_seen=timezone.now())
+                components = self.catalog.get_components(package, dist)
+                if not package.all_components:
+                    self.recorder.touch(*components)
 
+                # the Source field may contain the source version in parentheses
+                source = ctrl.get('Source', ctrl['Package']).split()[0]
+                included = failed = False
                 for component in components:
-                    self.includedeb(dist, component, filepath)
-
-                self.record_binary_upload(filename, package, dist, components)
+                    result = self.includedeb(dist, component, filepath)
+                    if result.ok:
+                        self.touch_deb_pool(component, source)
+                        included = True
+                    else:
+                        self.report(result)
+                        failed = True
+
+                if included:
+                    self.record_binary_upload(filename, package, dist, components)
+                if failed:
+                    raise RuntimeError(f'{filepath}: reprepro failed')
+                self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='added')
             except RuntimeError as e:
                 self.err(e)
+                self.metrics.inc('repomanager_uploads_total', dist=dist.name, outcome='failed')
+
+    def get_locks(self, dist, path):
+        """Get the names of the locks to hold while processing the incoming directory `path` for `dist`."""
+
+        if dist.vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]:
+            # reprepro locks its database anyway, so all Debian-like dists share one lock
+            keys = {f'reprepro:{settings.DEB_BASEDIR}'}
+        else:
+            # Only lock the components that the files in the directory are linked into. Files that are added
+            # later and need other locks are skipped, see handle_rpm_directory().
+            keys = {f'rpm:{component.name}' for component in dist.components.all()}
+            for name in os.listdir(path):
+                if not name.endswith('.rpm'):
+                    continue
+                try:
+                    header = read_rpm_header(os.path.join(path, name))
+                except (OSError, RuntimeError):
+                    continue  # reported when the directory is processed
+                keys.update(self.get_rpm_locks(self.find_rpm_package(header, dist), dist))
+
+        # always acquire locks in the same order to avoid deadlocks
+        return sorted(keys)
+
+    def find_rpm_package(self, header, dist):
+        """Get the package of an RPM file, or None if it doesn't exist yet."""
+
+        package = None
+        if header.arch != "src":
+            package = self.catalog.resolve_binary_package(header.name, dist, header.arch)
+        if package is None:
+            package = self.catalog.packages.get(header.name)
+        return package
+
+    def get_rpm_locks(self, package, dist):
+        """Get the names of the locks needed to add a package (`None` for a new one) to an RPM dist."""
+
+        dists = [dist]
+        components = set()
+        if package is not None:
+            # Packages with all_distributions set are linked into all dists of the same vendor, and removing
+            # a package removes its links from all of them.
+            if package.all_distributions or package.name in self.prerm or package.remove_on_update:
+                dists = [d for d in self.dists.values() if d.vendor == dist.vendor]
+            components.update(c.name for c in package.components.all())
+        for d in dists:
+            components.update(c.name for c in d.components.all())
+        return {f'rpm:{name}' for name in components}
+
+    def handle_directory(self, handler, path, dist, locks):
+        """Process a single dist directory while holding the locks named `locks`."""
+
+        self.local.recorder = UploadRecorder(self.catalog)
+        self.local.locks = set(locks)
+        with ExitStack() as stack:
+            for key in locks:
+                stack.enter_context(self.locks[key])
+
+            # `dist` is the directory name for Debian-like dists, uploads are counted by dist name instead
+            directory = os.path.basename(path)
+            start = time.monotonic()
+            outcome = 'error'
+            stack.enter_context(connection.execute_wrapper(self.metrics.count_queries(directory=directory)))
+            try:
+                handler(path, dist)
+                outcome = 'ok'
+            finally:
+                # one transaction for all database writes of this directory
+                self.local.recorder.flush()
+                self.metrics.observe('repomanager_directory_seconds', time.monotonic() - start,
+                                     directory=directory, outcome=outcome)
+
+        if self.regenerate_early and handler == self.handle_rpm_directory:
+            self.regenerate_changed()
+
+    def handle_directory_job(self, handler, path, dist, locks):
+        """Process a single dist directory in a worker thread, collecting its output."""
+
+        self.local.output = []
+        try:
+            self.handle_directory(handler, path, dist, locks)
+        except Exception as e:
+            self.err(f"{path}: {e}")
+            return self.local.output, False
+        finally:
+            # Django opens a database connection per thread, don't leak them
+            connections.close_all()
+        return self.local.output, True
+
+    def get_directory(self, path):
+        """Get the ``(handler, path, dist, locks)`` tuple for a dist directory.
+
+        Returns None if `path` isn't a dist directory.
+        """
+
+        dirname = os.path.basename(path)
+        dist = dirname
+        if '-' in dirname:
+            dist, _, _ = dirname.rpartition('-')
+
+        # check if it is a valid distribution
+        if not os.path.isdir(path) or dist not in self.dists:
+            return None
 
-        dist.save()
+        vendor = self.dists[dist].vendor
+        locks = self.get_locks(self.dists[dist], path)
+        if vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]:
+            return self.handle_deb_directory, path, dirname, locks
+        elif vendor in [VENDOR_FEDORA,VENDOR_REDHAT]:
+            return self.handle_rpm_directory, path, dist, locks
+        else:
+            self.err(f"Unknown distro path: {path}")
 
     def handle_incoming(self, incoming):
+        """Get a list of dist directories in an incoming directory.
+
+        Returns a list of ``(handler, path, dist, locks)`` tuples.
+        """
         # A few safety checks:
         if not os.path.exists(incoming.location):
             self.err("%s: No such directory." % incoming.location)
-            return
+            return []
         if not os.path.isdir(incoming.location):
             self.err("%s: Not a directory." % incoming.location)
-            return
+            return []
 
         location = os.path.abspath(incoming.location)
+        directories = []
 
-        dists = Distribution.objects.all()
-        dist_names = {}
+        for dirname in sorted(os.listdir(location)):
+            directory = self.get_directory(os.path.join(location, dirname))
+            if directory is not None:
+                directories.append(directory)
 
-        for dist in dists:
-            dist_names[dist.name] = dist
+        return directories
 
-        for dirname in sorted(os.listdir(location)):
-            path = os.path.join(location, dirname)
-            dist = dirname
-            if '-' in dirname:
-                dist, _, _ = dirname.rpartition('-')
-
-            # check if it is a valid distribution
-            if os.path.isdir(path) and dist in dist_names:
-                vendor = dist_names[dist].vendor
-                if vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]:
-                    self.handle_deb_directory(path, dirname)
-                elif vendor in [VENDOR_FEDORA,VENDOR_REDHAT]:
-                    self.handle_rpm_directory(path, dist)
-                else:
-                    self.err(f"Unknown distro path: {path}")
+    def handle_directories(self, directories):
+        """Process all dist directories, using a thread pool if --jobs is greater than one."""
 
-    def handle(self, *args, **options):
-        self.verbose = options['verbosity'] >= 2
-        self.dry = options['dry_run']
-        self.norm = options['norm']
-        self.prerm = options['prerm'].split(',')
-        self.src_handled = {}
+        if self.jobs <= 1:
+            for directory in directories:
+                self.handle_directory(*directory)
+            return
 
-        if settings.DEB_BASEDIR is not None:
-            # ensure deb directories exist
-            command = ["mkdir", "-p", f"{settings.DEB_BASEDIR}", f"{settings.DEB_BASEDIR}/conf"]
-            self.ex(*command)
-
-            with open(f"{settings.DEB_BASEDIR}/conf/distributions", 'w+') as d:
-                for distribution in Distribution.objects.filter(vendor__in=[VENDOR_DEBIAN,VENDOR_UBUNTU]):
-                    component_list = []
-                    for component in distribution.components.all():
-                        component_list.append(component.name)
-                    comps = " ".join(component_list)
-                    d.write(f"""Origin: ionic
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [(directory[1], executor.submit(self.handle_directory_job, *directory))
+                       for directory in directories]
+
+            # print output in the order of directories, not in the order they finish
+            for path, future in futures:
+                output, success = future.result()
+                for stream, msg in output:
+                    stream.write(msg)
+                if not success:
+                    failed.append(path)
+
+        if failed:
+            raise CommandError('Processing failed for: %s' % ', '.join(failed))
+
+    def get_distributions_conf(self):
+        """Get the content of the reprepro ``conf/distributions`` file."""
+
+        dists = sorted((d for d in self.dists.values() if d.vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]),
+                       key=lambda d: d.pk)
+        conf = []
+        for distribution in dists:
+            comps = " ".join(c.name for c in sorted(distribution.components.all(), key=lambda c: c.pk))
+            conf.append(f"""Origin: ionic
 Label: ionic repositories
 Codename: {distribution.name}
 Version: 3.0
@@ -466,42 +871,464 @@ Description: ionic custom packages
 SignWith: yes
 
 """)
+        return ''.join(conf)
+
+    def prepare(self):
+        """Write the reprepro configuration and make sure that all repository directories exist."""
+
+        # NOTE: prepare() is called again on every rescan in --watch mode, so the cache doesn't get stale
+        self.catalog = Catalog()
+        self.dists = self.catalog.dists
+
+        if settings.DEB_BASEDIR is not None:
+            # dists whose indices were not exported because an earlier run failed
+            self.unexported.update(d.name for d in self.dists.values()
+                                   if d.needs_export and d.vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU])
+
+            # ensure deb directories exist
+            self.makedirs(f"{settings.DEB_BASEDIR}/conf")
+
+            # Only write the configuration if it changed, reprepro re-examines its state otherwise
+            path = f"{settings.DEB_BASEDIR}/conf/distributions"
+            conf = self.get_distributions_conf().encode('utf-8')
+            try:
+                with open(path, 'rb') as stream:
+                    unchanged = hashlib.sha256(stream.read()).digest() == hashlib.sha256(conf).digest()
+            except FileNotFoundError:
+                unchanged = False
+
+            if not unchanged:
+                if self.verbose:
+                    self.out(f"Updating {path}")
+                if not self.dry:
+                    write_file(path, conf)
+                self.touched_paths.add(path)
 
         if settings.RPM_BASEDIR is not None:
             # ensure rpm directories exist
+            for dist in self.dists.values():
+                if dist.vendor in [VENDOR_FEDORA, VENDOR_REDHAT]:
+                    for component in dist.components.all():
+                        self.makedirs(f"{settings.RPM_BASEDIR}/{component.name}")
+                        self.makedirs(f"{settings.RPM_CACHEDIR}/{component.name}")
+            self.makedirs(f"{settings.RPM_BASEDIR}/pool")
+
+    def process(self, directories):
+        """Process the given dist directories and export the changed reprepro indices.
+
+        RPM metadata of changed components is regenerated in the background whenever an RPM directory is
+        done, see :py:meth:`publish`.
+        """
+
+        self.regenerate_early = settings.RPM_BASEDIR is not None
+        try:
+            self.handle_directories(directories)
+        finally:
+            self.regenerate_early = False
+            # Export even if processing failed, so that the indices match what reprepro has already
+            # added to its database.
+            if settings.DEB_BASEDIR is not None:
+                self.export()
+
+    def regenerate(self, name):
+        """Start regenerating the RPM metadata of a component, returns a future of the result.
+
+        Components are regenerated in parallel (see --tool-limit), each with its own cache directory. The
+        lock file also keeps other processincoming processes from regenerating the component at the same
+        time.
+        """
+
+        cachedir = f"{settings.RPM_CACHEDIR}/{name}"
+        command = ["createrepo_c", "-d", "--basedir", f"{settings.RPM_BASEDIR}/{name}", "--update",
+                   "--cachedir", cachedir, "--workers", str(self.createrepo_workers), "."]
+        self.touched_trees.add(f"{settings.RPM_BASEDIR}/{name}/repodata")
+        return self.ex_async(*command, key=name, lockfile=f"{cachedir}.lock")
+
+    def regenerate_changed(self):
+        """Start regenerating the components changed so far, while other directories are still processed."""
+
+        # Components are added to changed_components after their files were changed, so files changed
+        # by other threads in the meantime are either seen by createrepo_c or regenerated again later.
+        names = set(self.changed_components)
+        self.changed_components.difference_update(names)
+        for name in sorted(names):
+            self.regenerations.append((name, self.regenerate(name)))
+
+    def wait_regenerations(self, regenerations):
+        """Wait for createrepo_c runs, returns the names of the regenerated components."""
+
+        names = set()
+        for name, future in regenerations:
+            result = future.result()
+            if not result.ok:
+                self.err(f'{name}: Could not regenerate RPM metadata.')
+                self.report(result)
+            elif self.verbose:
+                self.out(f'{name}: regenerated RPM metadata in {result.duration:.3f} seconds')
+            if not self.dry:
+                self.metrics.observe('repomanager_regeneration_seconds', result.duration, component=name)
+            names.add(name)
+        return names
+
+    def publish(self):
+        """Regenerate RPM metadata and fix SELinux contexts after processing directories."""
+
+        if settings.RPM_BASEDIR is not None:
+            # components regenerated while processing directories only need it again if they changed since
+            regenerations, self.regenerations = self.regenerations, []
+            regenerated = self.wait_regenerations(regenerations)
+
+            # regenerate / update changed components
+            names = []
             for dist in Distribution.objects.filter(vendor__in=[VENDOR_FEDORA,VENDOR_REDHAT]):
                 for component in dist.components.all():
-                    command = ["mkdir", "-p", f"{settings.RPM_BASEDIR}/{component.name}"]
-                    self.ex(*command)
-            command = ["mkdir", "-p", f"{settings.RPM_BASEDIR}/rpms"]
-            self.ex(*command)
+                    if component.name in names or not self.needs_regeneration(component):
+                        continue
+                    if component.name in regenerated and component.name not in self.changed_components:
+                        continue
+                    names.append(component.name)
+
+            self.changed_components.clear()
+            self.wait_regenerations([(name, self.regenerate(name)) for name in names])
+
+        if settings.SELINUX:
+            self.restorecon()
+
+    def restorecon(self):
+        """Fix SELinux contexts of all paths created or modified since the last call.
+
+        Only these paths are relabeled, use the relabel command to relabel the whole repository.
+        """
+
+        touched = [(["restorecon", "-v"], self.touched_paths), (["restorecon", "-Rv"], self.touched_trees)]
+        for command, paths in touched:
+            # paths may have been removed again, e.g. by --prerm (and they never exist in dry runs)
+            paths = sorted(p for p in paths if self.dry or os.path.lexists(p))
+            for i in range(0, len(paths), RESTORECON_BATCH):
+                result = self.ex(*command, *paths[i:i + RESTORECON_BATCH])
+                if not result.ok:
+                    # the output of restorecon -v lists every relabeled file, so only stderr is printed
+                    self.err('Could not fix SELinux contexts.')
+                    self.err('   ... RETURN CODE: %s' % result.returncode)
+                    self.err('   ... STDERR: %s' % result.stderr.decode('utf-8', 'replace'))
+
+        self.touched_paths.clear()
+        self.touched_trees.clear()
+
+    def get_directories(self):
+        """Get all dist directories in all enabled incoming directories."""
+
+        directories = []
+        for directory in IncomingDirectory.objects.filter(enabled=True).order_by('location'):
+            directories += self.handle_incoming(directory)
+        return directories
+
+    def add_watches(self, inotify):
+        """Watch all enabled incoming directories and their dist directories."""
+
+        for incoming in IncomingDirectory.objects.filter(enabled=True).order_by('location'):
+            location = os.path.abspath(incoming.location)
+            if not os.path.isdir(location):
+                self.err("%s: Not a directory." % location)
+                continue
+            self.locations.add(location)
+
+            for path in [location] + [os.path.join(location, d) for d in sorted(os.listdir(location))]:
+                if os.path.isdir(path) and not inotify.is_watched(path):
+                    # The incoming directory is only watched for new dist directories
+                    inotify.add_watch(path, WATCH_INCOMING_MASK if path == location else WATCH_DIST_MASK)
+
+    def process_watched(self, directories):
+        """Process directories in --watch mode, where errors must not stop the daemon."""
+
+        started = timezone.now()
+        start = time.monotonic()
+        success = False
+        try:
+            with self.metrics.timer('repomanager_stage_seconds', stage='process'):
+                self.process(directories)
+            with self.metrics.timer('repomanager_stage_seconds', stage='publish'):
+                self.publish()
+            success = True
+        except CommandError as e:
+            self.err(e)
+        except Exception:
+            self.err(f'Processing failed:\n{traceback.format_exc()}')
+        finally:
+            self.save_metrics(started, time.monotonic() - start, success)
+
+    def get_due_directories(self):
+        """Get the dist directories with failed uploads that are due for a retry."""
+
+        due = Q(next_attempt__isnull=True) | Q(next_attempt__lte=timezone.now())
+        qs = PendingUpload.objects.filter(due, quarantined=False)
+        return sorted(set(qs.values_list('directory', flat=True)))
+
+    def get_retry_at(self):
+        """Get the time of the next retry of a failed upload as timestamp, or None if there is none."""
+
+        qs = PendingUpload.objects.filter(quarantined=False)
+        retry = qs.aggregate(retry_at=Min('next_attempt'),
+                             due=Count('pk', filter=Q(next_attempt__isnull=True)))
+        if retry['due']:
+            return time.time()  # uploads without a next attempt are retried right away
+        return None if retry['retry_at'] is None else retry['retry_at'].timestamp()
+
+    def save_metrics(self, started, duration, success):
+        """Store the metrics collected since the last call, unless this is a dry run."""
+
+        metrics, self.metrics = self.metrics, Metrics()
+        if not self.dry:
+            save_run('processincoming', metrics, started, duration, success)
+
+    def watch(self):
+        """Process dist directories whenever files are written to them."""
+
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            raise CommandError(f'--watch requires inotify: {e}')
+
+        self.locations = set()
+        with inotify:
+            last_scan = None
+            retry_at = None
+            pending = {}  # maps dist directories to the time of the last event in them
+
+            while True:
+                now = time.monotonic()
+
+                # failed uploads are retried once their backoff elapsed, not only on the next rescan
+                if retry_at is not None and time.time() >= retry_at:
+                    for path in self.get_due_directories():
+                        pending.setdefault(path, now - self.settle)
+                    retry_at = None
+
+                # Periodically (and on start) do a full scan to catch up with events we might have missed
+                if last_scan is None or now - last_scan >= self.rescan:
+                    with self.metrics.timer('repomanager_stage_seconds', stage='prepare'):
+                        self.prepare()
+                    self.add_watches(inotify)
+                    self.process_watched(self.get_directories())
+                    retry_at = self.get_retry_at()
+                    last_scan = now
+                    pending.clear()
+
+                # only process a directory once writing to it has settled
+                settled = sorted(p for p, t in pending.items() if now - t >= self.settle)
+                if settled:
+                    directories = [self.get_directory(path) for path in settled]
+                    for path in settled:
+                        del pending[path]
+                    self.process_watched([d for d in directories if d is not None])
+                    retry_at = self.get_retry_at()
+
+                timeout = self.settle if pending else self.rescan - (now - last_scan)
+                if retry_at is not None:
+                    # retry at most every --settle seconds, in case the due uploads can't be processed
+                    timeout = min(timeout, max(retry_at - time.time(), self.settle))
+                for path, name, mask in inotify.read(timeout=max(timeout, 0)):
+                    if mask & IN_Q_OVERFLOW:
+                        last_scan = None  # we lost events, so rescan everything
+                    elif path is None or mask & IN_IGNORED:
+                        continue
+                    elif mask & IN_ISDIR:
+                        if path not in self.locations:
+                            continue
+
+                        # new dist directory in an incoming directory
+                        subdir = os.path.join(path, name)
+                        inotify.add_watch(subdir, WATCH_DIST_MASK)
+                        pending[subdir] = time.monotonic()
+                    elif name:
+                        pending[path] = time.monotonic()
+
+    def enqueue(self):
+        """Create a job for every dist directory with files in it."""
+
+        directories = []
+        for handler, path, dist, locks in self.get_directories():
+            with os.scandir(path) as entries:
+                if not any(entries):
+                    continue
+            dist = self.dists[dist.rpartition('-')[0] if handler == self.handle_deb_directory else dist]
+            directories.append((path, get_job_lock(dist)))
 
-        directories = IncomingDirectory.objects.filter(enabled=True)
+        count = enqueue(directories)
+        if self.verbose:
+            self.out(f'Enqueued {count} of {len(directories)} directories.')
 
-        for directory in directories.order_by('location'):
-            self.handle_incoming(directory)
+    def take_publication(self):
+        """Get and reset what has to be exported, regenerated and relabeled after processing a job."""
 
-        if settings.RPM_BASEDIR is not None:
-            # regenerate / update all components
-            components_to_regenerate = []
-            for dist in Distribution.objects.filter(vendor__in=[VENDOR_FEDORA,VENDOR_REDHAT]):
-                for component in dist.components.all():
-                    if component not in components_to_regenerate:
-                        components_to_regenerate.append(component)
+        publication = {
+            'dists': sorted(self.unexported),
+            'components': sorted(self.changed_components),
+            'paths': sorted(self.touched_paths),
+            'trees': sorted(self.touched_trees),
+        }
+        for pending in [self.unexported, self.changed_components, self.touched_paths, self.touched_trees]:
+            pending.clear()
+        return publication
 
-            command = ["mkdir", "-p", f"{settings.RPM_CACHEDIR}"]
-            self.ex(*command)
-            for component in components_to_regenerate:
-                command = ["createrepo_c", "-d", "--basedir", f"{settings.RPM_BASEDIR}/{component.name}", "--update", "--cachedir", f"{settings.RPM_CACHEDIR}", "."]
-                self.ex(*command)
+    def run_job(self, job):
+        """Process the dist directory of a claimed job."""
 
-            if settings.SELINUX:
-                # fix selinux contexts
-                command = ["restorecon", "-Rv", settings.RPM_BASEDIR]
-                self.ex(*command)
+        if self.verbose:
+            self.out(f'{job.path}: attempt {job.attempts} of job {job.pk}')
+
+        # other workers may have recorded uploads since the catalog was loaded
+        self.catalog = Catalog()
+        self.dists = self.catalog.dists
+
+        error = None
+        try:
+            directory = self.get_directory(job.path)
+            if directory is None:
+                raise CommandError('Not a dist directory.')
+            self.handle_directory(*directory)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            self.err(f"{job.path}: {error}")
+
+        # record what has to be published even if the job failed, reprepro may have changed something
+        if not finish_job(job, self.take_publication(), error, self.job_attempts, self.job_backoff):
+            self.err(f"{job.path}: Job {job.pk} was claimed by another worker in the meantime.")
+
+    def publish_jobs(self, worker):
+        """Publish the repository for all processed jobs, if this worker is the leader."""
+
+        if not acquire_lease('publish', worker, self.lease):
+            if self.verbose:
+                self.out('Another worker publishes the repository.')
+            return
 
-        if settings.DEB_BASEDIR is not None:
-            if settings.SELINUX:
-                # fix selinux contexts
-                command = ["restorecon", "-Rv", settings.DEB_BASEDIR]
-                self.ex(*command)
+        try:
+            collected = timezone.now()
+            jobs, publication = get_publication()
+            if not jobs:
+                return
+
+            # reprepro must not export while another worker adds packages, publish once it is done
+            if settings.DEB_BASEDIR is not None and publication.get('dists') and is_lock_busy(REPREPRO_LOCK):
+                if self.verbose:
+                    self.out('Another worker uses reprepro, not publishing yet.')
+                return
+
+            self.unexported.update(publication.get('dists', []))
+            self.changed_components.update(publication.get('components', []))
+            self.touched_paths.update(publication.get('paths', []))
+            self.touched_trees.update(publication.get('trees', []))
+            if settings.DEB_BASEDIR is not None:
+                self.export()
+            self.publish()
+            mark_published(jobs, collected)
+        finally:
+            release_lease('publish', worker)
+
+    def work(self):
+        """Process jobs until there are none left, or forever with --poll."""
+
+        worker = get_worker_name()
+        self.prepare()
+        while True:
+            started = timezone.now()
+            start = time.monotonic()
+            success = False
+            try:
+                job = claim_job(worker, self.job_timeout)
+                if job is not None:
+                    with self.metrics.timer('repomanager_stage_seconds', stage='process'):
+                        self.run_job(job)
+                    success = True
+                    continue
+
+                # the queue is empty, so publish what we (and other workers) have processed
+                with self.metrics.timer('repomanager_stage_seconds', stage='publish'):
+                    self.publish_jobs(worker)
+                success = True
+            except CommandError as e:
+                if self.poll is None:
+                    raise
+                self.err(e)
+            finally:
+                self.save_metrics(started, time.monotonic() - start, success)
+
+            if self.poll is None:
+                return
+            time.sleep(self.poll)
+            self.prepare()  # pick up new packages and dists
+
+    def handle(self, *args, **options):
+        self.verbose = options['verbosity'] >= 2
+        self.dry = options['dry_run']
+        self.norm = options['norm']
+        self.prerm = options['prerm'].split(',')
+        self.jobs = options['jobs']
+        self.settle = options['settle']
+        self.rescan = options['rescan']
+        self.retry_backoff = options['retry_backoff']
+        self.max_attempts = options['max_attempts']
+        self.poll = options['poll']
+        self.job_timeout = options['job_timeout']
+        self.job_attempts = options['job_attempts']
+        self.job_backoff = options['job_backoff']
+        self.lease = options['lease']
+        self.src_handled = {}
+        self.local = threading.local()
+        self.locks = defaultdict(threading.Lock)
+        self.unexported = set()
+        self.changed_components = set()
+        self.touched_paths = set()  # files and directories to relabel
+        self.touched_trees = set()  # directories to relabel recursively
+        self.regenerate_all = options['regenerate_all']
+        self.regenerate_early = False
+        self.regenerations = []  # (component name, future) tuples of createrepo_c runs
+        self.metrics = Metrics()
+
+        try:
+            limits = parse_limits(options['tool_limit'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        # shared by all dist directories, so that --jobs doesn't multiply the number of hashing threads
+        with ThreadPoolExecutor(max_workers=options['hash_workers']) as self.hash_executor, \
+                ToolExecutor(limits, options['tool_timeout'], self.observe_result) as self.executor:
+            # share the CPUs between parallel createrepo_c runs
+            self.createrepo_workers = options['createrepo_workers'] or max(
+                1, CPU_COUNT // self.executor.limits['createrepo_c'])
+
+            if options['watch']:
+                self.watch()
+                return
+            if options['enqueue']:
+                self.prepare()
+                self.enqueue()
+                return
+            if options['worker']:
+                self.work()
+                return
+
+            started = timezone.now()
+            start = time.monotonic()
+            success = False
+
+            # state for "python -m repomanager.precheck", the fingerprint is taken before processing anything
+            incoming = IncomingDirectory.objects.filter(enabled=True)
+            locations = [os.path.abspath(d.location) for d in incoming]
+            fingerprint, _ = scan(locations)
+            try:
+                with self.metrics.timer('repomanager_stage_seconds', stage='prepare'):
+                    self.prepare()
+                with self.metrics.timer('repomanager_stage_seconds', stage='process'):
+                    self.process(self.get_directories())
+                with self.metrics.timer('repomanager_stage_seconds', stage='publish'):
+                    self.publish()
+                success = True
+            finally:
+                self.save_metrics(started, time.monotonic() - start, success)
+                if not self.dry:
+                    if success:
+                        save_state(settings.PRECHECK_STATE, locations, fingerprint, self.get_retry_at())
+                    else:
+                        remove_state(settings.PRECHECK_STATE)
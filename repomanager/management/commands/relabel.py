@@ -0,0 +1,34 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+from subprocess import run
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+
+class Command(BaseCommand):
+    help = ('Fix SELinux contexts of the whole repository. processincoming only relabels the files it '
+            'created or modified, run this periodically to catch everything else.')
+
+    def handle(self, *args, **options):
+        flags = '-Rv' if options['verbosity'] >= 2 else '-R'
+        for basedir in [settings.RPM_BASEDIR, settings.DEB_BASEDIR]:
+            if basedir is None:
+                continue
+
+            process = run(['restorecon', flags, basedir])
+            if process.returncode != 0:
+                raise CommandError(f'restorecon failed for {basedir} with code {process.returncode}.')
@@ -0,0 +1,213 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Counters and histograms of processincoming, exposed in the Prometheus text format.
+
+Metrics are collected in memory during a run and merged into the totals stored in
+:py:class:`~repomanager.models.RunSummary` at the end of it, see :py:func:`save_run`.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import RunSummary
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# maps metric names to their type and help text
+METRICS = {
+    'repomanager_subprocess_seconds': ('histogram', 'Time spent in external commands.'),
+    'repomanager_directory_seconds': ('histogram', 'Time spent processing a dist directory.'),
+    'repomanager_regeneration_seconds': ('histogram', 'Time spent regenerating RPM metadata of a component.'),
+    'repomanager_stage_seconds': ('histogram', 'Time spent in the stages of a run.'),
+    'repomanager_uploads_total': ('counter', 'Number of processed uploads.'),
+    'repomanager_db_queries_total': ('counter', 'Database queries when processing a dist directory.'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Thread-safe collection of counters and histograms.
+
+    Samples are identified by the metric name and a sorted tuple of ``(label, value)`` pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # maps (name, labels) to a number
+        self.histograms = {}  # maps (name, labels) to a [bucket counts, sum, count] list
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in the ``with`` block."""
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def count_queries(self, **labels):
+        """Get a wrapper for :py:meth:`~django.db.backends.base.base.BaseDatabaseWrapper.execute_wrapper`
+        that counts database queries."""
+
+        def wrapper(execute, sql, params, many, context):
+            self.inc('repomanager_db_queries_total', **labels)
+            return execute(sql, params, many, context)
+        return wrapper
+
+    def merge(self, other):
+        """Add all samples of `other` to this collection."""
+
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in other.histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def to_json(self):
+        """Get a JSON serializable representation, see :py:meth:`from_json`."""
+
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), histogram]
+                               for (name, labels), histogram in self.histograms.items()],
+            }
+
+    @classmethod
+    def from_json(cls, data):
+        metrics = cls()
+        for name, labels, value in data.get('counters', []):
+            metrics.counters[(name, tuple(sorted(labels.items())))] = value
+        for name, labels, histogram in data.get('histograms', []):
+            if len(histogram[0]) == len(BUCKETS):  # ignore data stored with different buckets
+                metrics.histograms[(name, tuple(sorted(labels.items())))] = histogram
+        return metrics
+
+    def render(self):
+        """Get all samples in the Prometheus text format."""
+
+        samples = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = METRICS.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {help_text}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output += samples[name]
+        return output
+
+
+def save_run(command, metrics, started, duration, success):
+    """Store the metrics of a run and add them to the totals of all runs of `command`."""
+
+    with transaction.atomic():
+        summary = RunSummary.objects.select_for_update().filter(command=command).first()
+        if summary is None:
+            summary = RunSummary(command=command)
+
+        totals = Metrics.from_json(summary.totals)
+        totals.merge(metrics)
+        summary.totals = totals.to_json()
+        summary.metrics = metrics.to_json()
+        summary.started = started
+        summary.finished = timezone.now()
+        summary.duration = duration
+        summary.success = success
+        summary.save()
+
+
+def render_summaries(summaries):
+    """Get the metrics of all runs and the status of the last run of every command in Prometheus format."""
+
+    totals = Metrics()
+    last_run = {
+        'repomanager_last_run_timestamp_seconds': ('Time when the last run finished.', 'gauge', []),
+        'repomanager_last_run_duration_seconds': ('Duration of the last run.', 'gauge', []),
+        'repomanager_last_run_success': ('Whether the last run finished without errors.', 'gauge', []),
+    }
+    for summary in summaries:
+        totals.merge(Metrics.from_json(summary.totals))
+        labels = _format_labels({'command': summary.command})
+        last_run['repomanager_last_run_timestamp_seconds'][2].append(
+            f'{labels} {_format_value(summary.finished.timestamp())}')
+        last_run['repomanager_last_run_duration_seconds'][2].append(
+            f'{labels} {_format_value(summary.duration)}')
+        last_run['repomanager_last_run_success'][2].append(f'{labels} {int(summary.success)}')
+
+    output = totals.render()
+    for name, (help_text, metric_type, samples) in last_run.items():
+        output.append(f'# HELP {name} {help_text}')
+        output.append(f'# TYPE {name} {metric_type}')
+        output += [f'{name}{sample}' for sample in samples]
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:00
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def merge_duplicates(apps, schema_editor):
+    """Merge duplicate rows that would violate the new unique constraints into the newest row.
+
+    The components of the removed rows are added to the newest row, so no links to components are lost.
+    """
+
+    Component = apps.get_model('repomanager', 'Component')
+    for model_name, fields in [
+        ('SourcePackage', ['package', 'dist', 'version']),
+        ('BinaryPackage', ['package', 'name', 'dist', 'arch', 'version']),
+    ]:
+        model = apps.get_model('repomanager', model_name)
+        duplicates = model.objects.values(*fields).annotate(count=Count('pk'), newest=Max('pk')).filter(count__gt=1)
+        for duplicate in duplicates:
+            lookup = {field: duplicate[field] for field in fields}
+            newest = model.objects.get(pk=duplicate['newest'])
+            others = model.objects.filter(**lookup).exclude(pk=newest.pk)
+            newest.components.add(*Component.objects.filter(**{f'{model_name.lower()}__in': others}).distinct())
+            others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0008_auto_20250829_0202'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='binarypackage',
+            index=models.Index(fields=['name', 'dist', 'arch'], name='binarypackage_name_dist_arch'),
+        ),
+        migrations.AddConstraint(
+            model_name='binarypackage',
+            constraint=models.UniqueConstraint(fields=('package', 'name', 'dist', 'arch', 'version'), name='unique_binarypackage_version'),
+        ),
+        migrations.AddConstraint(
+            model_name='sourcepackage',
+            constraint=models.UniqueConstraint(fields=('package', 'dist', 'version'), name='unique_sourcepackage_version'),
+        ),
+    ]
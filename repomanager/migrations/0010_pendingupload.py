@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0009_package_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('directory', models.CharField(db_index=True, max_length=255)),
+                ('fingerprint', models.JSONField(help_text='Size and mtime of all files when they were last checked.')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('quarantined', models.BooleanField(default=False, help_text='Quarantined uploads are not retried until their files change.')),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+                ('last_attempt', models.DateTimeField(blank=True, null=True)),
+                ('next_attempt', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0010_pendingupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=64, unique=True)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Duration of the last run in seconds.')),
+                ('success', models.BooleanField()),
+                ('metrics', models.JSONField(default=dict, help_text='Metrics of the last run.')),
+                ('totals', models.JSONField(default=dict, help_text='Metrics of all runs.')),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0011_runsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('holder', models.CharField(max_length=128)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('lock', models.CharField(help_text='Jobs with the same lock never run at the same time.', max_length=64)),
+                ('status', models.SmallIntegerField(choices=[(0, 'pending'), (1, 'running'), (2, 'done'), (3, 'failed')], default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('worker', models.CharField(blank=True, max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('publish', models.JSONField(blank=True, default=dict)),
+                ('needs_publish', models.BooleanField(default=False)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created'], name='job_status_created')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', [0, 1])), fields=('path',), name='unique_open_job')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0012_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='binarypackage',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='sourcepackage',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
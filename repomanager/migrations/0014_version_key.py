@@ -0,0 +1,54 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:21
+
+from django.db import migrations, models
+
+from repomanager.versions import get_version_key
+
+BATCH_SIZE = 1000
+
+
+def add_version_keys(apps, schema_editor):
+    """Compute the version keys of existing rows."""
+
+    for model_name in ['SourcePackage', 'BinaryPackage']:
+        model = apps.get_model('repomanager', model_name)
+        qs = model.objects.select_related('dist').only('version', 'dist__vendor').order_by('pk')
+        last = 0
+        while True:
+            # batches by primary key, as the table is updated while reading it
+            batch = list(qs.filter(pk__gt=last)[:BATCH_SIZE])
+            if not batch:
+                break
+            for row in batch:
+                row.version_key = get_version_key(row.dist.vendor, row.version)
+            model.objects.bulk_update(batch, ['version_key'])
+            last = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0013_upload_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='binarypackage',
+            name='version_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='sourcepackage',
+            name='version_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(add_version_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='binarypackage',
+            index=models.Index(fields=['package', 'name', 'dist', 'arch', 'version_key'], name='binarypackage_version_key'),
+        ),
+        migrations.AddIndex(
+            model_name='sourcepackage',
+            index=models.Index(fields=['package', 'dist', 'version_key'], name='sourcepackage_version_key'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0014_version_key'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 1)), fields=('lock',), name='unique_running_lock'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0015_running_lock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='distribution',
+            name='needs_export',
+            field=models.BooleanField(default=False, help_text='Set while the reprepro indices of the distribution are out of date.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomanager', '0016_distribution_needs_export'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, help_text='Failed jobs are retried after this.', null=True),
+        ),
+    ]
@@ -12,12 +12,20 @@
 # not, see <http://www.gnu.org/licenses/>.
 
 from django.db import models
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django.db.models import Q
 from django.utils.translation import gettext as _
 
+from .constants import JOB_DONE
+from .constants import JOB_FAILED
+from .constants import JOB_PENDING
+from .constants import JOB_RUNNING
 from .constants import VENDOR_DEBIAN
 from .constants import VENDOR_UBUNTU
 from .constants import VENDOR_FEDORA
 from .constants import VENDOR_REDHAT
+from .versions import get_version_key
 
 VENDORS = (
     (VENDOR_DEBIAN, 'Debian'),
@@ -26,6 +34,13 @@ VENDORS = (
     (VENDOR_REDHAT, 'RedHat'),
 )
 
+JOB_STATUSES = (
+    (JOB_PENDING, 'pending'),
+    (JOB_RUNNING, 'running'),
+    (JOB_DONE, 'done'),
+    (JOB_FAILED, 'failed'),
+)
+
 
 class Component(models.Model):
     name = models.CharField(max_length=64, unique=True)
@@ -42,6 +57,8 @@ class Distribution(models.Model):
     last_seen = models.DateTimeField(null=True)
     released = models.DateField(null=True, blank=True)
     supported_until = models.DateField(null=True, blank=True)
+    needs_export = models.BooleanField(
+        default=False, help_text=_('Set while the reprepro indices of the distribution are out of date.'))
 
     components = models.ManyToManyField(Component, blank=True)
 
@@ -74,13 +91,50 @@ class Package(models.Model):
         return self.name
 
 
+class UploadQuerySet(models.QuerySet):
+    def newest(self):
+        """Only include the newest version of every package in every dist (and arch for binary packages).
+
+        Rows with equal versions are ordered by primary key.
+        """
+
+        group = {field: OuterRef(field) for field in self.model.VERSION_GROUP}
+        key = OuterRef('version_key')
+        newer = self.model.objects.filter(Q(version_key__gt=key) | Q(version_key=key, pk__gt=OuterRef('pk')),
+                                          **group)
+        return self.filter(~Exists(newer))
+
+    def newer_than(self, dist, version):
+        """Only include uploads to `dist` that are newer than `version`."""
+        return self.filter(dist=dist, version_key__gt=get_version_key(dist.vendor, version))
+
+
 class SourcePackage(models.Model):
     package = models.ForeignKey(Package, on_delete=models.CASCADE)
     dist = models.ForeignKey(Distribution, on_delete=models.CASCADE)
     components = models.ManyToManyField(Component)
 
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     version = models.CharField(max_length=32)
+    version_key = models.CharField(max_length=255, editable=False, default='')  # see repomanager.versions
+
+    objects = UploadQuerySet.as_manager()
+
+    VERSION_GROUP = ['package', 'dist']
+
+    class Meta:
+        constraints = [
+            # also serves lookups by (package, dist)
+            models.UniqueConstraint(fields=['package', 'dist', 'version'],
+                                    name='unique_sourcepackage_version'),
+        ]
+        indexes = [
+            models.Index(fields=['package', 'dist', 'version_key'], name='sourcepackage_version_key'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.version_key = get_version_key(self.dist.vendor, self.version)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return '%s_%s' % (self.package.name, self.version)
@@ -92,10 +146,32 @@ class BinaryPackage(models.Model):
     dist = models.ForeignKey(Distribution, on_delete=models.CASCADE)
     components = models.ManyToManyField(Component)
 
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     version = models.CharField(max_length=32)
+    version_key = models.CharField(max_length=255, editable=False, default='')  # see repomanager.versions
     arch = models.CharField(max_length=8)
 
+    objects = UploadQuerySet.as_manager()
+
+    VERSION_GROUP = ['package', 'name', 'dist', 'arch']
+
+    class Meta:
+        constraints = [
+            # also serves lookups by (package, name, dist, arch)
+            models.UniqueConstraint(fields=['package', 'name', 'dist', 'arch', 'version'],
+                                    name='unique_binarypackage_version'),
+        ]
+        indexes = [
+            # lookups by name, e.g. to find the package of an RPM
+            models.Index(fields=['name', 'dist', 'arch'], name='binarypackage_name_dist_arch'),
+            models.Index(fields=['package', 'name', 'dist', 'arch', 'version_key'],
+                         name='binarypackage_version_key'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.version_key = get_version_key(self.dist.vendor, self.version)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return '%s_%s_%s' % (self.name, self.version, self.arch)
 
@@ -106,3 +182,85 @@ class IncomingDirectory(models.Model):
 
     def __str__(self):
         return self.location
+
+
+class PendingUpload(models.Model):
+    """A .changes file that could not be added yet, see :py:mod:`repomanager.pending`."""
+
+    path = models.CharField(max_length=255, unique=True)
+    directory = models.CharField(max_length=255, db_index=True)
+    fingerprint = models.JSONField(help_text=_('Size and mtime of all files when they were last checked.'))
+    attempts = models.PositiveIntegerField(default=0)
+    quarantined = models.BooleanField(
+        default=False,
+        help_text=_('Quarantined uploads are not retried until their files change.')
+    )
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_attempt = models.DateTimeField(null=True, blank=True)
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return self.path
+
+
+class RunSummary(models.Model):
+    """Metrics of the last run of a management command, see :py:mod:`repomanager.metrics`."""
+
+    command = models.CharField(max_length=64, unique=True)
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    duration = models.FloatField(help_text=_('Duration of the last run in seconds.'))
+    success = models.BooleanField()
+    metrics = models.JSONField(default=dict, help_text=_('Metrics of the last run.'))
+    totals = models.JSONField(default=dict, help_text=_('Metrics of all runs.'))
+
+    def __str__(self):
+        return self.command
+
+
+class Job(models.Model):
+    """Processing of a dist directory by a worker, see :py:mod:`repomanager.jobs`."""
+
+    path = models.CharField(max_length=255)
+    lock = models.CharField(max_length=64, help_text=_('Jobs with the same lock never run at the same time.'))
+    status = models.SmallIntegerField(choices=JOB_STATUSES, default=JOB_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=128, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    next_attempt = models.DateTimeField(
+        null=True, blank=True, help_text=_('Failed jobs are retried after this.'))
+    last_error = models.TextField(blank=True)
+
+    # what has to be exported, regenerated and relabeled by the leader
+    publish = models.JSONField(default=dict, blank=True)
+    needs_publish = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            # at most one pending or running job per directory
+            models.UniqueConstraint(fields=['path'], name='unique_open_job',
+                                    condition=models.Q(status__in=[JOB_PENDING, JOB_RUNNING])),
+            # jobs with the same lock never run at the same time
+            models.UniqueConstraint(fields=['lock'], name='unique_running_lock',
+                                    condition=models.Q(status=JOB_RUNNING)),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'created'], name='job_status_created'),
+        ]
+
+    def __str__(self):
+        return self.path
+
+
+class Lease(models.Model):
+    """A lease held by one worker at a time, e.g. to elect the worker that publishes the repository."""
+
+    name = models.CharField(max_length=64, unique=True)
+    holder = models.CharField(max_length=128)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,136 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Bookkeeping of .changes files that could not be added to the repository yet.
+
+Uploads are usually not atomic: a .changes file may arrive before the files it references, or a file may
+still be written to. Such uploads (and uploads that failed for any other reason) are stored as
+:py:class:`~repomanager.models.PendingUpload`. They are only retried once their files stopped changing
+and a backoff (doubled with every failed attempt) has elapsed, and quarantined after too many attempts.
+"""
+
+import os
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import PendingUpload
+
+# upper limit for the time between two attempts, in seconds
+MAX_BACKOFF = 24 * 60 * 60
+
+
+def get_fingerprint(changesfile, changes):
+    """Get size and mtime of a .changes file and all files it references.
+
+    Returns a dict mapping file names to a ``[size, mtime_ns]`` list, or ``None`` if the file is missing.
+    If `changes` can't be parsed (pass ``None`` if reading it failed), only the .changes file is included.
+    """
+
+    basedir = os.path.dirname(changesfile)
+    names = [os.path.basename(changesfile)]
+    try:
+        names += [f['name'] for f in changes['Files']]
+    except (KeyError, TypeError):
+        pass
+
+    fingerprint = {}
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(basedir, name))
+        except FileNotFoundError:
+            fingerprint[name] = None
+        else:
+            fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+class PendingUploads:
+    """Pending uploads of one dist directory, loaded with a single query.
+
+    In a dry run, nothing is written to the database.
+    """
+
+    def __init__(self, directory, max_attempts, backoff, settle=0, dry=False):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.settle = settle
+        self.dry = dry
+        self.entries = {u.path: u for u in PendingUpload.objects.filter(directory=directory)}
+
+    def _save(self, entry):
+        if not self.dry:
+            entry.save()
+
+    def get_backoff(self, attempts):
+        """Get the time to wait after the given number of failed attempts."""
+        return timedelta(seconds=min(self.backoff * 2 ** (attempts - 1), MAX_BACKOFF))
+
+    def check(self, changesfile, fingerprint):
+        """Check if a .changes file should be processed now.
+
+        Returns ``None`` if it should, otherwise the reason why it is skipped.
+        """
+
+        entry = self.entries.get(changesfile)
+        if entry is None:
+            return None
+
+        if entry.fingerprint != fingerprint:
+            # New or modified files, so earlier failures don't count. Retry once the files had time to settle.
+            entry.fingerprint = fingerprint
+            entry.attempts = 0
+            entry.quarantined = False
+            entry.next_attempt = timezone.now() + timedelta(seconds=self.settle)
+            self._save(entry)
+            return 'Files changed since the last attempt, waiting for them to settle'
+        if entry.quarantined:
+            return 'Quarantined after %s failed attempts (%s)' % (entry.attempts, entry.last_error)
+        if entry.next_attempt is not None and entry.next_attempt > timezone.now():
+            return 'Attempt %s failed, next attempt at %s' % (entry.attempts, entry.next_attempt)
+        return None
+
+    def failed(self, changesfile, fingerprint, error):
+        """Record a failed attempt to process a .changes file and return the updated entry."""
+
+        now = timezone.now()
+        entry = self.entries.get(changesfile)
+        if entry is None:
+            entry = PendingUpload(path=changesfile, directory=self.directory)
+            self.entries[changesfile] = entry
+
+        entry.fingerprint = fingerprint
+        entry.attempts += 1
+        entry.last_attempt = now
+        entry.last_error = error
+        entry.next_attempt = now + self.get_backoff(entry.attempts)
+        entry.quarantined = entry.attempts >= self.max_attempts
+        self._save(entry)
+        return entry
+
+    def succeeded(self, changesfile):
+        """Forget a .changes file that was successfully processed."""
+
+        entry = self.entries.pop(changesfile, None)
+        if entry is not None and entry.pk is not None and not self.dry:
+            entry.delete()
+
+    def cleanup(self, changesfiles):
+        """Forget all entries except the given .changes files, e.g. because they were removed manually."""
+
+        stale = [e.pk for path, e in self.entries.items() if path not in changesfiles and e.pk is not None]
+        if stale and not self.dry:
+            PendingUpload.objects.filter(pk__in=stale).delete()
+        self.entries = {path: e for path, e in self.entries.items() if path in changesfiles}
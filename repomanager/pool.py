@@ -0,0 +1,176 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed storage for package files.
+
+Files are stored as ``<pooldir>/<first two hex digits>/<sha256>.<ext>``, so identical files are only
+stored once, no matter how often (or for how many distributions) they are uploaded.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+BUFSIZE = 1024 * 1024
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def sha256sum(path):
+    """Get the hex SHA-256 digest of a file."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(BUFSIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_pool_path(pooldir, digest, ext):
+    """Get the path of a file with the given SHA-256 `digest` in the pool."""
+
+    return os.path.join(pooldir, digest[:2], f'{digest}{ext}')
+
+
+def _get_tmp_path(path):
+    # unique per process and thread, as several threads might process the same file
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _copy(src, dest):
+    """Copy `src` to `dest`, preferring reflinks and in-kernel copies over a copy in userspace.
+
+    Returns the method that was used.
+    """
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(fsrc.fileno(), fdest.fileno(), size - copied)
+                    if count == 0:
+                        break
+                    copied += count
+                method = 'copy_file_range'
+            except (AttributeError, OSError):
+                # copy_file_range() is not available (non-Linux) or not supported by the filesystem
+                fsrc.seek(0)
+                fdest.seek(0)
+                fdest.truncate()
+                shutil.copyfileobj(fsrc, fdest, BUFSIZE)
+                method = 'copy'
+    shutil.copystat(src, dest)
+    return method
+
+
+def add_to_pool(pooldir, path, link=False):
+    """Add a file to the pool.
+
+    If `link` is ``True``, the file may be hardlinked into the pool. Only pass it if `path` is removed
+    afterwards, otherwise modifying it would also modify the pool.
+
+    Returns a ``(pool_path, method)`` tuple, where `method` is ``"exists"`` if an identical file was
+    already in the pool.
+    """
+
+    digest = sha256sum(path)
+    _, ext = os.path.splitext(path)
+    dest = get_pool_path(pooldir, digest, ext)
+    if os.path.exists(dest):
+        return dest, 'exists'
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = _get_tmp_path(dest)
+
+    method = None
+    if link:
+        try:
+            os.link(path, tmp)
+            method = 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+
+    try:
+        if method is None:
+            method = _copy(path, tmp)
+
+        # atomic, so concurrent runs adding the same file never see a partial file
+        os.rename(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return dest, method
+
+
+def find_unreferenced(pooldir, basedir, min_age, now=None):
+    """Get the files in the pool that no symlink below `basedir` points to.
+
+    Files that were added less than `min_age` seconds ago are skipped, as the symlinks to them might not
+    have been created yet. Left over temporary files are included.
+    """
+
+    referenced = set()
+    for root, dirs, files in os.walk(basedir):
+        if os.path.abspath(root) == os.path.abspath(pooldir):
+            dirs[:] = []
+            continue
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                referenced.add(os.path.realpath(path))
+
+    # the ctime changes when a file is renamed into the pool, even if its mtime is preserved
+    now = time.time() if now is None else now
+    unreferenced = []
+    for root, dirs, files in os.walk(pooldir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.realpath(path) not in referenced and now - os.lstat(path).st_ctime >= min_age:
+                unreferenced.append(path)
+    return sorted(unreferenced)
+
+
+def symlink(target, linkpath):
+    """Atomically create (or replace) a symlink at `linkpath` pointing to `target`."""
+
+    tmp = _get_tmp_path(linkpath)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, linkpath)
+
+
+def write_file(path, data):
+    """Atomically replace the file at `path` with `data` (bytes)."""
+
+    tmp = _get_tmp_path(path)
+    try:
+        with open(tmp, 'wb') as stream:
+            stream.write(data)
+        os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,165 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check cheaply if processincoming has anything to do.
+
+Run ``python -m repomanager.precheck && python manage.py processincoming`` (e.g. from cron) to skip
+processincoming when nothing changed since its last run. This module doesn't set up Django: the enabled
+incoming directories are taken from the state file processincoming writes after every successful run
+(see :py:func:`save_state`), and only the incoming directories, their dist directories and the files in
+them are ``stat()``-ed.
+
+There is work if:
+
+* there is no (valid) state file or it is older than ``--max-age``,
+* any dist directory contains files and the fingerprint of the incoming directories changed since the
+  start of the last run, or
+* a failed upload is due for a retry (see :py:mod:`repomanager.pending`).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+# path of the state file, the same environment variable is read by the Django settings
+DEFAULT_STATE_FILE = '/tmp/cache/repomanager/precheck.json'
+STATE_VERSION = 1
+
+
+def get_state_file():
+    return os.environ.get('PRECHECK_STATE', DEFAULT_STATE_FILE)
+
+
+def scan(locations):
+    """Scan incoming directories.
+
+    Returns a ``(fingerprint, files)`` tuple, where `fingerprint` is a hex digest of the mtimes of all
+    incoming and dist directories and the size and mtime of all files in them, and `files` the number of
+    files in dist directories. Hidden files (e.g. uploads in progress) are ignored.
+    """
+
+    digest = hashlib.sha256()
+    files = 0
+    for location in sorted(locations):
+        try:
+            stat = os.stat(location)
+            with os.scandir(location) as entries:
+                subdirs = sorted(e.path for e in entries if e.is_dir() and not e.name.startswith('.'))
+        except OSError:  # processincoming reports missing incoming directories
+            digest.update(f'{location}:missing\n'.encode('utf-8', 'surrogateescape'))
+            continue
+        digest.update(f'{location}:{stat.st_mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+
+        for subdir in subdirs:
+            try:
+                stat = os.stat(subdir)
+                with os.scandir(subdir) as entries:
+                    # Files may be appended to without changing the mtime of the directory
+                    entries = sorted((e.name, e.stat()) for e in entries if not e.name.startswith('.'))
+            except OSError:  # removed in the meantime
+                continue
+            digest.update(f'{subdir}:{stat.st_mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+            for name, stat in entries:
+                line = f'{name}:{stat.st_size}:{stat.st_mtime_ns}\n'
+                digest.update(line.encode('utf-8', 'surrogateescape'))
+            files += len(entries)
+    return digest.hexdigest(), files
+
+
+def load_state(path):
+    """Load the state file, returns None if it doesn't exist or is invalid."""
+
+    try:
+        with open(path) as stream:
+            state = json.load(stream)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        return None
+    return state
+
+
+def save_state(path, locations, fingerprint, retry_at=None):
+    """Write the state file after a successful run.
+
+    `fingerprint` must be taken (with :py:func:`scan`) *before* the run, so that files arriving during the
+    run are never considered processed. `retry_at` is the time (in seconds since the epoch) the next
+    failed upload is due for a retry.
+    """
+
+    state = {
+        'version': STATE_VERSION,
+        'time': time.time(),
+        'locations': sorted(locations),
+        'fingerprint': fingerprint,
+        'retry_at': retry_at,
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as stream:
+        json.dump(state, stream)
+    os.rename(tmp, path)
+
+
+def remove_state(path):
+    """Remove the state file, so that the next check always finds work."""
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def check(state, max_age, now=None):
+    """Check if there is work. Returns a ``(has_work, reason)`` tuple."""
+
+    now = time.time() if now is None else now
+    if state is None:
+        return True, 'no state of a previous run'
+    if now - state['time'] >= max_age:
+        return True, 'last run is older than %d seconds' % max_age
+    if state['retry_at'] is not None and now >= state['retry_at']:
+        return True, 'failed uploads are due for a retry'
+
+    fingerprint, files = scan(state['locations'])
+    if files == 0:
+        return False, 'incoming directories are empty'
+    if fingerprint != state['fingerprint']:
+        return True, 'incoming directories changed (%d files)' % files
+    return False, 'nothing changed since the last run'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m repomanager.precheck',
+        description='Exit with status 0 if processincoming has work to do, 1 otherwise.')
+    parser.add_argument('--state', default=get_state_file(), metavar='PATH',
+                        help='State file written by processincoming (default: %(default)s).')
+    parser.add_argument('--max-age', type=float, default=3600, metavar='SECONDS',
+                        help='Always find work if the last run is older than SECONDS (default: %(default)s).')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Print why there is work or not.')
+    args = parser.parse_args(argv)
+
+    has_work, reason = check(load_state(args.state), args.max_age)
+    if args.verbose:
+        print(reason)
+    return 0 if has_work else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
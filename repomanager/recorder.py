@@ -0,0 +1,235 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory bookkeeping of uploads, written to the database in bulk."""
+
+import threading
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from . import cache
+from .models import BinaryPackage
+from .models import Component
+from .models import Distribution
+from .models import Package
+from .models import SourcePackage
+from .resolver import PackageResolver
+from .versions import get_version_key
+
+
+class Catalog:
+    """Cache of packages, distributions, components and upload records for one run.
+
+    A catalog may be shared by several threads, rows are only loaded from the database once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        ordered_components = Prefetch('components', queryset=Component.objects.order_by('name'))
+        self.dists = {d.name: d for d in Distribution.objects.prefetch_related('components')}
+        self.packages = {p.name: p for p in Package.objects.prefetch_related(ordered_components)}
+        self.packages_by_id = {p.pk: p for p in self.packages.values()}
+        self.resolver = PackageResolver()
+        self.source_packages = {}  # maps package ids to a list of SourcePackage instances
+        self.binary_packages = {}  # maps package ids to a list of BinaryPackage instances
+
+    def get_package(self, name):
+        """Get a package by name, creating it if it doesn't exist yet."""
+
+        package = self.packages.get(name)
+        if package is None:
+            with self.lock:
+                package = self.packages.get(name)
+                if package is None:
+                    package = Package.objects.get_or_create(name=name)[0]
+                    self.packages[name] = package
+                    self.packages_by_id[package.pk] = package
+        return package
+
+    def resolve_binary_package(self, name, dist, arch):
+        """Get the package a binary package belongs to, or None if it was never seen before."""
+
+        package_id = self.resolver.resolve(name, dist.pk, arch)
+        if package_id is None:
+            return None
+
+        package = self.packages_by_id.get(package_id)
+        if package is None:  # created by somebody else after the catalog was loaded
+            package = Package.objects.get(pk=package_id)
+            with self.lock:
+                self.packages[package.name] = package
+                self.packages_by_id[package.pk] = package
+        return package
+
+    def get_components(self, package, dist):
+        """Get the components a package is added to in a Debian-like dist."""
+
+        if package.all_components:
+            return [c for c in dist.components.all() if c.enabled]
+        dist_components = {c.pk for c in dist.components.all()}
+        return [c for c in package.components.all() if c.pk in dist_components]
+
+    def _get_rows(self, cache, model, package):
+        rows = cache.get(package.pk)
+        if rows is None:
+            with self.lock:
+                rows = cache.get(package.pk)
+                if rows is None:
+                    rows = list(model.objects.filter(package=package).prefetch_related('components')
+                                .order_by('pk'))
+                    for row in rows:
+                        row._component_ids = {c.pk for c in row.components.all()}
+                    cache[package.pk] = rows
+        return rows
+
+    def get_source_packages(self, package):
+        """Get all (recorded and not yet written) SourcePackage rows of a package."""
+        return self._get_rows(self.source_packages, SourcePackage, package)
+
+    def get_binary_packages(self, package):
+        """Get all (recorded and not yet written) BinaryPackage rows of a package."""
+        return self._get_rows(self.binary_packages, BinaryPackage, package)
+
+    def forget(self, package):
+        """Drop cached rows of a package, e.g. after they have been deleted."""
+
+        with self.lock:
+            self.source_packages.pop(package.pk, None)
+            self.binary_packages.pop(package.pk, None)
+
+
+class UploadRecorder:
+    """Unit of work recording uploads of one dist directory.
+
+    Nothing is written to the database until :py:meth:`flush` is called, which writes everything in a
+    single transaction using bulk queries.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.created = []  # new SourcePackage/BinaryPackage instances
+        self.updated = {}  # maps ids of changed rows to the instance
+        self.seen = {}  # maps (model, pk) to instances whose last_seen needs to be updated
+
+    def touch(self, *objs):
+        """Mark packages, distributions or components as seen."""
+
+        now = timezone.now()
+        for obj in objs:
+            obj.last_seen = now
+            self.seen[(type(obj), obj.pk)] = obj
+
+    def _record(self, rows, model, dist, match, values, components):
+        # NOTE: match uses foreign key ids, so that related objects are never fetched
+        row = next((r for r in rows if all(getattr(r, k) == v for k, v in match.items())), None)
+        if row is None:
+            row = model(**match, **values)
+            row._component_ids = set()
+            rows.append(row)
+            self.created.append(row)
+        else:
+            for key, value in values.items():
+                setattr(row, key, value)
+            row.timestamp = timezone.now()
+            if row.pk is not None:
+                self.updated[id(row)] = row
+
+        row._new_component_ids = {c.pk for c in components}
+        row.dist = dist  # no query when saving rows one by one, which updates the version key
+        return row
+
+    def record_source(self, package, dist, version, components, by_version=False):
+        """Record a source package upload.
+
+        With `by_version`, every version gets its own row, otherwise the row for `dist` is updated.
+        """
+
+        rows = self.catalog.get_source_packages(package)
+        match = {'package_id': package.pk, 'dist_id': dist.pk}
+        values = {'version': version}
+        if by_version:
+            match.update(values)
+            values = {}
+        values['version_key'] = get_version_key(dist.vendor, version)
+        return self._record(rows, SourcePackage, dist, match, values, components)
+
+    def record_binary(self, package, name, dist, arch, version, components, by_version=False):
+        """Record a binary package upload.
+
+        With `by_version`, every version gets its own row, otherwise the row for `name`, `dist` and
+        `arch` is updated.
+        """
+
+        rows = self.catalog.get_binary_packages(package)
+        match = {'package_id': package.pk, 'name': name, 'dist_id': dist.pk, 'arch': arch}
+        values = {'version': version}
+        if by_version:
+            match.update(values)
+            values = {}
+        values['version_key'] = get_version_key(dist.vendor, version)
+        self.catalog.resolver.add(name, dist.pk, arch, package.pk)
+        return self._record(rows, BinaryPackage, dist, match, values, components)
+
+    def _save_components(self, rows):
+        """Write the difference between old and new components of `rows`."""
+
+        for model in [SourcePackage, BinaryPackage]:
+            through = model.components.through
+            field = model.components.field.m2m_field_name()
+
+            add = []
+            for row in rows:
+                if not isinstance(row, model):
+                    continue
+
+                for component_id in row._new_component_ids - row._component_ids:
+                    add.append(through(**{f'{field}_id': row.pk, 'component_id': component_id}))
+                removed = row._component_ids - row._new_component_ids
+                if removed:
+                    through.objects.filter(**{field: row.pk, 'component_id__in': removed}).delete()
+                row._component_ids = row._new_component_ids
+            through.objects.bulk_create(add)
+
+    def flush(self):
+        """Write all recorded changes to the database."""
+
+        created, self.created = self.created, []
+        updated, self.updated = list(self.updated.values()), {}
+        seen, self.seen = self.seen, {}
+
+        with transaction.atomic():
+            for model in [SourcePackage, BinaryPackage]:
+                rows = [r for r in created if isinstance(r, model)]
+                if connection.features.can_return_rows_from_bulk_insert:
+                    model.objects.bulk_create(rows)
+                else:
+                    # we need the primary keys to add components
+                    for row in rows:
+                        row.save()
+
+                rows = [r for r in updated if isinstance(r, model)]
+                model.objects.bulk_update(rows, ['version', 'version_key', 'timestamp'])
+
+            self._save_components(created + updated)
+
+            by_model = {}
+            for (model, _pk), obj in seen.items():
+                by_model.setdefault(model, []).append(obj)
+            for model, objs in by_model.items():
+                model.objects.bulk_update(objs, ['last_seen'])
+
+            if created or updated:
+                transaction.on_commit(cache.invalidate)
@@ -0,0 +1,79 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from .models import BinaryPackage
+
+
+class PackageResolver:
+    """Index to find the package a binary package belongs to.
+
+    The index is loaded with a single query the first time it is used and kept up to date with
+    :py:meth:`add`. For every binary package name, the first row (by primary key) wins, so lookups give
+    the same result as evaluating the equivalent querysets and taking the first element.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.by_arch = {}  # maps (name, dist_id, arch) to a package id
+        self.by_dist = {}  # maps (name, dist_id) to a package id
+        self.by_name = {}  # maps name to a package id
+        self.pending = []  # rows added before the index was loaded
+
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+
+            qs = BinaryPackage.objects.order_by('pk').values_list('name', 'dist_id', 'arch', 'package_id')
+            for name, dist_id, arch, package_id in qs.iterator():
+                self._add(name, dist_id, arch, package_id)
+
+            # rows that are recorded but not yet written to the database are newer than any loaded row
+            for row in self.pending:
+                self._add(*row)
+            self.pending = []
+            self.loaded = True
+
+    def _add(self, name, dist_id, arch, package_id):
+        self.by_arch.setdefault((name, dist_id, arch), package_id)
+        self.by_dist.setdefault((name, dist_id), package_id)
+        self.by_name.setdefault(name, package_id)
+
+    def add(self, name, dist_id, arch, package_id):
+        """Add a newly recorded binary package to the index."""
+
+        with self.lock:
+            if self.loaded:
+                self._add(name, dist_id, arch, package_id)
+            else:
+                self.pending.append((name, dist_id, arch, package_id))
+
+    def resolve(self, name, dist_id, arch):
+        """Get the id of the package that the binary package `name` belongs to, or None if unknown.
+
+        Binary packages with the same arch in the same dist are preferred over packages in the same dist,
+        which in turn are preferred over packages with the same name in any dist.
+        """
+
+        if not self.loaded:
+            self._load()
+
+        package_id = self.by_arch.get((name, dist_id, arch))
+        if package_id is None:
+            package_id = self.by_dist.get((name, dist_id))
+        if package_id is None:
+            package_id = self.by_name.get(name)
+        return package_id
@@ -0,0 +1,93 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from collections import namedtuple
+
+from rpmfile.errors import RPMError
+from rpmfile.headers import get_headers
+
+RPM_LEAD = struct.Struct('!4sBBhh66shh16s')
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+RPM_TYPE_SOURCE = 1
+
+RpmHeader = namedtuple('RpmHeader', ['name', 'version', 'release', 'arch'])
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def read_rpm_header(path):
+    """Read name, version, release and arch of an RPM file.
+
+    Only the lead and the headers are read, the payload is never touched. Source RPMs have the
+    architecture "src", just like ``rpm -qpi`` reports them.
+
+    Raises ``RuntimeError`` if the file is not a valid RPM file.
+    """
+
+    with open(path, 'rb') as stream:
+        lead = stream.read(RPM_LEAD.size)
+        if len(lead) != RPM_LEAD.size or not lead.startswith(RPM_MAGIC):
+            raise RuntimeError(f'{path}: Not an RPM file.')
+        stream.seek(0)
+
+        try:
+            _, headers = get_headers(stream)
+        except (RPMError, AssertionError, struct.error, ValueError, IndexError) as e:
+            raise RuntimeError(f'{path}: Cannot read RPM header: {e}')
+
+    try:
+        name = _decode(headers['name'])
+        version = _decode(headers['version'])
+        release = _decode(headers['release'])
+    except KeyError as e:
+        raise RuntimeError(f'{path}: RPM header has no {e} tag.')
+
+    # Binary RPMs name the source RPM they were built from, source RPMs don't.
+    rpmtype = RPM_LEAD.unpack(lead)[3]
+    if rpmtype == RPM_TYPE_SOURCE or 'sourcerpm' not in headers:
+        arch = 'src'
+    else:
+        arch = _decode(headers.get('arch', b'x86_64'))
+
+    return RpmHeader(name=name, version=version, release=release, arch=arch)
+
+
+def parse_checksig(paths, output):
+    """Map the output of ``rpm --checksig`` for several files to the status of each file.
+
+    ``rpm`` prints a line like ``<path>: digests signatures OK`` for every file. Returns a dict mapping
+    each of `paths` to its status (e.g. ``"digests signatures OK"``). Files rpm did not report on (e.g.
+    because they are not RPM files) are missing from the dict.
+    """
+
+    paths = set(paths)
+    statuses = {}
+    for line in output.splitlines():
+        # file names may contain ": " as well, so try every separator until the prefix is a known path
+        index = line.find(': ')
+        while index != -1:
+            if line[:index] in paths:
+                statuses[line[:index]] = line[index + 2:].strip()
+                break
+            index = line.find(': ', index + 1)
+    return statuses
+
+
+def is_valid_checksig(status):
+    """True if a status returned by :py:func:`parse_checksig` means that the signature is valid."""
+    return status.endswith('OK') and 'NOT OK' not in status
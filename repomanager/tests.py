@@ -1,3 +1,1338 @@
-#from django.test import TestCase
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
 
-# Create your tests here.
+import base64
+import errno
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from debian import deb822
+from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .benchmark import _rpm_header
+from .benchmark import compare
+from .benchmark import fake_tools
+from .benchmark import make_changes
+from .benchmark import make_rpm
+from .benchmark import run_benchmark
+from .benchmark import write_fake_tools
+from .checksums import verify_changes
+from .constants import JOB_DONE
+from .constants import JOB_FAILED
+from .constants import JOB_PENDING
+from .constants import JOB_RUNNING
+from .constants import VENDOR_DEBIAN
+from .constants import VENDOR_FEDORA
+from .executor import OutputTail
+from .executor import ToolExecutor
+from .executor import parse_limits
+from .jobs import acquire_lease
+from .jobs import claim_job
+from .jobs import enqueue
+from .jobs import finish_job
+from .jobs import get_publication
+from .jobs import is_lock_busy
+from .jobs import mark_published
+from .jobs import release_lease
+from .metrics import Metrics
+from .metrics import save_run
+from .models import BinaryPackage
+from .models import Component
+from .models import Distribution
+from .models import IncomingDirectory
+from .models import Job
+from .models import Package
+from .models import PendingUpload
+from .models import SourcePackage
+from .pending import PendingUploads
+from .pending import get_fingerprint
+from .pool import add_to_pool
+from .pool import find_unreferenced
+from .pool import get_pool_path
+from .pool import sha256sum
+from .pool import symlink
+from .precheck import check
+from .precheck import load_state
+from .precheck import save_state
+from .precheck import scan
+from .recorder import Catalog
+from .recorder import UploadRecorder
+from .rpm import RPM_LEAD
+from .rpm import RPM_MAGIC
+from .rpm import RPM_TYPE_SOURCE
+from .rpm import is_valid_checksig
+from .rpm import parse_checksig
+from .rpm import read_rpm_header
+from .versions import get_dpkg_key
+from .versions import get_rpm_key
+from .versions import get_version_key
+
+
+class QueryTestCase(TestCase):
+    """Make sure that the database lookups of processincoming stay cheap."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.main = Component.objects.create(name='main')
+        cls.x86_64 = Component.objects.create(name='f40-x86_64')
+        cls.bookworm = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        cls.bookworm.components.add(cls.main)
+        cls.f40 = Distribution.objects.create(name='f40', vendor=VENDOR_FEDORA)
+        cls.f40.components.add(cls.x86_64)
+        cls.package = Package.objects.create(name='hello', all_components=True)
+
+    def assertIndexed(self, qs):
+        plan = qs.explain()
+        self.assertNotIn('SCAN repomanager_', plan)
+        self.assertIn('INDEX', plan)
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite only.')
+    def test_query_plans(self):
+        self.assertIndexed(Package.objects.filter(name='hello'))
+        self.assertIndexed(Distribution.objects.filter(name='f40'))
+        self.assertIndexed(SourcePackage.objects.filter(package=self.package, dist=self.bookworm))
+        self.assertIndexed(SourcePackage.objects.filter(package__name='hello', dist=self.bookworm))
+        self.assertIndexed(BinaryPackage.objects.filter(
+            package=self.package, name='hello', dist=self.f40, arch='x86_64'))
+        self.assertIndexed(BinaryPackage.objects.filter(name='hello', dist=self.f40, arch='x86_64'))
+        self.assertIndexed(BinaryPackage.objects.filter(name='hello'))
+
+
+class RecorderTestCase(TestCase):
+    """Test recording uploads with the UploadRecorder and writing them to the database."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.main = Component.objects.create(name='main')
+        cls.contrib = Component.objects.create(name='contrib')
+        cls.x86_64 = Component.objects.create(name='f40-x86_64')
+        cls.bookworm = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        cls.bookworm.components.add(cls.main, cls.contrib)
+        cls.f40 = Distribution.objects.create(name='f40', vendor=VENDOR_FEDORA)
+        cls.f40.components.add(cls.x86_64)
+        cls.package = Package.objects.create(name='hello', all_components=True)
+
+    def record(self, count):
+        """Record `count` uploads of source and binary packages and return the queries used to flush them."""
+
+        catalog = Catalog()
+        recorder = UploadRecorder(catalog)
+        for i in range(count):
+            package = catalog.get_package('hello')
+            recorder.touch(package, self.bookworm)
+            components = catalog.get_components(package, self.bookworm)
+            recorder.record_source(package, self.bookworm, f'1.{i}', components)
+            recorder.record_binary(package, f'hello{i}', self.bookworm, 'amd64', f'1.{i}-1', components)
+            recorder.record_binary(package, 'hello', self.f40, 'x86_64', f'1.{i}-1', [self.x86_64],
+                                   by_version=True)
+
+        with CaptureQueriesContext(connection) as context:
+            recorder.flush()
+        return context.captured_queries
+
+    def test_flush_query_count(self):
+        # The number of queries must not depend on the number of uploads in a directory
+        few = self.record(2)
+        many = self.record(20)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(SourcePackage.objects.count(), 1)
+        self.assertEqual(BinaryPackage.objects.filter(dist=self.f40).count(), 20)
+
+    def test_flush_unchanged_components(self):
+        # recording the same upload again must not rewrite its components
+        self.record(1)
+        queries = [q['sql'] for q in self.record(1)]
+        self.assertFalse([q for q in queries if 'components' in q and q.startswith(('INSERT', 'DELETE'))])
+
+    def test_flush(self):
+        # nothing is written before the recorder is flushed
+        catalog = Catalog()
+        recorder = UploadRecorder(catalog)
+        recorder.touch(self.package, self.bookworm)
+        recorder.record_source(self.package, self.bookworm, '1.0-1', [self.main, self.contrib])
+        self.assertFalse(SourcePackage.objects.exists())
+        recorder.flush()
+
+        source = SourcePackage.objects.get()
+        self.assertEqual(source.version_key, get_version_key(VENDOR_DEBIAN, '1.0-1'))
+        self.assertEqual(set(source.components.all()), {self.main, self.contrib})
+        self.assertIsNotNone(Package.objects.get().last_seen)
+        self.assertIsNotNone(Distribution.objects.get(name='bookworm').last_seen)
+
+        # a new version updates the row, removed components are dropped
+        recorder.record_source(self.package, self.bookworm, '1.0-2', [self.main])
+        recorder.flush()
+        source = SourcePackage.objects.get()
+        self.assertEqual(source.version, '1.0-2')
+        self.assertEqual(list(source.components.all()), [self.main])
+
+    def test_forget(self):
+        catalog = Catalog()
+        rows = catalog.get_source_packages(self.package)
+        self.assertIs(catalog.get_source_packages(self.package), rows)
+
+        # rows written by somebody else are only seen after the cached rows are dropped
+        SourcePackage.objects.create(package=self.package, dist=self.bookworm, version='1.0-1')
+        self.assertEqual(catalog.get_source_packages(self.package), [])
+        catalog.forget(self.package)
+        self.assertEqual(len(catalog.get_source_packages(self.package)), 1)
+
+
+class ResolverTestCase(TestCase):
+    """Test finding the package a binary package belongs to."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.bookworm = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        cls.trixie = Distribution.objects.create(name='trixie', vendor=VENDOR_DEBIAN)
+        cls.sid = Distribution.objects.create(name='sid', vendor=VENDOR_DEBIAN)
+        cls.packages = [Package.objects.create(name=f'foo{i}') for i in range(3)]
+        for package, dist, arch in [(cls.packages[0], cls.bookworm, 'i386'),
+                                    (cls.packages[1], cls.bookworm, 'amd64'),
+                                    (cls.packages[2], cls.trixie, 'amd64')]:
+            BinaryPackage.objects.create(package=package, name='libfoo', dist=dist, arch=arch, version='1.0')
+
+    def test_precedence(self):
+        catalog = Catalog()
+        foo0, foo1, foo2 = self.packages
+        for dist, arch, package in [
+            (self.bookworm, 'amd64', foo1),  # same arch in the same dist
+            (self.bookworm, 'arm64', foo0),  # first row in the same dist
+            (self.trixie, 'i386', foo2),
+            (self.sid, 'amd64', foo0),  # first row in any dist
+        ]:
+            self.assertEqual(catalog.resolve_binary_package('libfoo', dist, arch), package)
+        self.assertIsNone(catalog.resolve_binary_package('libbar', self.bookworm, 'amd64'))
+
+        # the same as evaluating querysets
+        qs = BinaryPackage.objects.filter(name='libfoo').order_by('pk')
+        self.assertEqual(catalog.resolve_binary_package('libfoo', self.sid, 'amd64'), qs.first().package)
+        self.assertEqual(catalog.resolve_binary_package('libfoo', self.bookworm, 'arm64'),
+                         qs.filter(dist=self.bookworm).first().package)
+
+    def test_refresh(self):
+        # packages recorded before and after the index is loaded are found before they are written
+        catalog = Catalog()
+        recorder = UploadRecorder(catalog)
+        bar = catalog.get_package('bar')
+        recorder.record_binary(bar, 'libbar', self.sid, 'amd64', '1.0', [])
+        self.assertEqual(catalog.resolve_binary_package('libbar', self.bookworm, 'amd64'), bar)
+        baz = catalog.get_package('baz')
+        recorder.record_binary(baz, 'libbaz', self.sid, 'amd64', '1.0', [])
+        self.assertEqual(catalog.resolve_binary_package('libbaz', self.sid, 'amd64'), baz)
+
+        # new rows don't change the package of existing ones
+        recorder.record_binary(baz, 'libfoo', self.sid, 'amd64', '1.0', [])
+        self.assertEqual(catalog.resolve_binary_package('libfoo', self.sid, 'amd64'), baz)
+        self.assertEqual(catalog.resolve_binary_package('libfoo', self.trixie, 'amd64'), self.packages[2])
+        recorder.flush()
+        self.assertEqual(BinaryPackage.objects.get(name='libbar').package, bar)
+
+    def test_created_elsewhere(self):
+        # packages created after the catalog was loaded, e.g. by another process, are fetched when needed
+        catalog = Catalog()
+        qux = Package.objects.create(name='qux')
+        BinaryPackage.objects.create(package=qux, name='libqux', dist=self.sid, arch='amd64', version='1.0')
+        self.assertEqual(catalog.resolve_binary_package('libqux', self.sid, 'amd64'), qux)
+        self.assertIs(catalog.get_package('qux'), catalog.resolve_binary_package('libqux', self.sid, 'amd64'))
+
+
+class AdminTestCase(TestCase):
+    """Make sure that admin pages use a constant number of queries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.components = [Component.objects.create(name=f'comp{i}') for i in range(3)]
+        cls.dist = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_packages(self, count):
+        for _ in range(count):
+            package = Package.objects.create(name=f'package{Package.objects.count()}')
+            package.components.add(*self.components)
+
+    def add_uploads(self, package, count):
+        for i in range(count):
+            version = f'1.{SourcePackage.objects.count()}'
+            src = SourcePackage.objects.create(package=package, dist=self.dist, version=version)
+            src.components.add(*self.components)
+            binary = BinaryPackage.objects.create(package=package, name='hello', dist=self.dist, arch='amd64',
+                                                  version=version)
+            binary.components.add(*self.components)
+
+    def count_queries(self, url):
+        self.client.get(url)  # warm up caches, e.g. of content types
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelists(self):
+        package = Package.objects.create(name='hello')
+        for url in ['/admin/repomanager/package/', '/admin/repomanager/sourcepackage/',
+                    '/admin/repomanager/binarypackage/']:
+            self.add_packages(2)
+            self.add_uploads(package, 2)
+            few = self.count_queries(url)
+            self.add_packages(20)
+            self.add_uploads(package, 20)
+            self.assertEqual(few, self.count_queries(url), url)
+
+    def test_package_change(self):
+        package = Package.objects.create(name='hello')
+        url = f'/admin/repomanager/package/{package.pk}/change/'
+        self.add_uploads(package, 2)
+        few = self.count_queries(url)
+        self.add_uploads(package, 60)
+        self.assertEqual(few, self.count_queries(url))
+
+
+class PendingUploadTestCase(TestCase):
+    """Test deferral of uploads that could not be processed."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+        self.changesfile = os.path.join(self.directory, 'hello_1.0_amd64.changes')
+        self.changes = {'Files': [{'name': 'hello_1.0_amd64.deb'}]}
+        with open(self.changesfile, 'w') as stream:
+            stream.write('changes')
+
+    def get_pending(self):
+        return PendingUploads(self.directory, max_attempts=3, backoff=60)
+
+    def test_backoff(self):
+        fingerprint = get_fingerprint(self.changesfile, self.changes)
+        self.assertIsNone(fingerprint['hello_1.0_amd64.deb'])
+        self.assertIsNone(self.get_pending().check(self.changesfile, fingerprint))
+        self.get_pending().failed(self.changesfile, fingerprint, 'Missing hello_1.0_amd64.deb')
+
+        # unchanged files are not retried before the backoff has elapsed
+        self.assertIsNotNone(self.get_pending().check(self.changesfile, fingerprint))
+        PendingUpload.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(self.get_pending().check(self.changesfile, fingerprint))
+
+        # the backoff doubles with every attempt
+        pending = self.get_pending()
+        entry = pending.failed(self.changesfile, fingerprint, 'Missing hello_1.0_amd64.deb')
+        self.assertEqual(entry.attempts, 2)
+        self.assertEqual(entry.next_attempt - entry.last_attempt, timedelta(seconds=120))
+
+    def test_quarantine(self):
+        fingerprint = get_fingerprint(self.changesfile, self.changes)
+        pending = self.get_pending()
+        for _ in range(3):
+            entry = pending.failed(self.changesfile, fingerprint, 'reprepro failed')
+        self.assertTrue(entry.quarantined)
+
+        PendingUpload.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertIsNotNone(self.get_pending().check(self.changesfile, fingerprint))
+
+    def test_changed_files(self):
+        fingerprint = get_fingerprint(self.changesfile, self.changes)
+        self.get_pending().failed(self.changesfile, fingerprint, 'Missing hello_1.0_amd64.deb')
+        PendingUpload.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+
+        # files that are still changing are not retried, even if the backoff has elapsed
+        with open(os.path.join(self.directory, 'hello_1.0_amd64.deb'), 'w') as stream:
+            stream.write('deb')
+        fingerprint = get_fingerprint(self.changesfile, self.changes)
+        pending = PendingUploads(self.directory, max_attempts=3, backoff=60, settle=5)
+        self.assertIsNotNone(pending.check(self.changesfile, fingerprint))
+        self.assertIsNotNone(self.get_pending().check(self.changesfile, fingerprint))
+        PendingUpload.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(self.get_pending().check(self.changesfile, fingerprint))
+
+        pending = self.get_pending()
+        pending.succeeded(self.changesfile)
+        self.assertFalse(PendingUpload.objects.exists())
+
+    def test_unreadable_changes(self):
+        # only the .changes file is fingerprinted, so it is retried when it is rewritten
+        self.assertEqual(list(get_fingerprint(self.changesfile, None)), ['hello_1.0_amd64.changes'])
+        self.assertEqual(list(get_fingerprint(self.changesfile, {})), ['hello_1.0_amd64.changes'])
+
+    def test_cleanup(self):
+        fingerprint = get_fingerprint(self.changesfile, self.changes)
+        self.get_pending().failed(self.changesfile, fingerprint, 'Missing hello_1.0_amd64.deb')
+        self.get_pending().cleanup(set())
+        self.assertFalse(PendingUpload.objects.exists())
+
+
+class MetricsTestCase(TestCase):
+    """Test collecting, storing and rendering metrics."""
+
+    def get_metrics(self):
+        metrics = Metrics()
+        metrics.observe('repomanager_subprocess_seconds', 0.2, tool='reprepro', outcome='ok')
+        metrics.observe('repomanager_subprocess_seconds', 1000, tool='reprepro', outcome='ok')
+        metrics.inc('repomanager_uploads_total', dist='bookworm', outcome='added')
+        return metrics
+
+    def test_render(self):
+        lines = self.get_metrics().render()
+        self.assertIn('# TYPE repomanager_subprocess_seconds histogram', lines)
+        bucket = 'repomanager_subprocess_seconds_bucket{outcome="ok",tool="reprepro",le="%s"} %s'
+        self.assertIn(bucket % ('0.25', 1), lines)
+        self.assertIn(bucket % ('+Inf', 2), lines)
+        self.assertIn('repomanager_subprocess_seconds_count{outcome="ok",tool="reprepro"} 2', lines)
+        self.assertIn('repomanager_uploads_total{dist="bookworm",outcome="added"} 1', lines)
+
+    def test_view(self):
+        # the totals of all runs are exposed
+        for _ in range(2):
+            save_run('processincoming', self.get_metrics(), timezone.now(), 1.5, True)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('repomanager_uploads_total{dist="bookworm",outcome="added"} 2', lines)
+        self.assertIn('repomanager_subprocess_seconds_count{outcome="ok",tool="reprepro"} 4', lines)
+        self.assertIn('repomanager_last_run_duration_seconds{command="processincoming"} 1.5', lines)
+        self.assertIn('repomanager_last_run_success{command="processincoming"} 1', lines)
+
+
+class BenchmarkTestCase(TestCase):
+    """Run processincoming end to end with generated uploads and fake tools."""
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            latency = {'reprepro': 0, 'createrepo_c': 0, 'rpm': 0, 'restorecon': 0}
+            results = run_benchmark(workdir, dists=1, packages=2, runs=2, latency=latency, size=16,
+                                    selinux=True)
+
+            # all uploads were processed, so the next cron run can be skipped
+            self.assertFalse(check(load_state(os.path.join(workdir, 'precheck.json')), max_age=3600)[0])
+
+        self.assertEqual(results['uploads'], 8)
+        self.assertEqual(results['added'], 8)
+        self.assertEqual(SourcePackage.objects.filter(dist__name='bench0').count(), 2)
+        self.assertEqual(BinaryPackage.objects.filter(dist__name='benchfc0').count(), 4)
+        self.assertEqual(results['subprocesses']['rpm'], 2)  # one call per directory
+        self.assertNotIn('mkdir', results['subprocesses'])
+        # per run, one call for new files and links and one for regenerated repodata
+        self.assertEqual(results['subprocesses']['restorecon'], 4)
+
+        self.assertEqual(compare(results, results, 10), [])
+        worse = dict(results, uploads_per_second=results['uploads_per_second'] / 2,
+                     queries_per_upload=results['queries_per_upload'] * 2)
+        self.assertEqual(len(compare(worse, results, 10)), 2)
+
+
+class ProcessIncomingTestCase(TransactionTestCase):
+    """Run processincoming on a small incoming directory with fake tools."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.workdir = tmp.name
+        self.incoming = os.path.join(self.workdir, 'incoming')
+        self.bindir = os.path.join(self.workdir, 'bin')
+        write_fake_tools(self.bindir, {'reprepro': 0, 'createrepo_c': 0, 'rpm': 0, 'restorecon': 0})
+        self.enterContext(fake_tools(self.bindir))
+        self.enterContext(override_settings(
+            DEB_BASEDIR=os.path.join(self.workdir, 'deb'),
+            RPM_BASEDIR=os.path.join(self.workdir, 'rpm'),
+            RPM_CACHEDIR=os.path.join(self.workdir, 'cache'),
+            PRECHECK_STATE=os.path.join(self.workdir, 'precheck.json'),
+        ))
+
+        main = Component.objects.create(name='main')
+        Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN).components.add(main)
+        Package.objects.create(name='hello', all_components=True)
+        IncomingDirectory.objects.create(location=self.incoming)
+        self.directory = os.path.join(self.incoming, 'bookworm-amd64')
+        os.makedirs(self.directory)
+
+    def process(self, **options):
+        stdout = StringIO()
+        call_command('processincoming', stdout=stdout, stderr=StringIO(), **options)
+        return stdout.getvalue()
+
+    def test_payload_after_changes(self):
+        # the .changes file arrives first and fails, then the payload arrives
+        changesfile = make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        deb = os.path.join(self.directory, 'hello_1.0-1_amd64.deb')
+        with open(deb, 'rb') as stream:
+            data = stream.read()
+        os.remove(deb)
+        self.process()
+        self.assertIn('missing', PendingUpload.objects.get(path=changesfile).last_error.lower())
+
+        state = os.path.join(self.workdir, 'precheck.json')
+        self.assertFalse(check(load_state(state), max_age=3600)[0])
+        with open(deb, 'wb') as stream:
+            stream.write(data)
+        self.assertTrue(check(load_state(state), max_age=3600)[0])
+
+        # the upload waits for its files to settle and the precheck runs again once they did
+        self.process()
+        self.assertFalse(SourcePackage.objects.exists())
+        self.assertTrue(check(load_state(state), max_age=3600, now=time.time() + 5)[0])
+        # rows without a next attempt (e.g. from older releases) are due right away, the command is
+        # imported here as it needs the repository settings
+        from .management.commands.processincoming import Command
+        PendingUpload.objects.update(next_attempt=None)
+        self.assertLessEqual(Command().get_retry_at(), time.time())
+
+        self.process()
+        self.assertFalse(PendingUpload.objects.exists())
+        self.assertTrue(SourcePackage.objects.filter(package__name='hello', dist__name='bookworm').exists())
+
+    def test_watch_errors(self):
+        from .management.commands.processincoming import Command
+
+        # unexpected errors are logged and the daemon keeps running
+        stderr = StringIO()
+        command = Command(stdout=StringIO(), stderr=stderr)
+        command.metrics = Metrics()
+        command.dry = True
+        command.local = threading.local()
+        command.process = lambda directories: {}['missing']
+        command.process_watched([])
+        self.assertIn('Traceback', stderr.getvalue())
+        self.assertIn('KeyError', stderr.getvalue())
+
+        # failed uploads are retried once they are due
+        PendingUpload.objects.create(directory=self.directory, path=f'{self.directory}/hello.changes',
+                                     fingerprint={}, next_attempt=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(command.get_due_directories(), [])
+        PendingUpload.objects.update(next_attempt=timezone.now())
+        self.assertEqual(command.get_due_directories(), [self.directory])
+
+    def add_fedora(self):
+        for name in ['f40', 'f41']:
+            dist = Distribution.objects.create(name=name, vendor=VENDOR_FEDORA)
+            for arch in ['x86_64', 'src']:
+                dist.components.add(Component.objects.create(name=f'{name}-{arch}'))
+        Package.objects.create(name='shared', all_distributions=True)
+        directory = os.path.join(self.incoming, 'f40')
+        os.makedirs(directory)
+        return directory
+
+    def test_prepare(self):
+        self.add_fedora()
+        calls = os.path.join(self.workdir, 'restorecon.log')
+        with open(os.path.join(self.bindir, 'restorecon'), 'w') as stream:
+            stream.write(f'#!/bin/sh\nfor arg in "$@"; do echo "$arg" >> {calls}; done\n')
+
+        # all directories created by prepare() are relabeled, once
+        with override_settings(SELINUX=True):
+            self.process()
+            with open(calls) as stream:
+                relabeled = set(stream.read().splitlines())
+            os.remove(calls)
+            self.process()
+        for path in ['rpm', 'rpm/pool', 'rpm/f40-x86_64', 'rpm/f41-src', 'cache/f40-x86_64', 'deb/conf']:
+            self.assertIn(os.path.join(self.workdir, path), relabeled)
+        self.assertFalse(os.path.exists(calls))
+
+    def test_metrics(self):
+        make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        self.process()
+
+        # uploads are counted per dist, directory metrics per dist directory
+        lines = self.client.get('/metrics').content.decode('utf-8').splitlines()
+        self.assertIn('repomanager_uploads_total{dist="bookworm",outcome="added"} 1', lines)
+        self.assertIn('repomanager_directory_seconds_count{directory="bookworm-amd64",outcome="ok"} 1', lines)
+        self.assertTrue(any(line.startswith('repomanager_db_queries_total{directory="bookworm-amd64"}')
+                            for line in lines))
+
+    def test_leftover_deb_failure(self):
+        # a .deb file without .changes file that reprepro rejects is not recorded
+        changesfile = make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        os.remove(changesfile)
+        with open(os.path.join(self.bindir, 'reprepro'), 'w') as stream:
+            stream.write('#!/bin/sh\ncase "$*" in *" includedeb "*) exit 1 ;; esac\nexit 0\n')
+
+        with mock.patch('debian.debfile.DebFile') as debfile:
+            debfile.return_value.debcontrol.return_value = {'Package': 'hello'}
+            self.process()
+        self.assertFalse(BinaryPackage.objects.exists())
+        lines = self.client.get('/metrics').content.decode('utf-8').splitlines()
+        self.assertIn('repomanager_uploads_total{dist="bookworm",outcome="failed"} 1', lines)
+
+    def test_export_after_failure(self):
+        calls = os.path.join(self.workdir, 'reprepro.log')
+        fail = os.path.join(self.workdir, 'fail')
+        with open(os.path.join(self.bindir, 'reprepro'), 'w') as stream:
+            stream.write(f'#!/bin/sh\necho "$@" >> {calls}\n'
+                         f'case "$*" in *" export "*) [ -e {fail} ] && exit 1 ;; esac\nexit 0\n')
+        open(fail, 'w').close()
+        make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+
+        with self.assertRaises(CommandError):
+            self.process()
+        self.assertTrue(Distribution.objects.get(name='bookworm').needs_export)
+
+        # the next run exports the dist, even though nothing was uploaded
+        os.remove(fail)
+        os.remove(calls)
+        self.process()
+        self.assertFalse(Distribution.objects.get(name='bookworm').needs_export)
+        with open(calls) as stream:
+            self.assertTrue(stream.read().rstrip().endswith('export bookworm'))
+
+    def test_regenerate(self):
+        self.add_fedora()
+        calls = os.path.join(self.workdir, 'createrepo_c.log')
+        with open(os.path.join(self.bindir, 'createrepo_c'), 'w') as stream:
+            stream.write(f'#!/bin/sh\nbasename "$3" >> {calls}\n'
+                         'mkdir -p "$3/repodata" && : > "$3/repodata/repomd.xml"\n')
+
+        def regenerated(**options):
+            if os.path.exists(calls):
+                os.remove(calls)
+            self.process(**options)
+            if not os.path.exists(calls):
+                return []
+            with open(calls) as stream:
+                return sorted(stream.read().split())
+
+        # components without metadata are always regenerated
+        self.assertEqual(regenerated(), ['f40-src', 'f40-x86_64', 'f41-src', 'f41-x86_64'])
+        self.assertEqual(regenerated(), [])
+
+        # only changed components are regenerated
+        make_rpm(os.path.join(self.incoming, 'f40'), 'hello', '1.0', '1', 'x86_64', 16)
+        self.assertEqual(regenerated(), ['f40-x86_64'])
+        os.remove(os.path.join(self.workdir, 'rpm', 'f41-src', 'repodata', 'repomd.xml'))
+        self.assertEqual(regenerated(), ['f41-src'])
+
+        self.assertEqual(regenerated(regenerate_all=True), ['f40-src', 'f40-x86_64', 'f41-src', 'f41-x86_64'])
+
+    def test_locks(self):
+        from .management.commands.processincoming import Command
+
+        directory = self.add_fedora()
+        command = Command()
+        command.catalog = Catalog()
+        command.dists = command.catalog.dists
+        command.prerm = ['']
+        f40 = command.dists['f40']
+
+        # only the components of the dist are locked, unless a package goes to all dists of the vendor
+        make_rpm(directory, 'hello', '1.0', '1', 'x86_64', 16)
+        self.assertEqual(command.get_locks(f40, directory), ['rpm:f40-src', 'rpm:f40-x86_64'])
+        make_rpm(directory, 'shared', '1.0', '1', 'x86_64', 16)
+        self.assertEqual(command.get_locks(f40, directory),
+                         ['rpm:f40-src', 'rpm:f40-x86_64', 'rpm:f41-src', 'rpm:f41-x86_64'])
+        self.assertEqual(command.get_locks(command.dists['bookworm'], self.directory),
+                         [f'reprepro:{self.workdir}/deb'])
+
+    def test_jobs(self):
+        directories = [self.directory, self.add_fedora()]
+        make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        make_rpm(directories[1], 'hello', '1.0', '1', 'x86_64', 16)
+
+        output = self.process(jobs=2, verbosity=2).splitlines()
+        self.assertTrue(SourcePackage.objects.filter(package__name='hello', dist__name='bookworm').exists())
+        self.assertTrue(BinaryPackage.objects.filter(package__name='hello', dist__name='f40').exists())
+
+        # the output of a directory, including the output of the commands it ran, is not interleaved
+        ranges = []
+        for directory in directories:
+            indexes = [i for i, line in enumerate(output) if f'{directory}/' in line]
+            self.assertTrue(indexes)
+            ranges.append((min(indexes), max(indexes)))
+        self.assertTrue(any(line.startswith('rpm: ') for line in output))
+        self.assertLess(ranges[0][1], ranges[1][0])
+
+    def test_jobs_catalog(self):
+        from .management.commands import processincoming
+
+        trixie = Distribution.objects.create(name='trixie', vendor=VENDOR_DEBIAN)
+        trixie.components.add(Component.objects.get(name='main'))
+        directory = os.path.join(self.incoming, 'trixie-amd64')
+        os.makedirs(directory)
+        make_changes(self.directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        make_changes(directory, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        enqueue([(self.directory, 'reprepro'), (directory, 'reprepro')])
+
+        # another worker records the same upload after the first job loaded the rows of the package
+        claim = processincoming.claim_job
+
+        def racing_claim(worker, timeout):
+            if Job.objects.filter(status=JOB_DONE).exists() and not SourcePackage.objects.filter(dist=trixie):
+                SourcePackage.objects.create(package=Package.objects.get(name='hello'), dist=trixie,
+                                             version='1.0-1')
+            return claim(worker, timeout)
+
+        with mock.patch.object(processincoming, 'claim_job', racing_claim):
+            self.process(worker=True)
+        self.assertEqual(list(Job.objects.values_list('status', flat=True)), [JOB_DONE, JOB_DONE])
+        self.assertEqual(SourcePackage.objects.get(dist=trixie).components.get().name, 'main')
+
+    def test_publish_jobs(self):
+        done = Job.objects.create(path=self.directory, lock='reprepro', status=JOB_DONE, needs_publish=True,
+                                  publish={'dists': ['bookworm']}, finished=timezone.now())
+        running = Job.objects.create(path=f'{self.incoming}/trixie-amd64', lock='reprepro',
+                                     status=JOB_RUNNING, started=timezone.now())
+
+        # indices are not exported while another worker runs reprepro
+        self.process(worker=True)
+        self.assertTrue(Job.objects.get(pk=done.pk).needs_publish)
+
+        Job.objects.filter(pk=running.pk).update(status=JOB_DONE, finished=timezone.now())
+        self.process(worker=True)
+        self.assertFalse(Job.objects.get(pk=done.pk).needs_publish)
+
+    def test_malformed_changes(self):
+        # a .changes file without Files field is recorded as failed and quarantined, not raised
+        changesfile = os.path.join(self.directory, 'hello_1.0-1_amd64.changes')
+        with open(changesfile, 'w') as stream:
+            stream.write('Source: hello\nVersion: 1.0-1\n')
+
+        for attempt in range(1, 3):
+            PendingUpload.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+            self.process(max_attempts=2)
+            entry = PendingUpload.objects.get(path=changesfile)
+            self.assertEqual(entry.attempts, attempt)
+            self.assertIn('Invalid .changes file', entry.last_error)
+        self.assertTrue(entry.quarantined)
+        self.assertFalse(SourcePackage.objects.exists())
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Test data migrations."""
+
+    def migrate(self, target=None):
+        """Migrate to `target`, or to the latest migration, and return the apps of that state."""
+
+        executor = MigrationExecutor(connection)
+        targets = [('repomanager', target)] if target else executor.loader.graph.leaf_nodes('repomanager')
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def test_merge_duplicates(self):
+        apps = self.migrate('0008_auto_20250829_0202')
+        self.addCleanup(self.migrate)
+        package = apps.get_model('repomanager', 'Package').objects.create(name='hello')
+        Distribution = apps.get_model('repomanager', 'Distribution')
+        dist = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        SourcePackage = apps.get_model('repomanager', 'SourcePackage')
+        Component = apps.get_model('repomanager', 'Component')
+        for name in ['main', 'contrib']:
+            row = SourcePackage.objects.create(package=package, dist=dist, version='1.0')
+            row.components.add(Component.objects.create(name=name))
+
+        # the components of removed duplicates are kept
+        apps = self.migrate('0009_package_indexes')
+        row = apps.get_model('repomanager', 'SourcePackage').objects.get()
+        self.assertEqual(sorted(c.name for c in row.components.all()), ['contrib', 'main'])
+
+
+class PoolTestCase(TestCase):
+    """Test the content-addressed pool of RPM files."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.basedir = tmp.name
+        self.pooldir = os.path.join(self.basedir, 'pool')
+
+    def write(self, name, data=b'rpm'):
+        path = os.path.join(self.basedir, name)
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        return path
+
+    def test_deduplication(self):
+        dest, method = add_to_pool(self.pooldir, self.write('hello-1.0-1.x86_64.rpm'))
+        self.assertEqual(dest, get_pool_path(self.pooldir, sha256sum(dest), '.rpm'))
+        self.assertNotEqual(method, 'exists')
+
+        # identical content is stored once, no matter the file name
+        self.assertEqual(add_to_pool(self.pooldir, self.write('hello-1.0-2.x86_64.rpm')), (dest, 'exists'))
+        dest2, method = add_to_pool(self.pooldir, self.write('hello-1.0-3.x86_64.rpm', b'other'))
+        self.assertNotEqual(dest2, dest)
+        self.assertNotEqual(method, 'exists')
+
+    def test_fallback(self):
+        path = self.write('hello-1.0-1.x86_64.rpm')
+        self.assertEqual(add_to_pool(self.pooldir, path, link=True)[1], 'hardlink')
+
+        # the filesystem (or Python build) of the test might not support reflinks and copy_file_range(), so
+        # they are mocked
+        exdev = OSError(errno.EXDEV, 'Invalid cross-device link')
+        unsupported = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+        cases = [
+            ({'os.link': exdev, 'fcntl.ioctl': None}, 'reflink'),
+            ({'os.link': exdev, 'fcntl.ioctl': unsupported,
+              'os.copy_file_range': lambda src, dest, count: os.write(dest, os.read(src, count))},
+             'copy_file_range'),
+            ({'os.link': exdev, 'fcntl.ioctl': unsupported, 'os.copy_file_range': unsupported}, 'copy'),
+        ]
+        for i, (side_effects, expected) in enumerate(cases):
+            path = self.write(f'hello-1.0-{i}.x86_64.rpm', f'rpm {i}'.encode('utf-8'))
+            with ExitStack() as stack:
+                for target, side_effect in side_effects.items():
+                    stack.enter_context(mock.patch(target, side_effect=side_effect, create=True))
+                dest, method = add_to_pool(self.pooldir, path, link=True)
+            self.assertEqual(method, expected)
+            if expected != 'reflink':  # the mocked ioctl doesn't copy anything
+                with open(dest, 'rb') as stream:
+                    self.assertEqual(stream.read(), f'rpm {i}'.encode('utf-8'))
+
+    def test_cleanup(self):
+        used = add_to_pool(self.pooldir, self.write('hello-1.0-1.x86_64.rpm'))[0]
+        unused = add_to_pool(self.pooldir, self.write('hello-1.0-2.x86_64.rpm', b'removed'))[0]
+        os.makedirs(os.path.join(self.basedir, 'f40-x86_64'))
+        symlink(used, os.path.join(self.basedir, 'f40-x86_64', 'hello-1.0-1.f40.x86_64.rpm'))
+
+        self.assertEqual(find_unreferenced(self.pooldir, self.basedir, min_age=3600), [])
+        self.assertEqual(find_unreferenced(self.pooldir, self.basedir, min_age=0), [unused])
+
+        with override_settings(RPM_BASEDIR=self.basedir):
+            call_command('cleanpool', min_age=0, dry_run=True, stdout=StringIO())
+            self.assertTrue(os.path.exists(unused))
+            call_command('cleanpool', min_age=0, stdout=StringIO())
+        self.assertFalse(os.path.exists(unused))
+        self.assertTrue(os.path.exists(used))
+
+
+class RpmTestCase(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def write_rpm(self, rpmtype, entries, name='hello.rpm'):
+        path = os.path.join(self.directory, name)
+        lead = RPM_LEAD.pack(RPM_MAGIC, 3, 0, rpmtype, 1, b'hello-1.0-1', 1, 5, b'')
+        with open(path, 'wb') as stream:
+            stream.write(lead + _rpm_header([(1000, 0)], signature=True) + _rpm_header(entries))
+        return path
+
+    def test_read_header(self):
+        path = make_rpm(self.directory, 'hello', '1.0', '1', 'x86_64', 16)
+        self.assertEqual(read_rpm_header(path), ('hello', '1.0', '1', 'x86_64'))
+
+    def test_read_source_header(self):
+        entries = [(1000, 'hello'), (1001, '1.0'), (1002, '1'), (1022, 'x86_64')]
+
+        # source RPMs are detected by the type in the lead, even if they have a SOURCERPM tag
+        path = self.write_rpm(RPM_TYPE_SOURCE, entries + [(1044, 'hello-1.0-1.src.rpm')])
+        self.assertEqual(read_rpm_header(path).arch, 'src')
+
+        # ... or by the missing SOURCERPM tag
+        self.assertEqual(read_rpm_header(self.write_rpm(0, entries)).arch, 'src')
+        self.assertEqual(read_rpm_header(make_rpm(self.directory, 'hello', '1.0', '1', 'src', 16)),
+                         ('hello', '1.0', '1', 'src'))
+
+    def test_read_invalid_header(self):
+        path = make_rpm(self.directory, 'hello', '1.0', '1', 'x86_64', 16)
+        with open(path, 'rb') as stream:
+            data = stream.read()
+
+        for invalid in [b'', b'not an rpm file' * 10, data[:RPM_LEAD.size - 1], data[:RPM_LEAD.size + 20],
+                        data[:len(data) - 40]]:
+            with open(path, 'wb') as stream:
+                stream.write(invalid)
+            with self.assertRaises(RuntimeError):
+                read_rpm_header(path)
+
+        with self.assertRaisesRegex(RuntimeError, 'has no'):
+            read_rpm_header(self.write_rpm(0, [(1000, 'hello'), (1002, '1')]))
+
+    def test_parse_checksig(self):
+        paths = ['/in/a.rpm', '/in/b: c.rpm', '/in/d.rpm', '/in/e.rpm']
+        output = '\n'.join([
+            '/in/a.rpm: digests signatures OK',
+            '/in/b: c.rpm: digests SIGNATURES NOT OK',
+            '/in/d.rpm: rsa sha1 (md5) pgp md5 OK',
+        ])
+        statuses = parse_checksig(paths, output)
+        self.assertEqual(statuses, {
+            '/in/a.rpm': 'digests signatures OK',
+            '/in/b: c.rpm': 'digests SIGNATURES NOT OK',
+            '/in/d.rpm': 'rsa sha1 (md5) pgp md5 OK',
+        })
+        self.assertEqual([p for p, s in statuses.items() if is_valid_checksig(s)], ['/in/a.rpm', '/in/d.rpm'])
+
+
+class JobTestCase(TestCase):
+    """Test the job queue used by processincoming --enqueue and --worker."""
+
+    def test_enqueue(self):
+        self.assertEqual(enqueue([('/in/bookworm-amd64', 'reprepro'), ('/in/f40', 'rpm:2')]), 2)
+        self.assertEqual(enqueue([('/in/bookworm-amd64', 'reprepro')]), 0)
+
+        job = claim_job('worker1', timeout=60)
+        finish_job(job, {})
+        self.assertEqual(enqueue([('/in/bookworm-amd64', 'reprepro')]), 1)
+
+    def test_claim(self):
+        enqueue([('/in/bookworm-amd64', 'reprepro'), ('/in/buster-amd64', 'reprepro'), ('/in/f40', 'rpm:2')])
+
+        job = claim_job('worker1', timeout=60)
+        self.assertEqual((job.path, job.attempts, job.worker), ('/in/bookworm-amd64', 1, 'worker1'))
+
+        # jobs with the same lock don't run at the same time
+        self.assertEqual(claim_job('worker2', timeout=60).path, '/in/f40')
+        self.assertIsNone(claim_job('worker2', timeout=60))
+
+        # jobs of workers that take too long are claimed again
+        Job.objects.filter(pk=job.pk).update(started=timezone.now() - timedelta(seconds=120))
+        job2 = claim_job('worker2', timeout=60)
+        self.assertEqual((job2.pk, job2.attempts), (job.pk, 2))
+        self.assertFalse(finish_job(job, {}))
+        self.assertTrue(finish_job(job2, {}))
+
+    def test_claim_exclusion(self):
+        # the database makes sure that jobs with the same lock don't run at the same time
+        pending = Job.objects.create(path='/in/bookworm-amd64', lock='reprepro')
+        stale = Job.objects.create(path='/in/buster-amd64', lock='reprepro', status=JOB_RUNNING,
+                                   started=timezone.now() - timedelta(seconds=120))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Job.objects.filter(pk=pending.pk).update(status=JOB_RUNNING)
+        self.assertTrue(is_lock_busy('reprepro'))
+        self.assertFalse(is_lock_busy('rpm:2'))
+
+        # the older pending job can't start before the stale job is finished, so that one is claimed again
+        job = claim_job('worker1', timeout=60)
+        self.assertEqual((job.pk, job.attempts), (stale.pk, 1))
+        self.assertIsNone(claim_job('worker2', timeout=60))
+        finish_job(job, {})
+        self.assertEqual(claim_job('worker2', timeout=60).pk, pending.pk)
+
+    def test_retry(self):
+        enqueue([('/in/f40', 'rpm:2')])
+        for status, backoff in [(JOB_PENDING, 60), (JOB_PENDING, 120), (JOB_FAILED, None)]:
+            job = claim_job('worker1', timeout=60)
+            before = timezone.now()
+            finish_job(job, {}, error='failed', max_attempts=3, backoff=60)
+            job = Job.objects.get()
+            self.assertEqual(job.status, status)
+            if backoff is None:
+                self.assertIsNone(job.next_attempt)
+                continue
+
+            # failed jobs are not retried before the backoff expired
+            self.assertGreaterEqual(job.next_attempt, before + timedelta(seconds=backoff))
+            self.assertIsNone(claim_job('worker1', timeout=60))
+            Job.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(claim_job('worker1', timeout=60))
+
+    def test_publication(self):
+        enqueue([('/in/f40', 'rpm:2'), ('/in/f41', 'rpm:2')])
+        finish_job(claim_job('worker1', timeout=60), {'components': ['f40-x86_64'], 'dists': []})
+        finish_job(claim_job('worker1', timeout=60), {'components': ['f41-x86_64'], 'dists': []})
+
+        jobs, publication = get_publication()
+        self.assertEqual(publication, {'components': {'f40-x86_64', 'f41-x86_64'}, 'dists': set()})
+        mark_published(jobs, timezone.now())
+        self.assertEqual(get_publication(), ([], {}))
+        self.assertEqual(Job.objects.filter(status=JOB_DONE).count(), 2)
+
+    def test_lease(self):
+        self.assertTrue(acquire_lease('publish', 'worker1', 60))
+        self.assertFalse(acquire_lease('publish', 'worker2', 60))
+        self.assertTrue(acquire_lease('publish', 'worker1', 60))
+        release_lease('publish', 'worker1')
+        self.assertTrue(acquire_lease('publish', 'worker2', 60))
+
+
+class ChecksumTestCase(TestCase):
+    """Test verifying the files of a .changes file."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.changesfile = make_changes(tmp.name, 'hello', '1.0-1', ['hello'], 'amd64', 16)
+        self.deb = os.path.join(tmp.name, 'hello_1.0-1_amd64.deb')
+        self.executor = ThreadPoolExecutor(2)
+        self.addCleanup(self.executor.shutdown)
+
+    def verify(self):
+        with open(self.changesfile) as stream:
+            return verify_changes(self.changesfile, deb822.Changes(stream), self.executor)
+
+    def test_ok(self):
+        result = self.verify()
+        self.assertTrue(result.ok)
+        self.assertGreater(result.size, 16)
+
+    def test_missing(self):
+        os.remove(self.deb)
+        result = self.verify()
+        self.assertEqual(result.missing, ['hello_1.0-1_amd64.deb'])
+        self.assertFalse(result.complete)
+
+    def test_size_mismatch(self):
+        with open(self.deb, 'ab') as stream:
+            stream.write(b'more')
+        result = self.verify()
+        self.assertEqual(result.incomplete, ['hello_1.0-1_amd64.deb'])
+        self.assertEqual(result.mismatched, [])  # incomplete files are not hashed
+
+    def test_sha256_mismatch(self):
+        with open(self.deb, 'r+b') as stream:
+            stream.write(b'?')
+        result = self.verify()
+        self.assertTrue(result.complete)
+        self.assertEqual(result.mismatched, ['hello_1.0-1_amd64.deb'])
+
+    def test_invalid_size(self):
+        with open(self.changesfile) as stream:
+            data = stream.read()
+        with open(self.changesfile, 'w') as stream:
+            stream.write(re.sub(r' [0-9]+ hello_1.0-1_amd64.deb', ' big hello_1.0-1_amd64.deb', data))
+        result = self.verify()
+        self.assertEqual(result.mismatched, ['hello_1.0-1_amd64.deb'])
+        self.assertFalse(result.ok)
+
+
+class UploadTestCase(TestCase):
+    """Test uploading packages over HTTP."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('uploader', password='password')
+        cls.user.user_permissions.add(Permission.objects.get(codename='add_job'))
+        Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        Distribution.objects.create(name='f40', vendor=VENDOR_FEDORA)
+
+    def setUp(self):
+        incoming = tempfile.TemporaryDirectory()
+        self.addCleanup(incoming.cleanup)
+        self.incoming = incoming.name
+        IncomingDirectory.objects.create(location=self.incoming)
+        for dirname in ['bookworm-amd64', 'f40']:
+            os.mkdir(os.path.join(self.incoming, dirname))
+
+        # files to upload are generated in a separate directory
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        self.source = source.name
+
+    def post(self, dirname, names, username='uploader'):
+        credentials = base64.b64encode(f'{username}:password'.encode('utf-8')).decode('ascii')
+        files = {}
+        for i, name in enumerate(names):
+            files[f'file{i}'] = open(os.path.join(self.source, name), 'rb')
+            self.addCleanup(files[f'file{i}'].close)
+        return self.client.post(f'/upload/{dirname}/', files, HTTP_AUTHORIZATION=f'Basic {credentials}')
+
+    def listdir(self, dirname):
+        return sorted(os.listdir(os.path.join(self.incoming, dirname)))
+
+    def test_changes(self):
+        make_changes(self.source, 'hello', '1.0-1', ['hello'], 'amd64', 1024)
+        names = sorted(os.listdir(self.source))
+        response = self.post('bookworm-amd64', names)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['files']['hello_1.0-1_amd64.deb']['size'], 1032)
+        self.assertEqual(self.listdir('bookworm-amd64'), names)
+        self.assertEqual(Job.objects.get().path, os.path.join(self.incoming, 'bookworm-amd64'))
+
+    def test_rejected(self):
+        make_changes(self.source, 'hello', '1.0-1', ['hello'], 'amd64', 1024)
+        with open(os.path.join(self.source, 'hello_1.0-1_amd64.deb'), 'ab') as stream:
+            stream.write(b'corrupt')
+
+        response = self.post('bookworm-amd64', os.listdir(self.source))
+        self.assertEqual(response.status_code, 400)
+        response = self.post('bookworm-amd64', ['hello_1.0-1_amd64.deb'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.listdir('bookworm-amd64'), [])  # temporary files are removed
+        self.assertFalse(Job.objects.exists())
+
+    def test_invalid_changes(self):
+        changesfile = make_changes(self.source, 'hello', '1.0-1', ['hello'], 'amd64', 1024)
+        with open(changesfile) as stream:
+            data = stream.read()
+
+        for invalid, error in [
+            ('Source: hello\nVersion: 1.0-1\n', 'missing field'),
+            (re.sub(r' [0-9]+ hello_1.0-1_amd64.deb', ' big hello_1.0-1_amd64.deb', data),
+             'Invalid size of hello_1.0-1_amd64.deb'),
+        ]:
+            with open(changesfile, 'w') as stream:
+                stream.write(invalid)
+            response = self.post('bookworm-amd64', os.listdir(self.source))
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(error, response.json()['error'])
+        self.assertEqual(self.listdir('bookworm-amd64'), [])
+
+    def test_rpm(self):
+        make_rpm(self.source, 'hello', '1.0', '1', 'x86_64', 1024)
+        response = self.post('f40', ['hello-1.0-1.x86_64.rpm'])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.listdir('f40'), ['hello-1.0-1.x86_64.rpm'])
+
+    def test_permissions(self):
+        User.objects.create_user('nobody', password='password')
+        make_rpm(self.source, 'hello', '1.0', '1', 'x86_64', 1024)
+        self.assertEqual(self.post('f40', ['hello-1.0-1.x86_64.rpm'], username='unknown').status_code, 401)
+        self.assertEqual(self.post('f40', ['hello-1.0-1.x86_64.rpm'], username='nobody').status_code, 403)
+        self.assertEqual(self.post('f41', ['hello-1.0-1.x86_64.rpm']).status_code, 404)
+
+
+class ApiTestCase(TestCase):
+    """Test the JSON API."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.main = Component.objects.create(name='main')
+        cls.dist = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        cls.dist.components.add(cls.main)
+        for name in ['a', 'b', 'c']:
+            package = Package.objects.create(name=name)
+            package.components.add(cls.main)
+            source = SourcePackage.objects.create(package=package, dist=cls.dist, version='1.0')
+            source.components.add(cls.main)
+            for arch in ['amd64', 'arm64']:
+                BinaryPackage.objects.create(package=package, name=f'lib{name}', dist=cls.dist, arch=arch,
+                                             version='1.0')
+
+    def setUp(self):
+        django_cache.clear()
+
+    def test_pagination(self):
+        response = self.client.get('/api/packages/?limit=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([p['name'] for p in data['results']], ['a', 'b'])
+        self.assertEqual(data['results'][0]['components'], ['main'])
+
+        data = self.client.get(data['next']).json()
+        self.assertEqual([p['name'] for p in data['results']], ['c'])
+        self.assertIsNone(data['next'])
+
+        self.assertEqual(self.client.get('/api/packages/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/sourcepackages/?after=x').status_code, 400)
+        self.assertEqual(self.client.get('/api/sourcepackages/?newer_than=1.0').status_code, 400)
+
+    def test_filters(self):
+        data = self.client.get('/api/binarypackages/?arch=arm64&limit=1').json()
+        self.assertEqual(data['results'][0]['name'], 'liba')
+        data = self.client.get(data['next'].replace('limit=1', 'limit=10')).json()
+        self.assertEqual([(p['name'], p['arch']) for p in data['results']],
+                         [('libb', 'arm64'), ('libc', 'arm64')])
+
+        data = self.client.get('/api/sourcepackages/?dist=bookworm&newer_than=0.9&newest=1').json()
+        self.assertEqual(len(data['results']), 3)
+
+        data = self.client.get('/api/sourcepackages/?package=b&component=main').json()
+        self.assertEqual([(p['package'], p['dist'], p['version']) for p in data['results']],
+                         [('b', 'bookworm', '1.0')])
+
+    def test_conditional(self):
+        response = self.client.get('/api/sourcepackages/')
+        self.assertIn('Last-Modified', response)
+        response = self.client.get('/api/sourcepackages/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidation(self):
+        response = self.client.get('/api/sourcepackages/?package=a')
+        self.assertEqual(response.json()['results'][0]['version'], '1.0')
+
+        recorder = UploadRecorder(Catalog())
+        recorder.record_source(Package.objects.get(name='a'), self.dist, '2.0', [self.main])
+        with self.captureOnCommitCallbacks(execute=True):
+            recorder.flush()
+
+        second = self.client.get('/api/sourcepackages/?package=a', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['results'][0]['version'], '2.0')
+
+
+class VersionTestCase(TestCase):
+    """Test version keys and queries for the newest versions."""
+
+    def assertOrdered(self, get_key, versions):
+        for older, newer in zip(versions, versions[1:]):
+            self.assertLess(get_key(older), get_key(newer), f'{older} < {newer}')
+
+    def test_dpkg(self):
+        self.assertOrdered(get_dpkg_key, [
+            '1.0~~', '1.0~~a', '1.0~', '1.0', '1.0-1~bpo12+1', '1.0-1', '1.0-1+b1', '1.0-1.1', '1.0a',
+            '1.0+dfsg', '1.0.1', '1.2', '1.10', '2~rc1', '2', '10', '1:0.9', '2:0.1',
+        ])
+        for a, b in [('1.0', '1.00'), ('1.0', '1.0-0'), ('0:1.0', '1.0'), ('a', 'a0')]:
+            self.assertEqual(get_dpkg_key(a), get_dpkg_key(b))
+
+    def test_rpm(self):
+        self.assertOrdered(get_rpm_key, [
+            '1.a-1', '1.0~rc1-1', '1.0-1', '1.0-1.fc40', '1.0-2', '1.0-10', '1.0^git1-1', '1.0a-1', '1.0.1-1',
+            '1.1-1', '1:0.9-1',
+        ])
+        for a, b in [('1.0-1', '1_0-1'), ('1.0-1', '1.0.-1'), ('01-1', '1-1')]:
+            self.assertEqual(get_rpm_key(a), get_rpm_key(b))
+
+    def test_newest(self):
+        main = Component.objects.create(name='main')
+        bookworm = Distribution.objects.create(name='bookworm', vendor=VENDOR_DEBIAN)
+        fedora = Distribution.objects.create(name='f40', vendor=VENDOR_FEDORA)
+        hello = Package.objects.create(name='hello')
+
+        recorder = UploadRecorder(Catalog())
+        for version in ['1.10-1', '1.9-1', '1.10~rc1-1']:
+            recorder.record_binary(hello, 'hello', fedora, 'x86_64', version, [main], by_version=True)
+        recorder.record_binary(hello, 'hello', fedora, 'aarch64', '1.9-1', [main], by_version=True)
+        recorder.flush()
+        for version in ['1.0', '1:0.1', '1.0+b1']:
+            SourcePackage.objects.create(package=hello, dist=bookworm, version=version)
+
+        newest = BinaryPackage.objects.newest().order_by('arch')
+        self.assertEqual([(p.arch, p.version) for p in newest], [('aarch64', '1.9-1'), ('x86_64', '1.10-1')])
+        self.assertEqual(SourcePackage.objects.newest().get().version, '1:0.1')
+
+        newer = BinaryPackage.objects.newer_than(fedora, '1.9-1').order_by('version_key')
+        self.assertEqual([p.version for p in newer], ['1.10~rc1-1', '1.10-1'])
+
+
+class ExecutorTestCase(TestCase):
+    """Test running external commands with ToolExecutor."""
+
+    def test_run(self):
+        results = []
+        with ToolExecutor(observer=results.append) as executor:
+            result = executor.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual((result.returncode, result.stdout, result.stderr), (3, b'out\n', b'err\n'))
+        self.assertEqual(result.tool, 'sh')
+        self.assertFalse(result.ok)
+        self.assertEqual(results, [result])
+
+    def test_limits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # each command fails if another one is running at the same time
+            script = f'mkdir {tmp}/running || exit 1; sleep 0.1; rmdir {tmp}/running'
+            with ToolExecutor(limits={'sh': 1}) as executor:
+                futures = [executor.submit(['sh', '-c', script]) for i in range(3)]
+                self.assertTrue(all(f.result().ok for f in futures))
+
+            with ToolExecutor() as executor:
+                futures = [executor.submit(['sh', '-c', script], key='key') for i in range(3)]
+                self.assertTrue(all(f.result().ok for f in futures))
+
+            # lock files also serialize commands of different executors (or processes)
+            lockfile = os.path.join(tmp, 'lock')
+            with ToolExecutor() as first, ToolExecutor() as second:
+                futures = [executor.submit(['sh', '-c', script], lockfile=lockfile)
+                           for executor in [first, second, first]]
+                self.assertTrue(all(f.result().ok for f in futures))
+
+    def test_timeout(self):
+        with ToolExecutor(timeout=0.1) as executor:
+            result = executor.run(['sleep', '10'])
+            self.assertTrue(result.timed_out)
+            self.assertFalse(result.ok)
+            self.assertLess(result.duration, 5)
+
+            future = executor.submit(['sleep', '10'], timeout=60)
+            future.cancel()
+        self.assertTrue(future.cancelled())
+
+    def test_output(self):
+        lines = []
+        with ToolExecutor(output_limit=1000) as executor:
+            script = 'seq 100000; echo error >&2'
+            result = executor.run(['sh', '-c', script], on_line=lambda *args: lines.append(args))
+        self.assertTrue(result.truncated)
+        self.assertEqual(len(result.stdout), 1000)
+        self.assertTrue(result.stdout.endswith(b'\n99999\n100000\n'))
+        self.assertEqual(result.stderr, b'error\n')
+        self.assertEqual(len(lines), 100001)
+        self.assertEqual(lines[:2], [('stdout', b'1'), ('stdout', b'2')])
+        self.assertIn(('stderr', b'error'), lines)
+
+    def test_output_tail(self):
+        lines = []
+        tail = OutputTail(4, lines.append)
+        for chunk in [b'a', b'bc\nd', b'ef', b'\n\ng']:
+            tail.feed(chunk)
+        tail.close()
+        self.assertEqual(tail.getvalue(), b'f\n\ng')
+        self.assertTrue(tail.truncated)
+        self.assertEqual(lines, [b'abc', b'def', b'', b'g'])
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(['rpm=8', 'createrepo_c=2']), {'rpm': 8, 'createrepo_c': 2})
+        for value in ['rpm', 'rpm=0', '=2', 'rpm=x']:
+            with self.assertRaises(ValueError):
+                parse_limits([value])
+
+
+class PrecheckTestCase(TestCase):
+    """Test checking for work without setting up Django."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.incoming = os.path.join(tmp.name, 'incoming')
+        self.state = os.path.join(tmp.name, 'state', 'precheck.json')
+        os.makedirs(os.path.join(self.incoming, 'f40'))
+
+    def write(self, name, data=b'data'):
+        path = os.path.join(self.incoming, 'f40', name)
+        with open(path, 'ab') as stream:
+            stream.write(data)
+        return path
+
+    def check(self, **kwargs):
+        return check(load_state(self.state), max_age=3600, **kwargs)[0]
+
+    def test_check(self):
+        self.assertTrue(self.check())  # no state yet
+
+        save_state(self.state, [self.incoming], scan([self.incoming])[0])
+        self.assertFalse(self.check())
+        self.assertTrue(self.check(now=time.time() + 3600))
+
+        # a new upload, and an upload that is still being written
+        path = self.write('hello-1.0-1.x86_64.rpm')
+        self.assertTrue(self.check())
+        save_state(self.state, [self.incoming], scan([self.incoming])[0])
+        self.assertFalse(self.check())
+        os.utime(path, ns=(0, 0))
+        self.assertTrue(self.check())
+
+        # hidden files (e.g. uploads over HTTP in progress) are ignored
+        os.remove(path)
+        self.write('.hello.upload')
+        self.assertFalse(self.check())
+
+    def test_retry(self):
+        self.write('hello_1.0-1_amd64.changes')
+        save_state(self.state, [self.incoming], scan([self.incoming])[0], retry_at=time.time() + 60)
+        self.assertFalse(self.check())
+        self.assertTrue(self.check(now=time.time() + 60))
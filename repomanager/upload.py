@@ -0,0 +1,159 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Receive packages over HTTP and publish them into an incoming directory.
+
+Files are written to hidden temporary files in the dist directory while they are received (and hashed
+on the way), so they are never buffered in memory. Once the upload is complete and verified, they are
+renamed to their final names, .changes files last. processincoming thus never sees incomplete uploads.
+"""
+
+import hashlib
+import os
+import uuid
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from debian import deb822
+
+from .checksums import get_checksums
+from .checksums import hexdigest
+from .constants import VENDOR_DEBIAN
+from .constants import VENDOR_UBUNTU
+from .rpm import read_rpm_header
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """The upload was rejected."""
+
+
+class StagedFile(UploadedFile):
+    """A file received by :py:class:`StagingUploadHandler`, stored at `path` until it is published."""
+
+    def __init__(self, path, name, size, sha256, content_type=None):
+        super().__init__(file=None, name=name, content_type=content_type, size=size)
+        self.path = path
+        self.sha256 = sha256
+
+
+class StagingUploadHandler(FileUploadHandler):
+    """Upload handler that writes files to hidden temporary files in `directory`.
+
+    The paths of all temporary files are in `staged`, the caller has to remove those that are not
+    published.
+    """
+
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, directory, request=None):
+        super().__init__(request)
+        self.directory = directory
+        self.staged = []
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        if not file_name or file_name.startswith('.') or os.sep in file_name:
+            raise UploadError(f'Invalid file name: {file_name}')
+
+        # the suffix makes sure that processincoming ignores the file
+        self.path = os.path.join(self.directory, f'.{file_name}.{uuid.uuid4().hex}.upload')
+        self.stream = open(self.path, 'xb')
+        self.staged.append(self.path)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.stream.write(raw_data)
+        self.digest.update(raw_data)
+        self.size += len(raw_data)
+        return None  # no other handler gets the data
+
+    def file_complete(self, file_size):
+        self.stream.close()
+        return StagedFile(self.path, self.file_name, self.size, self.digest.hexdigest(), self.content_type)
+
+    def upload_interrupted(self):
+        if hasattr(self, 'stream'):
+            self.stream.close()
+
+
+def check_changes(directory, files):
+    """Check that the .changes files in `files` are complete and match the other files."""
+
+    changesfiles = [f for name, f in files.items() if name.endswith('.changes')]
+    if not changesfiles:
+        raise UploadError('No .changes file uploaded.')
+
+    referenced = set()
+    for changesfile in changesfiles:
+        try:
+            with open(changesfile.path) as stream:
+                changes = deb822.Changes(stream)
+            checksums = get_checksums(changes)
+        except KeyError as e:
+            raise UploadError(f'{changesfile.name}: Invalid .changes file, missing field {e}.')
+        except ValueError as e:  # also raised if the file is not UTF-8
+            raise UploadError(f'{changesfile.name}: Invalid .changes file: {e}')
+
+        for name, size, algorithm, expected in checksums:
+            referenced.add(name)
+            if size is None:
+                raise UploadError(f'{changesfile.name}: Invalid size of {name}.')
+            uploaded = files.get(name)
+            if uploaded is None:
+                # may have been uploaded before
+                if not os.path.exists(os.path.join(directory, name)):
+                    raise UploadError(f'{changesfile.name}: {name} is missing.')
+                continue
+
+            if uploaded.size != size:
+                raise UploadError(f'{changesfile.name}: {name} has {uploaded.size} bytes, expected {size}.')
+            # SHA-256 was calculated while receiving the file
+            actual = uploaded.sha256 if algorithm == 'sha256' else hexdigest(uploaded.path, algorithm)
+            if actual != expected.lower():
+                raise UploadError(f'{changesfile.name}: Checksum mismatch for {name}.')
+
+    unreferenced = sorted(name for name in files if not name.endswith('.changes') and name not in referenced)
+    if unreferenced:
+        raise UploadError('Not referenced by a .changes file: %s' % ', '.join(unreferenced))
+
+
+def publish_upload(directory, dist, files):
+    """Verify uploaded files and move them from their temporary location into `directory`.
+
+    `files` is a list of :py:class:`StagedFile` instances. Raises :py:class:`UploadError` if the upload
+    is rejected.
+    """
+
+    by_name = {f.name: f for f in files}
+    if len(by_name) != len(files):
+        raise UploadError('Duplicate file names.')
+
+    if dist.vendor in [VENDOR_DEBIAN, VENDOR_UBUNTU]:
+        check_changes(directory, by_name)
+    else:
+        for uploaded in files:
+            if not uploaded.name.endswith('.rpm'):
+                raise UploadError(f'{uploaded.name}: Not an RPM file.')
+            try:
+                read_rpm_header(uploaded.path)
+            except RuntimeError:
+                raise UploadError(f'{uploaded.name}: Not a valid RPM file.')
+
+    # .changes files go last, so that processincoming never sees them without their files
+    for uploaded in sorted(files, key=lambda f: f.name.endswith('.changes')):
+        os.rename(uploaded.path, os.path.join(directory, uploaded.name))
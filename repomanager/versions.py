@@ -0,0 +1,127 @@
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+"""Sortable keys for Debian and RPM version strings.
+
+A version key is a string that sorts like the version it was derived from, i.e. ``a < b`` if and only if
+version ``a`` is older than version ``b`` according to dpkg or rpm. Keys only consist of digits and lower
+case letters, so they sort the same under any database collation and queries can order and compare
+versions using an index.
+
+Keys are built from tokens that are compared left to right. Numbers are encoded with their length first
+(``42`` becomes ``"242"``), so that they compare numerically. Other characters are encoded as two base-36
+digits of their weight in the respective comparison algorithm.
+"""
+
+import re
+import string
+
+from .constants import VENDOR_DEBIAN
+from .constants import VENDOR_UBUNTU
+
+DIGITS = string.digits + string.ascii_lowercase
+
+# rpm tokens, in the order rpmvercmp() sorts them
+RPM_TILDE = '0'
+RPM_END = '1'
+RPM_CARET = '2'
+RPM_ALPHA = '3'
+RPM_NUMBER = '4'
+
+RPM_SEGMENT = re.compile(r'[~^]|[0-9]+|[a-zA-Z]+')
+
+
+def _encode_weight(weight):
+    weight = min(max(weight, 0), len(DIGITS) ** 2 - 1)
+    return DIGITS[weight // len(DIGITS)] + DIGITS[weight % len(DIGITS)]
+
+
+def _encode_number(digits):
+    digits = digits.lstrip('0')
+    return DIGITS[min(len(digits), len(DIGITS) - 1)] + digits
+
+
+def _split_epoch(version):
+    epoch, colon, rest = version.partition(':')
+    if not colon:
+        return '', version
+    return (epoch if epoch.isdigit() else ''), rest
+
+
+def _dpkg_weight(char):
+    # see order() in dpkg's lib/dpkg/version.c, shifted by 2 so that "~" is 0 and the end of a part is 1
+    if char == '~':
+        return 0
+    if char.isascii() and char.isalpha():
+        return ord(char) + 2
+    return ord(char) + 258
+
+
+def _dpkg_part_key(value):
+    """Get the key of an upstream version or revision (see verrevcmp() in dpkg)."""
+
+    # alternating runs of non-digits and digits, the first run may be empty
+    runs = re.findall(r'([^0-9]*)([0-9]*)', value)
+    key = []
+    for i, (chars, digits) in enumerate(runs):
+        if i > 0 and not chars and not digits:  # re.findall() ends with an empty match
+            break
+        key.extend(_encode_weight(_dpkg_weight(c)) for c in chars)
+        key.append(_encode_weight(1))  # end of the non-digit run sorts like the end of the string
+        key.append(_encode_number(digits))
+    key.append(_encode_weight(1))
+    return ''.join(key)
+
+
+def get_dpkg_key(version):
+    """Get the key of a Debian version (``[epoch:]upstream[-revision]``)."""
+
+    epoch, version = _split_epoch(version)
+    upstream, _, revision = version.rpartition('-') if '-' in version else (version, '', '')
+    return _encode_number(epoch) + _dpkg_part_key(upstream) + _dpkg_part_key(revision)
+
+
+def _rpm_part_key(value):
+    """Get the key of an RPM version or release (see rpmvercmp() in rpm)."""
+
+    key = []
+    for segment in RPM_SEGMENT.findall(value):
+        if segment == '~':
+            key.append(RPM_TILDE)
+        elif segment == '^':
+            key.append(RPM_CARET)
+        elif segment[0].isdigit():
+            key.append(RPM_NUMBER + _encode_number(segment))
+        else:
+            # letters are compared with strcmp(), the terminator sorts before any letter
+            letters = ''.join(_encode_weight(ord(c) - ord('A') + 1) for c in segment)
+            key.append(RPM_ALPHA + letters + _encode_weight(0))
+    key.append(RPM_END)
+    return ''.join(key)
+
+
+def get_rpm_key(version):
+    """Get the key of an RPM version (``[epoch:]version[-release]``)."""
+
+    epoch, version = _split_epoch(version)
+    version, _, release = version.rpartition('-') if '-' in version else (version, '', '')
+    return _encode_number(epoch) + _rpm_part_key(version) + _rpm_part_key(release)
+
+
+def get_version_key(vendor, version):
+    """Get the key of a version in a distribution of `vendor`."""
+
+    if vendor in (VENDOR_DEBIAN, VENDOR_UBUNTU):
+        return get_dpkg_key(version)
+    return get_rpm_key(version)
@@ -1,3 +1,113 @@
-#from django.shortcuts import render
+# This file is part of django-repomanager (https://github.com/Astranox/django-repomanager).
+#
+# django-repomanager is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# django-repomanager is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See
+# the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with django-repomanager.  If
+# not, see <http://www.gnu.org/licenses/>.
 
-# Create your views here.
+
+import base64
+import binascii
+import os
+
+from django.contrib.auth import authenticate
+from django.http import HttpResponse
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_POST
+
+from .jobs import enqueue
+from .jobs import get_job_lock
+from .metrics import render_summaries
+from .models import Distribution
+from .models import IncomingDirectory
+from .models import RunSummary
+from .upload import StagingUploadHandler
+from .upload import UploadError
+from .upload import publish_upload
+
+
+@require_GET
+def metrics(request):
+    """Metrics of processincoming in the Prometheus text format."""
+
+    return HttpResponse(render_summaries(RunSummary.objects.order_by('command')),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def get_basic_auth_user(request):
+    """Get the user authenticated with HTTP basic authentication, or None."""
+
+    method, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if method.lower() != 'basic':
+        return None
+    try:
+        username, sep, password = base64.b64decode(credentials).decode('utf-8').partition(':')
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    if not sep:
+        return None
+    return authenticate(request, username=username, password=password)
+
+
+def get_dist_directory(dirname):
+    """Get the path and the Distribution of a dist directory in an enabled incoming directory, or None."""
+
+    if not dirname or dirname.startswith('.') or os.sep in dirname:
+        return None
+
+    # same as Command.get_directory() of processincoming
+    dist = Distribution.objects.filter(name=dirname.rpartition('-')[0] if '-' in dirname else dirname).first()
+    if dist is None:
+        return None
+
+    for incoming in IncomingDirectory.objects.filter(enabled=True).order_by('location'):
+        path = os.path.join(os.path.abspath(incoming.location), dirname)
+        if os.path.isdir(path):
+            return path, dist
+    return None
+
+
+# Only HTTP basic authentication is accepted, so requests can't be forged by other sites.
+@csrf_exempt
+@require_POST
+def upload(request, dirname):
+    """Upload a .changes file with its files, or RPM files, to a dist directory and enqueue a job for it."""
+
+    user = get_basic_auth_user(request)
+    if user is None:
+        response = JsonResponse({'error': 'Authentication required.'}, status=401)
+        response['WWW-Authenticate'] = 'Basic realm="repomanager"'
+        return response
+    if not user.has_perm('repomanager.add_job'):
+        return JsonResponse({'error': 'Permission denied.'}, status=403)
+
+    directory = get_dist_directory(dirname)
+    if directory is None:
+        return JsonResponse({'error': f'{dirname}: No such dist directory.'}, status=404)
+    path, dist = directory
+
+    # must be set before the request body is parsed
+    handler = StagingUploadHandler(path, request)
+    request.upload_handlers = [handler]
+    try:
+        files = [f for field in request.FILES for f in request.FILES.getlist(field)]
+        if not files:
+            raise UploadError('No files uploaded.')
+        publish_upload(path, dist, files)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    finally:
+        for staged in handler.staged:
+            if os.path.exists(staged):
+                os.remove(staged)
+
+    enqueue([(path, get_job_lock(dist))])
+    return JsonResponse({'files': {f.name: {'size': f.size, 'sha256': f.sha256} for f in files}}, status=202)